@@ -0,0 +1,194 @@
+# ArduinoEmulator.py
+
+# Arduino（RobotManager.ino）の代わりにPC上でバイナリのシリアル通信に応答するエミュレータ。
+# 疑似端末（pty）を開き、RobotManager.ino と同じようにフレームごとにACKを返し、動作開始を受けると
+# +200 → -200 → 初期位置の動作を（既定では3秒ずつ）進める。ptyを使うため Linux / macOS 専用。
+#
+# 使い方:
+#   python ArduinoEmulator.py                   # 表示されたポートを BehaviorManager に渡す
+#   python BehaviorManager.py --arduino-port /dev/pts/5
+#   python ArduinoEmulator.py --bench 5         # 5秒間ArduinoLinkから深度値を送り続け、送信数・ACK遅延を表示する
+
+import argparse                                   # コマンドライン引数の解析用
+import os                                         # 疑似端末の作成用
+import threading                                  # エミュレータ・ベンチマークのスレッド用
+import time                                       # 動作の時間管理用
+import struct                                     # 深度値ペイロードの読み取り用
+import numpy as np                                # ACK遅延の集計用
+from SerialLink import (                          # フレームの定義（RobotManager.ino と同じ）
+    SerialFrameDecoder, encode_serial_frame, ArduinoLink, SERIAL_BAUD, NO_DEPTH,
+    CMD_DEPTH, CMD_TRIGGER, CMD_RESET, CMD_CONDITION, REPLY_ACK, REPLY_TEXT, REPLY_STATE,
+    STATUS_OK, STATUS_BUSY, STATUS_UNKNOWN,
+)
+
+class ArduinoEmulator:
+    """
+    疑似端末のマスター側でRobotManager.inoの動作を再現する。スレーブ側のパス（self.port_name）をシリアルポートとして開いて使う。
+    """
+    def __init__(self, motion_step=3.0, verbose=True):
+        import tty                                # Windowsには無いため、ここで読み込む
+        self.master, slave = os.openpty()
+        tty.setraw(slave)                         # 改行変換などを行わずにバイト列をそのまま通す
+        self.port_name = os.ttyname(slave)
+        self.slave = slave                        # 閉じるとマスター側が読めなくなるため開いたままにする
+        self.motion_step = motion_step
+        self.verbose = verbose
+        self.motion_index = 0                     # 動作の段階（0: 停止中）
+        self.motion_deadline = 0.0
+        self.last_depth = None
+        self.positions = {1: 1000, 2: 1000}       # モーターIDごとの目標位置
+        self.counts = {"frames": 0, "depth": 0, "trigger": 0, "busy": 0, "unknown": 0}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self._send(REPLY_TEXT, 0, b"Dynamixel Ready")
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1.0)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _send(self, frame_type, seq, payload=b""):
+        os.write(self.master, encode_serial_frame(frame_type, seq, payload))
+
+    def _log(self, text):
+        if self.verbose:
+            print(f"[Emulator] {text}")
+
+    def _set_position(self, motor_id, position):
+        self.positions[motor_id] = position
+        self._log(f"ID{motor_id} → {position}")
+
+    def _run(self):
+        import select                             # Windowsのselectはソケット専用のため、ここで読み込む
+        decoder = SerialFrameDecoder()
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.01)
+            if readable:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    break                         # 接続側が閉じた
+                for frame_type, seq, payload in decoder.feed(data):
+                    self._handle_frame(frame_type, seq, payload)
+            self._update_motion()
+
+    def _handle_frame(self, frame_type, seq, payload):  # RobotManager.ino の handleFrame と同じ処理
+        self.counts["frames"] += 1
+        status = STATUS_OK
+        if frame_type == CMD_DEPTH and len(payload) >= 2:
+            value = struct.unpack("<H", payload[:2])[0]
+            self.last_depth = None if value == NO_DEPTH else value
+            self.counts["depth"] += 1
+        elif frame_type == CMD_TRIGGER:
+            if self.motion_index == 0:
+                self.counts["trigger"] += 1
+                self._start_motion()
+            else:
+                status = STATUS_BUSY
+                self.counts["busy"] += 1
+        elif frame_type == CMD_RESET:
+            self._set_position(1, 1000)
+            self._set_position(2, 1000)
+            if self.motion_index != 0:
+                self.motion_index = 0
+                self._send(REPLY_STATE, 0, b"\x00")
+        elif frame_type == CMD_CONDITION and payload[:1] in (b"\x01", b"\x02"):
+            self._set_position(payload[0], 1100)
+        else:
+            status = STATUS_UNKNOWN
+            self.counts["unknown"] += 1
+        self._send(REPLY_ACK, seq, bytes([frame_type, status]))
+
+    def _start_motion(self):
+        self.motion_index = 1
+        self._set_position(1, 1200)
+        self.motion_deadline = time.monotonic() + self.motion_step
+        self._send(REPLY_STATE, 0, b"\x01")
+
+    def _update_motion(self):
+        if self.motion_index == 0 or time.monotonic() < self.motion_deadline:
+            return
+        if self.motion_index == 1:
+            self._set_position(1, 800)
+        elif self.motion_index == 2:
+            self._set_position(1, 1000)
+        else:
+            self.motion_index = 0
+            self._send(REPLY_TEXT, 0, b"motion done")
+            self._send(REPLY_STATE, 0, b"\x00")
+            return
+        self.motion_index += 1
+        self.motion_deadline = time.monotonic() + self.motion_step
+
+def run_link_benchmark(duration, rate):
+    """
+    エミュレータに ArduinoLink をつなぎ、rate [Hz] で深度値を duration 秒送り続ける。
+    深度値は手の接近・離脱を繰り返すように変化させ、動作開始の回数も確認する。
+    """
+    import serial                                 # pyserial（BehaviorManagerと同じ開き方をする）
+    from LatencyTrace import LatencyStats, now
+    emulator = ArduinoEmulator(motion_step=0.2, verbose=False)
+    emulator.start()
+    port = serial.Serial(emulator.port_name, SERIAL_BAUD, timeout=0.5)
+    stats = LatencyStats()
+    link = ArduinoLink(port, latency_stats=stats, on_text=lambda text: None)
+    link.start()
+    interval = 1.0 / rate if rate > 0 else 0.0
+    frame_idx = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        frame_idx += 1
+        depth = 400 + 300 * np.sin(frame_idx * 0.01)    # 100〜700mmを往復する
+        t = now()
+        link.update_depth(depth, {"id": frame_idx, "cap": t, "bm": t})
+        if interval:
+            time.sleep(interval)
+    time.sleep(0.2)                                # 最後のACKを待つ
+    link.close()
+    port.close()
+    emulator.stop()
+    stats.flush_pending()
+    wall = time.perf_counter() - start
+    summary = stats.summary()
+    print(f"[ベンチマーク] {frame_idx} 件の深度値 / {wall:.2f} 秒")
+    print(f"  送信 {link.stats['depth_sent']} 件（{link.stats['depth_sent'] / wall:.0f} 件/秒）, "
+          f"上書きで破棄 {link.stats['depth_coalesced']} 件, {link.stats['bytes_sent'] / wall / 1000:.1f} kB/秒")
+    print(f"  ACK {link.stats['acks']} 件, 動作開始 {link.stats['triggers']} 回（エミュレータ側 {emulator.counts['trigger']} 回, "
+          f"動作中で無視 {emulator.counts['busy']} 回）, 受信エラー {link.stats['decode_errors']} 件")
+    if "arduino_reply" in summary:
+        st = summary["arduino_reply"]
+        print(f"  ACK遅延: p50 {st['p50_ms']:.2f} ms, p99 {st['p99_ms']:.2f} ms, 最大 {st['max_ms']:.2f} ms")
+    return {"link": link.stats, "emulator": emulator.counts, "latency": summary}
+
+def main():
+    parser = argparse.ArgumentParser(description="RobotManager.ino のシリアル通信エミュレータ")
+    parser.add_argument("--motion-step", type=float, default=3.0, help="動作の各段階の時間（秒）")
+    parser.add_argument("--bench", type=float, metavar="SECONDS", help="ArduinoLinkから深度値を送り続けて計測する")
+    parser.add_argument("--rate", type=float, default=0, help="--bench での深度値の送信頻度 [Hz]（0で最大速度）")
+    args = parser.parse_args()
+
+    if args.bench:
+        run_link_benchmark(args.bench, args.rate)
+        return
+    emulator = ArduinoEmulator(args.motion_step)
+    emulator.start()
+    print(f"[Emulator] ポート: {emulator.port_name}")
+    print(f"[Emulator] python BehaviorManager.py --arduino-port {emulator.port_name}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        print(f"[Emulator] 受信統計: {emulator.counts}")
+
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,203 @@
 # BehaviorManager.py
 
-import socket                                      # ソケット通信ライブラリ
+import argparse                                    # コマンドライン引数の解析用
 import threading                                   # スレッド処理ライブラリ
 import serial.tools.list_ports                    # シリアルポート探索用ライブラリ
 import serial                                     # シリアル通信ライブラリ
 import time                                       # 時間操作用標準ライブラリ
+import os                                         # OS操作用ライブラリ
+import glob                                       # ファイルパスの検索用ライブラリ
+import re                                         # 正規表現操作用ライブラリ
+from BlackBoardProtocol import (                  # BlackBoard通信フレームの定義
+    connect_blackboard, send_frame, send_hello, iter_frames, MSG_EXIT, MSG_ACK, MSG_ERROR, MSG_SHM_OFFER, MSG_SHM_ACCEPT,
+)
+from SharedLatestValue import LatestValueReader   # 同一PC内の共有メモリ最新値スロット
+import LatencyTrace                               # カメラからサーボ指令までの遅延トレース
+from SerialLink import ArduinoLink, SERIAL_BAUD, CMD_RESET, CMD_CONDITION  # Arduinoとのバイナリ通信
 
 # --- BlackBoard通信設定 ---
 HOST = 'localhost'                                # BlackBoardサーバのホスト名
 PORT = 9000                                       # BlackBoardサーバのポート番号
 CLIENT_NAME = 'BM'                                # このクライアントの名前（Behavior Manager）
 s = None                                          # ソケット接続オブジェクト
-arduino = None                                    # Arduino接続オブジェクト
+arduino = None                                    # Arduino接続オブジェクト（シリアルポート）
+arduino_link = None                               # Arduinoとの送受信（最新の深度値だけを送る送信スレッドと受信スレッド）
+DEPTH_TRIGGER = 500                               # この深度[mm]を下回ったらArduinoに動作開始を送る
+DEPTH_HYSTERESIS = 50                             # DEPTH_TRIGGER + この値を上回るまで次の動作開始を送らない
 running = True                                    # プロセス稼働フラグ
+exit_event = threading.Event()                    # EXIT受信でメインループをすぐに抜けるためのイベント
+USE_SHARED_MEMORY = True                          # VisionManagerが提供する共有メモリスロットから深度を読むか（FalseならTCP経由のみ）
+shm_reader = None                                 # 共有メモリ最新値スロットの読み出しオブジェクト
+latency_stats = LatencyTrace.LatencyStats()       # 遅延トレースの集計（終了時にLog/LatencyLogへ出力）
 
 # --- Arduino接続処理 ---
-def connect_to_arduino():                         # Arduinoへ接続する関数
-    global arduino
+def connect_to_arduino(port_name=None):           # Arduinoへ接続する関数（port_nameを指定した場合はそのポートに接続）
+    global arduino, arduino_link
     target_vid_pid_list = ["2341:0069"]           # 接続対象ArduinoのVID:PID（Uno R4 Minima用）
-    ports = list(serial.tools.list_ports.comports())  # 利用可能なシリアルポート一覧取得
-    for port in ports:
-        print(f"[DEBUG] 発見: {port.device} - {port.hwid}")  # 検出したポート情報を表示
-        for vid_pid in target_vid_pid_list:
-            if f"VID:PID={vid_pid}" in port.hwid:  # VID:PID一致を確認
-                try:
-                    arduino = serial.Serial(port.device, 9600, timeout=0.5)  # Arduinoへシリアル接続
-                    print(f"[Arduino] 接続成功: {port.device} ({port.description})")
-                    start_arduino_receive_thread()  # Arduino受信用スレッド開始
-                    return
-                except Exception as e:
-                    print(f"[Arduino] 接続失敗: {port.device}, {e}")
+    candidates = [port_name] if port_name else []
+    if not port_name:
+        ports = list(serial.tools.list_ports.comports())  # 利用可能なシリアルポート一覧取得
+        for port in ports:
+            print(f"[DEBUG] 発見: {port.device} - {port.hwid}")  # 検出したポート情報を表示
+            if any(f"VID:PID={vid_pid}" in port.hwid for vid_pid in target_vid_pid_list):  # VID:PID一致を確認
+                candidates.append(port.device)
+    for device in candidates:
+        try:
+            arduino = serial.Serial(device, SERIAL_BAUD, timeout=0.5)  # Arduinoへシリアル接続
+            print(f"[Arduino] 接続成功: {device}（{SERIAL_BAUD}bps）")
+            arduino_link = ArduinoLink(arduino, DEPTH_TRIGGER, DEPTH_HYSTERESIS, latency_stats=latency_stats)
+            arduino_link.start()                  # 送信・受信スレッド開始
+            return
+        except Exception as e:
+            print(f"[Arduino] 接続失敗: {device}, {e}")
     print("[Arduino] 対象のVID:PIDデバイスが見つかりませんでした")  # 指定デバイスが見つからない場合
 
-# --- Arduinoからのメッセージ受信処理 ---
-def start_arduino_receive_thread():
-    def read_from_arduino():
-        global arduino
-        while True:
-            if arduino and arduino.is_open:         # Arduino接続中確認
-                try:
-                    line = arduino.readline().decode(errors='ignore').strip()  # メッセージ受信
-                    if line:
-                        print(f"[Arduino→BM] {line}")  # Arduinoからのメッセージを表示
-                except Exception as e:
-                    print(f"[Arduino受信エラー] {e}")  # 読み取りエラー表示
-                    time.sleep(1)
-            else:
-                print("[Arduino] ポートが閉じられました")  # Arduino切断検知
-                break
-    t = threading.Thread(target=read_from_arduino, daemon=True)  # Arduino受信用スレッド作成
-    t.start()                                        # スレッド開始
+# --- Arduinoへのコマンド送信処理 ---
+def forward_depth(depth_mm, trace=None):          # 最新の深度値をArduinoとの通信に渡す（送信・閾値判定は送信スレッドで行う）
+    if arduino_link:
+        arduino_link.update_depth(depth_mm, trace)
+    elif trace is not None:
+        latency_stats.record(trace)                # 送信できなかった場合もBMまでの遅延は集計する
+
+def send_to_arduino(content, trace=None):
+    """
+    BlackBoard経由の文字列コマンドをArduinoへのバイナリコマンドに変換して送る。
+      "Depth:412.0"     → 最新の深度値（古い値は送らずに捨てる）
+      "reset"           → CMD_RESET
+      "ID:..Cond:1/2"   → CMD_CONDITION
+    """
+    if content.startswith("Depth:"):
+        try:
+            forward_depth(float(content[6:]), trace)
+        except ValueError:
+            print(f"[BM] 深度値を解釈できません: {content}")
+        return
+    if not arduino_link:
+        print("[Arduino] 未接続のため送信できません")  # Arduino未接続時
+        return
+    if content == "reset":
+        arduino_link.send_command(CMD_RESET)
+    elif content.startswith("ID:") and "Cond:" in content:
+        condition = content.split("Cond:", 1)[1][:1]
+        if condition in ("1", "2"):
+            arduino_link.send_command(CMD_CONDITION, bytes([int(condition)]))
+        else:
+            print(f"[BM] 未知の条件です: {content}")
+            return
+    else:
+        print(f"[BM] 未知のコマンドです: {content}")
+        return
+    print(f"[Arduinoへ送信] {content}")
+
+# --- 遅延トレースの集計結果の出力 ---
+def dump_latency_stats():
+    """
+    遅延トレースの区間ごとのp50/p99を表示し、BlackBoardログと同じ番号で Log/LatencyLog に保存する。
+    """
+    latency_stats.flush_pending()                 # Arduinoの応答が来なかったトレースも集計に含める
+    lines = latency_stats.summary_lines()
+    if not lines:
+        return
+    for line in lines:
+        print(f"[遅延] {line}")
+    latency_log_dir = "Log/LatencyLog"            # 遅延ログ保存ディレクトリ
+    os.makedirs(latency_log_dir, exist_ok=True)
+    log_index = 0                                 # BlackBoardログの最大番号に合わせる
+    for log_file in glob.glob(os.path.join("Log/BlackBoardLog", "log*_blackBoard.log")):
+        match = re.match(r".*log(\d+)_blackBoard\.log$", log_file)
+        if match:
+            log_index = max(log_index, int(match.group(1)))
+    path = os.path.join(latency_log_dir, f"log{log_index}_latency.json")
+    try:
+        latency_stats.dump(path)
+        print(f"[遅延] 集計結果を保存しました: {path}")
+    except Exception as e:
+        print(f"[遅延] 集計結果の保存に失敗しました: {e}")
+
+# --- 共有メモリ最新値スロットの読み出し処理 ---
+def start_shm_reader(publisher, topic, segment):  # 提供された共有メモリスロットにattachし、読み出しスレッドを開始する
+    global shm_reader
+    stop_shm_reader()                             # 以前のスロットは破棄
+    try:
+        reader = LatestValueReader(segment)
+    except Exception as e:
+        print(f"[共有メモリ] {segment} へのattachに失敗しました。TCP経由で受信します: {e}")
+        return
+    shm_reader = reader
+    send_frame(s, MSG_SHM_ACCEPT, publisher, f"{topic};1")  # 提供元に利用開始を通知（以降DepthはTCPで送られてこない）
+    print(f"[共有メモリ] {publisher} の {topic} を共有メモリ {segment} から読み出します")
+
+    def read_latest_values():
+        hand_present = False                      # 前回の値で手が検出されていたか
+        while running and shm_reader is reader:
+            value = reader.wait_for_update(timeout=0.1)  # 新しい値が書き込まれるまで待つ
+            if value is None:
+                continue                          # 更新なし
+            if value["min_depth"] is None:
+                if hand_present:                  # 手が無くなったことを1回だけ伝える
+                    forward_depth(None)
+                hand_present = False
+                continue
+            hand_present = True
+            trace = value["trace"] or None        # 遅延トレース（VisionManagerで無効なら空）
+            if trace is not None:
+                trace.update(id=value["frame_index"], bm=LatencyTrace.now())
+            forward_depth(value["min_depth"], trace)  # 最新の深度値をArduinoとの通信に渡す
+        reader.close()                            # attachを解除
+    t = threading.Thread(target=read_latest_values, daemon=True)
+    t.start()
+
+def stop_shm_reader():                            # 読み出しスレッドを止める（次のポーリングで終了しattachを解除する）
+    global shm_reader
+    shm_reader = None
 
 # --- BlackBoardからのメッセージ受信処理 ---
 def receive_from_blackboard():
     global s, arduino, running
-    while True:
-        try:
-            msg = s.recv(1024).decode().strip()    # BlackBoardからメッセージを受信しデコード
-            if msg:
-                print(f"[BlackBoard→{CLIENT_NAME}] {msg}")  # 受信内容を表示
-
-                if msg == "EXIT":                 # EXITを受信した場合
-                    print("[BM] EXITコマンドを受信しました。ACKを返して終了します。")
-                    try:
-                        s.sendall(b"ACK;EXIT_RECEIVED")  # BlackBoardにACK送信
-                        print("[ACK送信] EXIT受領確認を送信しました。")
-                    except Exception as e:
-                        print(f"[ACK送信失敗] {e}")
-                    running = False               # メインループを終了する
-                    break                         # 受信用スレッド終了
-                else:
-                    content = msg                # その他のコマンド内容を取得
-                    print(f"[BM] コマンド抽出: {content}")
-                    if arduino and arduino.is_open:  # Arduino接続確認
-                        try:
-                            arduino.write((content + '\n').encode())  # Arduinoにコマンド送信
-                            print(f"[Arduinoへ送信] {content}")
-                        except Exception as e:
-                            print(f"[Arduino送信エラー] {e}")
-                    else:
-                        print("[Arduino] 未接続のため送信できません")  # Arduino未接続時
-        except Exception as e:
-            print(f"[BM] 受信処理エラー: {e}")    # BlackBoard受信処理中の例外を表示
-            break
+    try:
+        for msg_type, sender, content in iter_frames(s):  # フレーム単位で受信（1回の受信に複数あっても分割される）
+            print(f"[BlackBoard→{CLIENT_NAME}] {sender}: {content}")  # 受信内容を表示
+
+            if msg_type == MSG_EXIT:              # EXITを受信した場合
+                print("[BM] EXITコマンドを受信しました。ACKを返して終了します。")
+                try:
+                    send_frame(s, MSG_ACK, "", "EXIT_RECEIVED")  # BlackBoardにACK送信
+                    print("[ACK送信] EXIT受領確認を送信しました。")
+                except Exception as e:
+                    print(f"[ACK送信失敗] {e}")
+                running = False                   # メインループを終了する
+                exit_event.set()
+                break                             # 受信用スレッド終了
+            elif msg_type == MSG_ERROR:           # BlackBoardからのエラー通知は表示のみ
+                continue
+            elif msg_type == MSG_SHM_OFFER:       # 共有メモリスロットの提供・取り下げ
+                topic, _, segment = content.partition(";")
+                if not segment:
+                    print(f"[共有メモリ] {sender} の {topic} が取り下げられました")
+                    stop_shm_reader()
+                elif USE_SHARED_MEMORY:
+                    start_shm_reader(sender, topic, segment)
+            else:
+                content, trace = LatencyTrace.split_trace(content)  # 遅延トレースが付いていれば分離する
+                if trace is not None:
+                    trace["bm"] = LatencyTrace.now()
+                print(f"[BM] コマンド抽出: {content}")
+                send_to_arduino(content, trace)
+    except Exception as e:
+        print(f"[BM] 受信処理エラー: {e}")        # BlackBoard受信処理中の例外を表示
 
 # --- BlackBoardへの接続処理 ---
 def connect_to_blackboard():                      # BlackBoardへ接続する関数
     global s
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCPソケット生成
     try:
-        s.connect((HOST, PORT))                            # BlackBoardに接続を試みる
+        s = connect_blackboard(HOST, PORT)                 # BlackBoardに接続を試みる（起動中なら待って再試行）
     except Exception as e:                                 # 接続に失敗した場合
         print(f"[接続エラー] BlackBoardへの接続に失敗しました: {e}")  # エラーメッセージを表示
         print("[接続エラー] 5秒後に終了します。")                       # 終了前に待機することを案内
         time.sleep(5)                                      # 手動確認できるよう5秒間待機
         exit(1)                                            # エラーコード1で終了
 
-    local_ip, local_port = s.getsockname()                # 自分側のIP・ポート取得
-    init_msg = f"{CLIENT_NAME};{local_ip}:{local_port}"   # 初期メッセージ作成
-    s.sendall(init_msg.encode())                          # 初期メッセージをBlackBoardに送信
+    local_ip, local_port = send_hello(s, CLIENT_NAME)     # 初期メッセージ（HELLO）をBlackBoardに送信
 
     print(f"[接続] BlackBoardに '{CLIENT_NAME}'（{local_ip}:{local_port}）として接続済み")  # 接続完了メッセージを表示
 
@@ -107,15 +206,23 @@ def connect_to_blackboard():                      # BlackBoardへ接続する関
 
 # --- メイン処理 ---
 def main():
+    parser = argparse.ArgumentParser(description="BehaviorManager")
+    parser.add_argument("--arduino-port", help="VID:PIDで探さずに接続するシリアルポート（ArduinoEmulator.py のpty等）")
+    args = parser.parse_args()
     connect_to_blackboard()                              # BlackBoard接続
-    connect_to_arduino()                                # Arduino接続
+    connect_to_arduino(args.arduino_port)               # Arduino接続
     print("[BM] 起動中。BlackBoardからのメッセージを待機しています...")
     try:
         while running:                                  # メインループ
-            time.sleep(1)                               # スリープでCPU負荷軽減
+            exit_event.wait(1.0)                        # EXITを受け取るまで待機（Ctrl+Cを受け付けるため1秒ごとに戻る）
     except KeyboardInterrupt:
         print("[BM] 終了要求を受け取りました。")         # Ctrl+Cなどで終了要求検知
     finally:
+        stop_shm_reader()                              # 共有メモリ読み出しを停止
+        dump_latency_stats()                           # 遅延トレースの集計結果を出力
+        if arduino_link:
+            arduino_link.close()                       # 送信待ちのコマンドを送り終えてから送受信スレッドを止める
+            print(f"[BM] Arduino送信統計: {arduino_link.stats}")
         if arduino:
             arduino.close()                            # Arduino接続を閉じる
             print("[BM] Arduinoとの接続を閉じました。")
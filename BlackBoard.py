@@ -1,32 +1,86 @@
 # BlackBoard.py
 
+import argparse                                 # コマンドライン引数の解析用
 import socket                                   # ソケット通信を行うための標準ライブラリ
+import selectors                                # 単一スレッドで複数ソケットを監視するイベントループ用
 import threading                                # スレッド処理用標準ライブラリ
-import msvcrt                                   # WindowsでESCキー検出用
+try:
+    import msvcrt                               # WindowsでESCキー検出用
+except ImportError:                             # Linux等ではESC監視を行わない（Ctrl+C または CMD;shutdown で終了）
+    msvcrt = None
+from BlackBoardProtocol import (                # 長さプレフィックス付きフレームの定義
+    FrameDecoder, ProtocolError, encode_frame, RECV_BUFFER_SIZE,
+    MSG_HELLO, MSG_ROUTE, MSG_EXIT, MSG_ACK, MSG_ERROR, MSG_SHM_OFFER, MSG_SHM_ACCEPT, MSG_PING, MSG_PONG,
+    MSG_TYPE_NAMES,
+)
 
 ###### ログ記録設定 #########
 
 import logging                                  # ログ出力用モジュール
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler  # 非同期のログ書き出しとサイズでの分割用
+import queue                                   # ログのキュー用
 import os                                      # OS操作用
 import glob                                    # ファイル検索用
 import re                                      # 正規表現
 import json                                    # 設定ファイル読み込み用
 import time                                    # 待機処理用
+from collections import deque                  # クライアントごとの送信キュー用
+from LatencyTrace import TRACE_MARKER, add_hop  # 遅延トレースへの転送時刻の書き足し用
+from TrafficCapture import TrafficRecorder     # 転送メッセージのバイナリ記録用（TrafficReplay.py で再生する）
 
 # --- ログ記録用関数 ---
+LOG_FORMAT = '%(asctime)s.%(msecs)03d [%(levelname)s] %(message)s'  # ミリ秒まで記録する（転送の間隔を追えるように）
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+log_listener = None                                    # キューからコンソール・ファイルへ書き出すスレッド（QueueListener）
+traffic_recorder = None                                # 転送メッセージのキャプチャ（save_blackboard_traffic が true の場合）
+
+class TopicRateFilter(logging.Filter):
+    """
+    高頻度トピック（extra={"topic": ...} を付けたログ）のコンソール出力を、トピックごとに interval 秒に1行へ間引く。
+    間引いた件数は次に出力する行の末尾に付ける（skipped_note）。トピックの無いログはそのまま通す。
+    """
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.last = {}                                 # トピック → 最後に出力した時刻
+        self.skipped = {}                              # トピック → 前回の出力から間引いた件数
+
+    def filter(self, record):
+        record.skipped_note = ""
+        topic = getattr(record, "topic", None)
+        if topic is None or self.interval <= 0:
+            return True
+        if record.created - self.last.get(topic, float("-inf")) < self.interval:
+            self.skipped[topic] = self.skipped.get(topic, 0) + 1
+            return False
+        self.last[topic] = record.created
+        skipped = self.skipped.pop(topic, 0)
+        if skipped:
+            record.skipped_note = f"（{topic} 他 {skipped} 件省略）"
+        return True
+
 def initialize_blackboard_logging():
     """
     logging_config.json の設定に基づき、BlackBoard用ログをLog/BlackBoardLogに保存する。
     保存しない設定なら、標準出力のみのロガーを構成する。
+    ログはキュー（QueueHandler）に積むだけにし、コンソール・ファイルへの書き出しは別スレッド（QueueListener）で行う。
+    転送処理がコンソールやディスクの書き込み速度に左右されないようにするため。
     """
+    global log_listener, traffic_recorder
     try:
         with open("logging_config.json", "r", encoding="utf-8") as f:  # 設定ファイルを開く
             config_data = json.load(f)                                 # JSONデータを辞書として読み込み
         save_blackboard_logs = config_data.get("save_blackboard_logs", False)  # ログ保存ON/OFFを取得（デフォルトFalse）
-        print(f"[設定] save_blackboard_logs={save_blackboard_logs}")  # 設定内容をコンソールに出力
+        save_blackboard_traffic = config_data.get("save_blackboard_traffic", False)  # 転送メッセージのキャプチャON/OFF（デフォルトFalse）
+        print(f"[設定] save_blackboard_logs={save_blackboard_logs}, save_blackboard_traffic={save_blackboard_traffic}")  # 設定内容をコンソールに出力
     except Exception as e:                                            # 設定ファイル読み込み失敗時
         print(f"[設定エラー] logging_config.json の読み込みに失敗しました: {e}")  # エラーメッセージを出力
+        config_data = {}
         save_blackboard_logs = False                                  # ログ保存はOFFに設定
+        save_blackboard_traffic = False
+    max_bytes = int(config_data.get("blackboard_log_max_mb", 10) * 1024 * 1024)  # 1ファイルの最大サイズ（超えたら .1, .2, ... に回す）
+    backup_count = config_data.get("blackboard_log_backup_count", 5)  # 残す古いファイルの数
+    console_interval = config_data.get("blackboard_console_interval", 1.0)  # 高頻度トピックをコンソールに出す間隔（秒, 0で間引かない）
 
     log_dir = os.path.join("Log", "BlackBoardLog")        # ログ保存ディレクトリを作成
     os.makedirs(log_dir, exist_ok=True)                  # ディレクトリが無ければ作成する
@@ -36,164 +90,490 @@ def initialize_blackboard_logging():
 
     if logger.hasHandlers():                            # 既にハンドラがある場合
         logger.handlers.clear()                        # 古いハンドラを削除
+    stop_blackboard_logging()                           # 再初期化の場合は前の書き出しスレッドを止める
 
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', '%Y-%m-%d %H:%M:%S')  # フォーマット作成
-
+    handlers = []
     console_handler = logging.StreamHandler()           # コンソール用ハンドラ作成
     console_handler.setLevel(logging.INFO)              # INFOレベルに設定
-    console_handler.setFormatter(formatter)             # フォーマット適用
-    logger.addHandler(console_handler)                  # ハンドラ追加
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT + '%(skipped_note)s', LOG_DATE_FORMAT))  # 間引いた件数を末尾に付ける
+    console_handler.addFilter(TopicRateFilter(console_interval))  # 高頻度トピックはコンソールに毎回出さない
+    handlers.append(console_handler)
+
+    existing_logs = glob.glob(os.path.join(log_dir, "log*_*"))  # 既存ログファイル・キャプチャを探索
+    max_index = 0                                       # ログ番号最大値を初期化
+    for log_file in existing_logs:                      # 既存ログを走査
+        match = re.match(r".*log(\d+)_(blackBoard\.log|traffic\.bbcap)$", log_file)  # ログ番号抽出
+        if match:
+            idx = int(match.group(1))                   # 抽出番号をint変換
+            if idx > max_index: max_index = idx         # 最大値更新
+    next_index = max_index + 1                          # 次に使うログ番号決定（テキストログとキャプチャで共通）
 
     if save_blackboard_logs:                            # ログ保存がONの場合
-        existing_logs = glob.glob(os.path.join(log_dir, "log*_blackBoard.log"))  # 既存ログファイルを探索
-        max_index = 0                                   # ログ番号最大値を初期化
-        for log_file in existing_logs:                  # 既存ログを走査
-            match = re.match(r".*log(\d+)_blackBoard\.log$", log_file)  # ログ番号抽出
-            if match:
-                idx = int(match.group(1))               # 抽出番号をint変換
-                if idx > max_index: max_index = idx     # 最大値更新
-
-        next_index = max_index + 1                     # 次に使うログ番号決定
         log_filename = os.path.join(log_dir, f"log{next_index}_blackBoard.log")  # ログファイル名作成
         print(f"[ログ初期化] ログファイル: {log_filename}")                     # ログファイル名を表示
 
-        file_handler = logging.FileHandler(log_filename, encoding="utf-8")  # ファイル用ハンドラ作成
+        file_handler = RotatingFileHandler(log_filename, maxBytes=max_bytes, backupCount=backup_count,
+                                           encoding="utf-8")  # サイズで分割するファイル用ハンドラ作成（すべての転送を記録）
         file_handler.setLevel(logging.INFO)              # INFOレベル設定
-        file_handler.setFormatter(formatter)             # フォーマット適用
-        logger.addHandler(file_handler)                  # ハンドラ追加
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))  # フォーマット適用
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()                     # 転送処理のスレッドはここに積むだけ
+    logger.addHandler(QueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+    if save_blackboard_traffic:                         # 転送メッセージをバイナリで記録する
+        capture_filename = os.path.join(log_dir, f"log{next_index}_traffic.bbcap")
+        traffic_recorder = TrafficRecorder(capture_filename)
+        print(f"[ログ初期化] キャプチャ: {capture_filename}")
+
+def stop_blackboard_logging():                          # キャプチャを閉じ、キューに残ったログを書き出して書き出しスレッドを止める
+    global log_listener, traffic_recorder
+    if traffic_recorder:
+        traffic_recorder.close()
+        logging.info(f"[キャプチャ] {traffic_recorder.recorded} 件を記録しました（破棄 {traffic_recorder.dropped} 件）: {traffic_recorder.path}")
+        traffic_recorder = None
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
 
 ###### BlackBoard処理内容 #########
 
-clients = {}                                            # 接続中クライアントを格納する辞書
+# すべてのソケットは start_server() のイベントループ（単一スレッド）だけが操作する。
+# ESC監視スレッドなど他スレッドからは stop_server() で起床要求を送るのみとし、clients には触れない。
+
+clients = {}                                            # 接続中クライアント（名前 → 接続状態辞書）
+connections = {}                                        # ハンドシェイク前を含む全接続（ソケット → 接続状態辞書）
 server_running = True                                   # サーバ実行フラグ
 exit_acks_received = set()                             # EXIT受領ACKを受け取ったクライアント名の集合
+shm_offers = {}                                        # 共有メモリスロットの提供情報（受け手名 → {(提供元名, トピック): セグメント名}）
+client_watchers = set()                                # 接続・切断の通知を受け取るクライアント名（Supervisor.py の起動完了判定用）
+exit_wait = None                                       # EXIT送信後のACK待ち状態（None なら待機していない）
+EXIT_ACK_TIMEOUT = 5.0                                 # ACK待機の最大時間（秒）
+HEARTBEAT_INTERVAL = 1.0                               # 生存確認（PING）を送る間隔（秒）
+HEARTBEAT_TIMEOUT = 4.0                                # この秒数何も受信しなかった接続は応答が無いとみなして切断する
+next_heartbeat = 0.0                                   # 次に生存確認を行う時刻（time.monotonic）
+heartbeat_evictions = []                               # 応答が無く切断した接続（(名前, 最後の受信からの秒数)）
+OUTBOUND_QUEUE_LIMIT = 256                             # クライアントごとのデータレーン送信キューの最大フレーム数
+WRITE_CHUNK_SIZE = 16384                               # 送信キューからソケット送信バッファへ一度に移す最大バイト数
+LANE_CONTROL = "control"                               # 制御レーン（EXIT, ACK, CMD, reset等。破棄せず常に先に送る）
+LANE_DATA = "data"                                     # データレーン（高頻度センサ値。満杯時は古いものから破棄）
+DATA_TOPICS = {"Depth"}                                # データレーンで扱うトピック
+CONFLATING_TOPICS = {"Depth"}                          # 最新値だけ届ければよいトピック（未送信の古い値は新しい値で置き換える）
+
+selector = None                                        # イベントループで使用するセレクタ
+wakeup_sender = None                                   # 他スレッドからイベントループを起こすためのソケット
+
+def stop_server():                                     # 他スレッドから安全にサーバ停止を要求する関数
+    global server_running
+    server_running = False
+    if wakeup_sender:
+        try:
+            wakeup_sender.send(b"\0")                  # select() 待機中のイベントループを即座に起こす
+        except OSError:
+            pass
+
+def update_selector_events(state):                     # 送信待ちデータの有無に応じて監視イベントを切り替える
+    events = selectors.EVENT_READ
+    if state["outbuf"] or state["lanes"][LANE_CONTROL] or state["lanes"][LANE_DATA]:
+        events |= selectors.EVENT_WRITE                # 未送信データがあれば書き込み可能も監視
+    if state["events"] != events:
+        selector.modify(state["conn"], events, data=state)
+        state["events"] = events
+
+def message_topic(content):                            # "Depth:412.0" のような内容からトピック名を取り出す
+    topic, sep, _ = content.partition(":")
+    return topic if sep else None
+
+def classify_lane(msg_type, content):                  # フレームを制御レーンとデータレーンに振り分ける
+    if msg_type == MSG_ROUTE and message_topic(content) in DATA_TOPICS:
+        return LANE_DATA                               # 高頻度のセンサ値
+    return LANE_CONTROL                                # EXIT・ACK・エラー・reset/ID等のコマンドは常に優先
+
+def fill_outbuf(state):                                # 送信キューからソケット送信バッファへフレームを移す（制御レーン優先）
+    control = state["lanes"][LANE_CONTROL]
+    data_lane = state["lanes"][LANE_DATA]
+    outbuf = state["outbuf"]
+    while len(outbuf) < WRITE_CHUNK_SIZE:              # 送信バッファを小さく保ち、キュー内で最新値への置き換えと制御の追い越しが効くようにする
+        if control:
+            key, data = control.popleft()
+        elif data_lane:
+            key, data = data_lane.popleft()
+        else:
+            break
+        if key is not None:                            # 最新値スロットの場合は、取り出す時点の最新値を送る
+            data = state["latest"].pop(key)
+        outbuf += data
+        state["stats"]["sent"] += 1
+
+def flush_client(state):                               # 送信キューと送信バッファをノンブロッキングで可能な限り送信する
+    fill_outbuf(state)
+    try:
+        while state["outbuf"]:
+            sent = state["conn"].send(state["outbuf"]) # 送れる分だけ送信
+            del state["outbuf"][:sent]                 # 送信済み分をバッファから削除
+            fill_outbuf(state)
+    except (BlockingIOError, InterruptedError):
+        pass                                           # 送信バッファが一杯なら次の書き込み可能イベントで再送
+    except OSError as e:
+        logging.error(f"[エラー] {state['name'] or state['addr']} への送信に失敗: {e}")
+        close_client(state)
+        return
+    update_selector_events(state)
+
+def queue_send(state, data, lane=LANE_CONTROL, conflate_key=None):  # 宛先の送信キューに追加して送信を試みる
+    if state["closed"]:
+        return
+    stats = state["stats"]
+    stats["queued"] += 1
+    lane_queue = state["lanes"][lane]
+    if conflate_key is not None and conflate_key in state["latest"]:
+        state["latest"][conflate_key] = data           # 未送信の古い値を最新値で置き換える（キュー長は増えない）
+        stats["conflated"] += 1
+    else:
+        if lane == LANE_DATA and len(lane_queue) >= OUTBOUND_QUEUE_LIMIT:  # データレーンが満杯なら最も古いフレームを捨てる
+            old_key, _ = lane_queue.popleft()          # 制御レーンは破棄しない
+            if old_key is not None:
+                state["latest"].pop(old_key, None)
+            stats["dropped"] += 1
+        if conflate_key is not None:
+            state["latest"][conflate_key] = data
+            lane_queue.append((conflate_key, None))
+        else:
+            lane_queue.append((None, data))
+        stats["max_depth"] = max(stats["max_depth"], len(lane_queue))
+    flush_client(state)                                # すぐに送れる分は送信する
+
+def client_stats():
+    """
+    クライアントごとの送信キュー統計と生存確認の応答時間を返す。
+    "heartbeat_evictions" には、応答が無く切断した接続（名前と、最後の受信から切断までの秒数）を起動時から記録順に入れる。
+    """
+    now = time.monotonic()
+    stats = {
+        name: dict(info["stats"],
+                   control_depth=len(info["lanes"][LANE_CONTROL]),
+                   data_depth=len(info["lanes"][LANE_DATA]),
+                   heartbeat_rtt_ms=round(info["rtt"] * 1000, 3) if info["rtt"] is not None else None,
+                   silent_ms=round((now - info["last_seen"]) * 1000, 1))
+        for name, info in clients.items()
+    }
+    stats["heartbeat_evictions"] = [{"name": str(label), "silent_s": round(silent, 2)} for label, silent in heartbeat_evictions]
+    return stats
+
+def notify_watchers(event, name):                      # 接続・切断を通知先に知らせる（"joined:BM" / "left:BM"）
+    for watcher in client_watchers:
+        state = clients.get(watcher)
+        if state and watcher != name:
+            queue_send(state, encode_frame(MSG_ROUTE, "CMD", f"{event}:{name}"))
+
+def close_client(state):                               # 接続を閉じてクライアント登録を解除する
+    if state["closed"]:
+        return
+    state["closed"] = True
+    conn = state["conn"]
+    try:
+        selector.unregister(conn)                      # イベントループの監視対象から外す
+    except (KeyError, ValueError):
+        pass
+    connections.pop(conn, None)
+    name = state["name"]
+    if name and clients.get(name) is state:
+        logging.info(f"[切断] {state['ip']}:{state['port']} ({name}) の接続を終了 送信統計: {state['stats']}")
+        del clients[name]
+        client_watchers.discard(name)
+        notify_watchers("left", name)
+        if exit_wait is not None:
+            exit_wait["expected"].discard(name)        # 切断済みクライアントのACKは待たない
+        withdraw_shm_offers(name)                      # 提供元が居なくなった共有メモリスロットを取り下げる
+        release_shm_offers(name)                       # 受け手が居なくなったことを提供元に知らせる
+    conn.close()
+
+def withdraw_shm_offers(publisher):                    # 指定クライアントが提供していた共有メモリスロットを取り下げ、受け手に通知する
+    for consumer, offers in shm_offers.items():
+        for (offer_publisher, topic) in [key for key in offers if key[0] == publisher]:
+            del offers[(offer_publisher, topic)]
+            target = clients.get(consumer)
+            if target:
+                queue_send(target, encode_frame(MSG_SHM_OFFER, publisher, f"{topic};"))  # セグメント名が空 = 取り下げ
+            logging.info(f"[共有メモリ] {publisher} → {consumer} の {topic} を取り下げました")
+
+def release_shm_offers(consumer):                     # 受け手の切断を提供元に通知する（提供元はTCP送信に戻る）
+    for (publisher, topic) in shm_offers.get(consumer, {}):
+        target = clients.get(publisher)
+        if target:
+            queue_send(target, encode_frame(MSG_SHM_ACCEPT, consumer, f"{topic};0"))
+
+def handle_shm_frame(state, msg_type, target_name, content):  # 共有メモリスロットの提供・利用開始通知を中継する
+    name = state["name"]
+    if msg_type == MSG_SHM_OFFER:
+        topic, _, segment = content.partition(";")
+        shm_offers.setdefault(target_name, {})[(name, topic)] = segment  # 受け手が後から接続した場合にも渡せるよう保持
+        logging.info(f"[共有メモリ] {name} が {target_name} 向けに {topic} を提供: {segment}")
+    else:
+        logging.info(f"[共有メモリ] {name} が {target_name} の共有メモリスロット利用状態を通知: {content}")
+    target = clients.get(target_name)
+    if target:
+        queue_send(target, encode_frame(msg_type, name, content))  # 送信元名を付けて制御レーンで中継
+
+def reject_client(state, message):                     # エラーメッセージを送って接続を閉じる
+    try:
+        state["conn"].send(encode_frame(MSG_ERROR, "", message))  # 短いメッセージなのでノンブロッキング送信で十分
+    except OSError:
+        pass
+    close_client(state)
 
-def send_exit_to_all_clients():                        # 全クライアントにEXITを送信する関数
+def send_exit_to_all_clients():                        # 全クライアントにEXITを送信し、ACK待ちを開始する関数
+    global exit_wait
     logging.info("[CMD] 全クライアントにEXITを送信中...")
     for client_name, client_info in list(clients.items()):  # 接続中クライアントを走査
-        try:
-            client_info["conn"].sendall(b"EXIT")       # 各クライアントにEXITを送信
-            logging.info(f"[CMD] {client_name} に EXIT を送信しました。")
-        except Exception as e:
-            logging.error(f"[CMD] {client_name} へのEXIT送信に失敗: {e}")
-
-    expected_acks = set(clients.keys())               # 期待するACK送信元クライアント集合
-    timeout = 5.0                                     # ACK待機の最大時間（秒）
-    start_time = time.time()                          # 待機開始時間を取得
-    while time.time() - start_time < timeout:         # タイムアウトまで待機
-        if exit_acks_received >= expected_acks:       # すべてのACKを受領したら終了
-            logging.info("[CMD] 全クライアントからEXIT受領ACKを確認しました。")
-            return
-        time.sleep(0.1)                               # ACKを待機しつつループ
-    missing = expected_acks - exit_acks_received      # 未受領クライアントを計算
-    if missing:
-        logging.warning(f"[CMD] タイムアウト: 以下のクライアントからACKが未受領: {missing}")
-
-def handle_client(conn, addr):                        # クライアント接続を処理する関数
-    global server_running
-    name = None                                       # クライアント名変数
+        queue_send(client_info, encode_frame(MSG_EXIT))  # 各クライアントにEXITを送信（制御レーン）
+        logging.info(f"[CMD] {client_name} に EXIT を送信しました。")
+
+    exit_wait = {                                      # ACKはイベントループ内で受信し続け、check_exit_acks()で完了判定する
+        "expected": set(clients.keys()),               # 期待するACK送信元クライアント集合
+        "deadline": time.monotonic() + EXIT_ACK_TIMEOUT,  # ACK待機の期限
+        "started": time.perf_counter(),                # 終了にかかった時間の計測用
+    }
+    check_exit_acks()
+
+def check_exit_acks():                                 # ACKが揃ったか、またはタイムアウトしたかを判定する
+    global exit_wait
+    if exit_wait is None:
+        return
+    elapsed_ms = (time.perf_counter() - exit_wait["started"]) * 1000
+    if exit_acks_received >= exit_wait["expected"]:    # すべてのACKを受領したら終了
+        logging.info(f"[CMD] 全クライアントからEXIT受領ACKを確認しました（{elapsed_ms:.1f} ms）。")
+    elif time.monotonic() >= exit_wait["deadline"]:    # 期限切れ
+        missing = exit_wait["expected"] - exit_acks_received  # 未受領クライアントを計算
+        logging.warning(f"[CMD] タイムアウト（{elapsed_ms:.1f} ms）: 以下のクライアントからACKが未受領: {missing}")
+    else:
+        return                                         # まだ待機中
+    exit_wait = None
+    stop_server()                                      # すべて完了後にサーバ停止
+
+def handle_handshake(state, msg_type, name, ip_port):  # 初期メッセージ（HELLO: 名前, IP:PORT）を処理する
     try:
-        init_msg = conn.recv(1024).decode().strip()   # 初期メッセージを受信しデコード
-
-        if ";" in init_msg and ":" in init_msg:       # 初期メッセージ形式を確認
-            name_part, ip_port_part = init_msg.split(";", 1)  # 名前・IP:PORTを分割
-            ip, port_str = ip_port_part.split(":", 1)         # IPとPORTを分割
-            name = name_part.strip()                         # クライアント名
-            reported_ip = ip.strip()                         # IP
-            reported_port = int(port_str.strip())            # PORT
+        if msg_type != MSG_HELLO:                        # 最初のフレームは必ずHELLO
+            raise ValueError(MSG_TYPE_NAMES.get(msg_type, msg_type))
+        ip, port_str = ip_port.split(":", 1)             # IPとPORTを分割
+        name = name.strip()                              # クライアント名
+        reported_ip = ip.strip()                         # IP
+        reported_port = int(port_str.strip())            # PORT
+        if not name:
+            raise ValueError("empty name")
+    except ValueError:                                   # 初期メッセージ形式が不正
+        reject_client(state, "[エラー] 初期メッセージ形式が不正です。HELLOフレームで名前とIP:PORTを送信してください。")
+        return
+
+    if name in clients:                                # 名前重複を確認
+        error_msg = f"[拒否] 名前 '{name}' はすでに使用されています。他の名前で接続してください。"
+        logging.error(error_msg)
+        reject_client(state, error_msg)
+        return
+
+    logging.info(f"[接続] {name} ({reported_ip}:{reported_port}) が接続しました")
+    state.update(name=name, ip=reported_ip, port=reported_port)
+    clients[name] = state                              # クライアントを登録
+
+    for (publisher, topic), segment in shm_offers.get(name, {}).items():  # 接続前に提供されていた共有メモリスロットを通知
+        queue_send(state, encode_frame(MSG_SHM_OFFER, publisher, f"{topic};{segment}"))
+    notify_watchers("joined", name)
+
+def handle_message(state, msg_type, target_name, content):  # 登録済みクライアントからのフレームを処理する
+    name = state["name"]
+    if msg_type == MSG_PONG:                           # 生存確認への応答（毎秒届くためログには残さない）
+        if state["ping_sent"] is not None:
+            state["rtt"] = time.perf_counter() - state["ping_sent"]
+            state["ping_sent"] = None
+        return
+    if msg_type == MSG_ROUTE and traffic_recorder:     # 宛先付きメッセージ（CMD宛てを含む）を受信時のまま記録する
+        traffic_recorder.record(msg_type, name, target_name, content)
+    if msg_type != MSG_ROUTE or target_name == "CMD":  # 転送するメッセージは [転送] の1行だけ記録する
+        logging.info(f"[受信] {name} → {MSG_TYPE_NAMES.get(msg_type, msg_type)} {target_name};{content}")
+
+    if msg_type == MSG_ROUTE and target_name == "CMD" and content == "shutdown":  # CMD;shutdown受信時
+        logging.info("[CMD] CMD;shutdown を受信しました。全クライアントに終了指示を送信します。")
+        send_exit_to_all_clients()                     # 全クライアントにEXIT送信（ACKはイベントループで待機）
+
+    elif msg_type == MSG_ROUTE and target_name == "CMD" and content == "stats":  # CMD;stats受信時は送信キュー統計を返す
+        stats = client_stats()
+        logging.info(f"[統計] {stats}")
+        queue_send(state, encode_frame(MSG_ROUTE, "CMD", json.dumps(stats)))
+
+    elif msg_type == MSG_ROUTE and target_name == "CMD" and content == "watch_clients":  # 接続中の一覧を返し、以降の接続・切断を通知する
+        client_watchers.add(name)
+        queue_send(state, encode_frame(MSG_ROUTE, "CMD", "clients:" + ",".join(clients)))
+
+    elif msg_type == MSG_ACK and content == "EXIT_RECEIVED":  # クライアントからのEXIT ACK
+        logging.info(f"[ACK受信] {name} からEXIT受領確認を受信しました。")
+        exit_acks_received.add(name)
+        check_exit_acks()                              # 最後のACKなら即座に停止処理へ
+
+    elif msg_type in (MSG_SHM_OFFER, MSG_SHM_ACCEPT):  # 共有メモリスロットのネゴシエーション
+        handle_shm_frame(state, msg_type, target_name, content)
+
+    elif msg_type == MSG_ROUTE:                        # 宛先付きメッセージは転送
+        target = clients.get(target_name)              # 宛先を取得
+        if target:
+            lane = classify_lane(msg_type, content)   # 制御かデータかを判定
+            topic = message_topic(content)
+            conflate_key = f"{name}/{topic}" if topic in CONFLATING_TOPICS else None  # 送信元ごとに最新値を保持
+            if TRACE_MARKER in content:             # 遅延トレース付きなら転送時刻を書き足す
+                content = add_hop(content, "bb")
+            queue_send(target, encode_frame(MSG_ROUTE, name, content), lane, conflate_key)  # 送信元名を付けて宛先の送信キューへ追加（ブロックしない）
+            logging.info("[転送] %s → %s : %s", name, target_name, content, extra={"topic": topic if topic in DATA_TOPICS else None})  # 高頻度トピックはコンソールで間引く
         else:
-            conn.sendall("[エラー] 初期メッセージ形式が不正です。'名前;IP:PORT'の形式で送信してください。".encode())
-            conn.close()
-            return
-
-        if name in clients:                                # 名前重複を確認
-            error_msg = f"[拒否] 名前 '{name}' はすでに使用されています。他の名前で接続してください。"
-            logging.error(error_msg)
-            conn.sendall(error_msg.encode())
-            conn.close()
-            return
-
-        logging.info(f"[接続] {name} ({reported_ip}:{reported_port}) が接続しました")
-        clients[name] = { "conn": conn, "ip": reported_ip, "port": reported_port }  # クライアントを登録
-
-        while server_running:                            # サーバ稼働中ループ
-            try:
-                data = conn.recv(1024)                   # クライアントからデータ受信
-                if not data: break                      # データが空なら切断扱い
-                message = data.decode().strip()         # デコードしてメッセージ取得
-                logging.info(f"[受信] {name} → {message}")
-
-                if message == "CMD;shutdown":           # CMD;shutdown受信時
-                    logging.info("[CMD] CMD;shutdown を受信しました。全クライアントに終了指示を送信します。")
-                    send_exit_to_all_clients()          # 全クライアントにEXIT送信＆ACK確認
-                    server_running = False              # すべて完了後にサーバ停止
-                    break                               # クライアントループ終了
-
-                elif message.startswith("ACK;EXIT_RECEIVED"):  # クライアントからのEXIT ACK
-                    logging.info(f"[ACK受信] {name} からEXIT受領確認を受信しました。")
-                    exit_acks_received.add(name)
-
-                elif ";" in message:                    # メッセージが;を含む場合は転送
-                    target_name, content = message.split(";", 1)  # 宛先と内容を分割
-                    target = clients.get(target_name)   # 宛先を取得
-                    if target:
-                        target["conn"].sendall(content.encode())  # 宛先に転送
-                        logging.info(f"[転送] {name} → {target_name} : {content}")
-                    else:
-                        err_msg = f"[エラー] 宛先 '{target_name}' が見つかりません"
-                        conn.sendall(err_msg.encode())
-                        logging.error(err_msg)
-                else:
-                    err_msg = "[エラー] メッセージは '宛先名;内容' の形式で送信してください"
-                    conn.sendall(err_msg.encode())
-                    logging.error(err_msg)
-            except Exception as e:
-                logging.error(f"[エラー] 受信中に例外発生：{e}")
-                break
-    finally:
-        if name:
-            client_info = clients.get(name)
-            if client_info:
-                logging.info(f"[切断] {client_info['ip']}:{client_info['port']} ({name}) の接続を終了")
-                del clients[name]
-        conn.close()
+            err_msg = f"[エラー] 宛先 '{target_name}' が見つかりません"
+            queue_send(state, encode_frame(MSG_ERROR, "", err_msg))
+            logging.error(err_msg)
+    else:
+        err_msg = f"[エラー] 未対応のメッセージ種別です: {MSG_TYPE_NAMES.get(msg_type, msg_type)}"
+        queue_send(state, encode_frame(MSG_ERROR, "", err_msg))
+        logging.error(err_msg)
+
+def handle_readable(state):                            # クライアントソケットが読み込み可能になった時の処理
+    try:
+        data = state["conn"].recv(RECV_BUFFER_SIZE)    # クライアントからデータ受信
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError as e:
+        logging.error(f"[エラー] 受信中に例外発生：{e}")
+        close_client(state)
+        return
+    if not data:                                       # データが空なら切断扱い
+        close_client(state)
+        return
+    state["last_seen"] = time.monotonic()              # 何か届けば生きているとみなす（PONGを待たない）
+
+    try:
+        frames = state["decoder"].feed(data)           # 1回の受信に含まれる全フレームを取り出す（分割分は次回に持ち越し）
+    except ProtocolError as e:
+        logging.error(f"[エラー] {state['name'] or state['addr']} から不正なフレームを受信: {e}")
+        reject_client(state, f"[エラー] 不正なフレームです: {e}")
+        return
+
+    for msg_type, name, payload in frames:
+        if state["closed"]:                            # 処理中に切断された場合は残りを捨てる
+            break
+        if state["name"] is None:                      # まだ登録前なら初期メッセージとして処理
+            handle_handshake(state, msg_type, name, payload)
+        else:
+            handle_message(state, msg_type, name, payload)
+
+def accept_client(server):                             # 新規接続を受け付けてイベントループに登録する
+    try:
+        conn, addr = server.accept()                   # クライアント接続受付
+    except (BlockingIOError, InterruptedError):
+        return
+    conn.setblocking(False)                            # イベントループ用にノンブロッキング化
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 小さな制御メッセージをNagleで遅延させない
+    state = {                                          # 接続ごとの状態
+        "conn": conn, "addr": addr, "name": None, "ip": None, "port": None,
+        "outbuf": bytearray(),                         # ソケットへ送信中のデータ
+        "lanes": {LANE_CONTROL: deque(), LANE_DATA: deque()},  # レーン別送信キュー（(最新値キー, フレーム) の列）
+        "latest": {},                                  # 最新値キー → 未送信の最新フレーム
+        "stats": {"queued": 0, "sent": 0, "dropped": 0, "conflated": 0, "max_depth": 0},  # 送信キュー統計
+        "decoder": FrameDecoder(),                     # 受信データのフレーム分割器
+        "events": selectors.EVENT_READ,                # 現在監視しているイベント
+        "closed": False,
+        "last_seen": time.monotonic(),                 # 最後に何か受信した時刻（生存確認用）
+        "ping_sent": None,                             # 応答待ちのPINGを送った時刻（time.perf_counter）
+        "rtt": None,                                   # 直近のPING → PONGの往復時間（秒）
+    }
+    connections[conn] = state
+    selector.register(conn, selectors.EVENT_READ, data=state)
+
+def check_heartbeats():                                # 生存確認: 応答の無い接続を切断し、残りにPINGを送る
+    global next_heartbeat
+    now = time.monotonic()
+    if now < next_heartbeat:
+        return
+    next_heartbeat = now + HEARTBEAT_INTERVAL
+    for state in list(connections.values()):
+        silent = now - state["last_seen"]
+        if silent > HEARTBEAT_TIMEOUT:                 # ハングしたプロセスは接続を閉じないため、タイムアウトで切断する
+            label = state["name"] or state["addr"]
+            logging.warning(f"[ハートビート] {label} から {silent:.1f} 秒応答が無いため切断します。")
+            heartbeat_evictions.append((label, silent))
+            close_client(state)
+        elif state["name"] and state["ping_sent"] is None:
+            state["ping_sent"] = time.perf_counter()
+            queue_send(state, encode_frame(MSG_PING))  # 制御レーンで送る（データレーンが詰まっていても届く）
 
 def watch_for_esc():                                   # ESCキー押下でサーバ終了を監視する関数
-    global server_running
     logging.info("[操作] ESCキーでサーバを終了できます")
     while server_running:
         if msvcrt.kbhit():                            # キーボード入力を検出
             key = msvcrt.getch()                      # 入力キーを取得
             if key == b'\x1b':                        # ESCキーの場合
                 logging.info("[操作] ESCキーが押されました。サーバを終了します。")
-                server_running = False
+                stop_server()                         # イベントループを起こして停止させる
                 break
+        time.sleep(0.05)                              # キー監視のビジーループを避ける
 
 def start_server(host='localhost', port=9000):        # サーバを起動する関数
-    global server_running
+    global selector, wakeup_sender
+    selector = selectors.DefaultSelector()            # OSに応じた最適なセレクタを使用
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCPソケット作成
+    if os.name != "nt":                               # Linux等では直前の接続のTIME_WAITが残っていても再起動直後にバインドできるようにする
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((host, port))                         # ホスト・ポートにバインド
     server.listen()                                   # 接続待機状態にする
+    server.setblocking(False)                         # acceptもイベントループから行う
+    selector.register(server, selectors.EVENT_READ, data="accept")
+
+    wakeup_receiver, wakeup_sender = socket.socketpair()  # stop_server()からの起床通知用
+    wakeup_receiver.setblocking(False)
+    selector.register(wakeup_receiver, selectors.EVENT_READ, data="wakeup")
     logging.info(f"[起動] BlackBoardサーバが {host}:{port} で待機中...")
 
-    esc_thread = threading.Thread(target=watch_for_esc, daemon=True)  # ESC監視スレッド作成
-    esc_thread.start()
+    if msvcrt:
+        esc_thread = threading.Thread(target=watch_for_esc, daemon=True)  # ESC監視スレッド作成
+        esc_thread.start()
 
     try:
         while server_running:                        # サーバ稼働中ループ
-            server.settimeout(1.0)                   # 1秒ごとにacceptをタイムアウトしてESC監視
-            try:
-                conn, addr = server.accept()         # クライアント接続受付
-                thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)  # クライアントごとにスレッド作成
-                thread.start()
-            except socket.timeout:                   # タイムアウト時
-                continue                             # ESC監視へ戻る
+            timeout = max(0.0, next_heartbeat - time.monotonic())  # 次の生存確認までイベントを待つ
+            if exit_wait is not None:                # ACK待ち中は期限でも起きるようにする
+                timeout = min(timeout, max(0.0, exit_wait["deadline"] - time.monotonic()))
+            for key, mask in selector.select(timeout):
+                if key.data == "accept":
+                    accept_client(server)
+                elif key.data == "wakeup":
+                    try:
+                        wakeup_receiver.recv(64)     # 起床通知を読み捨てる
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                else:
+                    state = key.data
+                    if mask & selectors.EVENT_READ:
+                        handle_readable(state)
+                    if mask & selectors.EVENT_WRITE and not state["closed"]:
+                        flush_client(state)
+            check_exit_acks()                        # ACK待ちのタイムアウト判定
+            check_heartbeats()                       # 応答の無いクライアントの切断とPING送信
     finally:
         logging.info("[終了] サーバ停止中...")
-        for client in clients.values():              # 接続中クライアント全ての接続を閉じる
-            client["conn"].close()
+        if heartbeat_evictions:                      # 生存確認で切断した接続の集計
+            logging.info(f"[ハートビート] 応答が無く切断した接続: {len(heartbeat_evictions)} 件 "
+                         + ", ".join(f"{label}（{silent:.1f} 秒）" for label, silent in heartbeat_evictions))
+        else:
+            logging.info("[ハートビート] 応答が無く切断した接続はありません。")
+        for state in list(connections.values()):     # 接続中クライアント全ての接続を閉じる
+            close_client(state)
+        selector.close()
+        wakeup_receiver.close()
+        wakeup_sender.close()
         server.close()                               # サーバソケットを閉じる
 
 if __name__ == "__main__":                           # スクリプトが直接実行されたときのみ
+    parser = argparse.ArgumentParser(description="BlackBoardサーバ")
+    parser.add_argument("--port", type=int, default=9000, help="待機するポート番号（BlackBoardBenchmark.py が別ポートで起動する）")
+    args = parser.parse_args()
     initialize_blackboard_logging()                 # ログ初期化
-    start_server()                                  # サーバ起動
+    try:
+        start_server(port=args.port)                # サーバ起動
+    finally:
+        stop_blackboard_logging()                   # 残りのログを書き出す
@@ -0,0 +1,372 @@
+# BlackBoardBenchmark.py
+
+# BlackBoardの負荷試験。ループバック上に専用のBlackBoard（BlackBoard.py --port）を起動し、
+# 実際と同じハンドシェイク（名前;IP:PORT）で登録した疑似クライアントN個に "宛先;内容" を指定の頻度・サイズで送り合わせる。
+# 各クライアントは隣のクライアント（最後は先頭）に送り、受信側で送信時刻との差（BlackBoard経由の転送遅延）を測る。
+# 受信数から求めたスループット、遅延のp50/p99/p999、BlackBoardプロセスのCPU使用率とメモリを表示し、JSONに保存できる。
+# 同じ条件でバージョン間の結果を比べたり、クライアント数・頻度を振って遅延が悪化し始める点を探したりするために使う。
+#
+# 使い方:
+#   python BlackBoardBenchmark.py                                         # 8クライアント × 100件/秒 × 64byte を10秒
+#   python BlackBoardBenchmark.py --clients 2 8 32 --rate 100 1000        # 条件の組み合わせをすべて計測する
+#   python BlackBoardBenchmark.py --rate 0 --size 1024 --json result.json # 受信が追いつく範囲の最大速度で送る
+#   python BlackBoardBenchmark.py --topic Depth                           # データレーン（最新値の上書き・破棄あり）を計測する
+#
+# 注意:
+#   - 計測条件ごとにBlackBoardを起動し直す。ログは既定で保存しない（--save-logs で実際の設定に近づける）。
+#   - 疑似クライアントも同じPCで動くため、BlackBoardと CPU を取り合う（--processes でプロセス数を変えられる）。
+#   - --rate 0 では、各クライアントは自分の受信数より --in-flight 件以上先には送らない（閉ループ）。
+#     受信側が追いつかずクライアント内で溜まった待ち時間まで遅延に含めないため。
+#   - 遅延は time.perf_counter_ns() の差（同一PC内のプロセス間で比較できる）。送信・受信側の処理時間も含む。
+#   - CPU・メモリは psutil があれば使い、無ければ /proc から読む（どちらも使えなければ記録しない）。Linuxでも動作する。
+
+import argparse                                   # コマンドライン引数の解析用
+import json                                       # 結果のJSON出力・BlackBoard設定の書き出し用
+import multiprocessing                            # 疑似クライアントのワーカープロセス用
+import os                                         # パス・CPU数・/proc の参照用
+import platform                                   # 実行環境の記録用
+import queue                                      # 制御クライアントの受信待ち用
+import shutil                                     # 一時ディレクトリの削除用
+import socket                                     # 切断・TCP_NODELAYの設定用
+import subprocess                                 # BlackBoardの起動用
+import sys                                        # 同じPythonでBlackBoardを起動するため
+import tempfile                                   # BlackBoardの作業ディレクトリ（Log/ と設定ファイル）用
+import threading                                  # クライアントごとの送信・受信スレッド用
+import time                                       # 送信時刻・遅延の計測用
+import numpy as np                                # 遅延の集計用
+try:
+    import psutil                                 # BlackBoardのCPU時間・メモリの取得用（任意）
+except ImportError:                               # 無ければLinuxでは /proc から読む
+    psutil = None
+from BlackBoardProtocol import (                  # BlackBoard通信フレームの定義
+    connect_blackboard, send_frame, send_hello, iter_frames, MSG_ROUTE, MSG_EXIT, MSG_ACK, MSG_ERROR,
+)
+
+HOST = 'localhost'                                # BlackBoardを起動するホスト（ループバック）
+PORT = 9100                                       # 動作中のBlackBoard（9000）と衝突しないポート
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTROL_NAME = "BenchCtl"                         # 登録確認・統計取得・終了指示を行う制御クライアントの名前
+CLIENT_PREFIX = "Bench"                           # 疑似クライアントの名前（Bench0, Bench1, ...）
+WARMUP_TIME = 1.0                                 # 計測前に送り始めておく秒数（接続直後の遅延を集計に含めない）
+DRAIN_TIME = 1.0                                  # 送信終了後、転送中のメッセージの到着を待つ秒数
+READY_TIMEOUT = 30.0                              # BlackBoardの起動と全クライアントの登録を待つ最大秒数
+REPLY_TIMEOUT = 5.0                               # CMD;stats の応答を待つ最大秒数
+SHUTDOWN_TIMEOUT = 10.0                           # CMD;shutdown 後、BlackBoardの終了を待つ最大秒数
+SAMPLE_INTERVAL = 0.2                             # 計測中にBlackBoardのメモリを読む間隔（秒）
+IN_FLIGHT = 32                                    # --rate 0 のとき、1クライアントが受信数より先に送れる件数
+
+def process_usage(pid):
+    """
+    プロセスの (CPU時間の合計秒, 常駐メモリのバイト数) を返す。取得できなければ None。
+    """
+    try:
+        if psutil:
+            process = psutil.Process(pid)
+            cpu = process.cpu_times()
+            return cpu.user + cpu.system, process.memory_info().rss
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()  # プロセス名（括弧内）より後ろ。fields[0] が3番目の項目
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+        return cpu, int(fields[21]) * os.sysconf("SC_PAGE_SIZE")               # rss（ページ数）
+    except Exception:                             # psutil・/proc が使えない環境、またはプロセス終了後
+        return None
+
+def send_loop(sock, peer, rate, size, topic, start, end, credits, result):
+    """
+    start から end まで peer に "トピック:送信時刻ns:詰め物" を送る。rate 件/秒。
+    rate が0以下なら、受信のたびに増える credits（セマフォ）がある限り待たずに送る。
+    """
+    interval = 1.0 / rate if rate > 0 else 0.0
+    due = start
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if now < due:
+            time.sleep(due - now)
+        due = max(due + interval, start)
+        if rate <= 0 and not credits.acquire(timeout=min(0.1, max(0.0, end - now))):
+            continue                              # 受信を待つ（終了時刻の確認のため一定時間で戻る）
+        header = f"{topic}:{time.perf_counter_ns()}:"
+        try:
+            send_frame(sock, MSG_ROUTE, peer, header + "x" * max(0, size - len(header)))
+        except OSError:
+            break
+        result["sent_total"] += 1
+
+def receive_loop(sock, topic, window_start_ns, window_end_ns, credits, result):
+    """
+    受信したベンチマークメッセージの転送遅延（ns）を記録する。計測区間内に送られたものだけを集計する。
+    """
+    prefix = topic + ":"
+    latencies = result["latencies"]
+    try:
+        for msg_type, sender, content in iter_frames(sock):
+            if msg_type == MSG_ROUTE and content.startswith(prefix):
+                received_ns = time.perf_counter_ns()
+                credits.release()                 # 同じクライアントの送信を1件進める（--rate 0 の場合）
+                result["received_total"] += 1
+                sent_ns = int(content[len(prefix):content.index(":", len(prefix))])
+                if window_start_ns <= sent_ns < window_end_ns:
+                    latencies.append(received_ns - sent_ns)
+            elif msg_type == MSG_EXIT:
+                send_frame(sock, MSG_ACK, "", "EXIT_RECEIVED")
+            elif msg_type == MSG_ERROR:
+                result["errors"] += 1
+    except OSError:
+        pass
+
+def client_worker(names, peers, rate, size, topic, duration, in_flight, port, start_value, start_event, result_queue):
+    """
+    疑似クライアントを names の数だけ接続して登録し、start_event 後に start_value の時刻から送受信する。
+    クライアントごとの送信数・受信遅延を result_queue で親に返す。
+    """
+    socks = []
+    try:
+        for name in names:
+            sock = connect_blackboard(HOST, port)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 1件ずつの遅延を測るため、まとめて送らない
+            send_hello(sock, name)
+            socks.append(sock)
+    except OSError as e:
+        result_queue.put(("error", names[0], str(e)))
+        return
+    if not start_event.wait(READY_TIMEOUT):
+        return
+
+    start = start_value.value                     # 送信開始（ウォームアップ込み）の perf_counter 時刻
+    window_start = start + WARMUP_TIME
+    end = window_start + duration
+    results = {name: {"sent_total": 0, "received_total": 0, "errors": 0, "latencies": []} for name in names}
+    credits = {name: threading.Semaphore(in_flight) for name in names}
+    receivers = [threading.Thread(target=receive_loop, daemon=True,
+                                  args=(sock, topic, int(window_start * 1e9), int(end * 1e9), credits[name], results[name]))
+                 for sock, name in zip(socks, names)]
+    senders = [threading.Thread(target=send_loop, daemon=True,
+                                args=(sock, peer, rate, size, topic, start, end, credits[name], results[name]))
+               for sock, name, peer in zip(socks, names, peers)]
+    for thread in receivers + senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    time.sleep(max(0.0, end + DRAIN_TIME - time.perf_counter()))  # 転送中のメッセージを待つ
+    for sock in socks:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)       # 受信スレッドの recv を終わらせる
+        except OSError:
+            pass
+    for thread in receivers:
+        thread.join()
+    for sock in socks:
+        sock.close()
+    for name, result in results.items():
+        result["latencies"] = np.array(result["latencies"], dtype=np.int64)
+        result_queue.put(("result", name, result))
+
+class ControlClient:
+    """
+    計測対象のBlackBoardに CONTROL_NAME で登録し、疑似クライアントの登録確認・統計の取得・終了指示を行う。
+    """
+    def __init__(self, port):
+        self.sock = connect_blackboard(HOST, port, timeout=READY_TIMEOUT)
+        send_hello(self.sock, CONTROL_NAME)
+        self.frames = queue.Queue()
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):                           # PINGへの応答とEXITのACKはここで返し、それ以外を frames に積む
+        try:
+            for msg_type, sender, content in iter_frames(self.sock):
+                if msg_type == MSG_EXIT:
+                    send_frame(self.sock, MSG_ACK, "", "EXIT_RECEIVED")
+                else:
+                    self.frames.put((msg_type, sender, content))
+        except OSError:
+            pass
+        self.frames.put(None)                     # 切断
+
+    def _next(self, deadline):
+        frame = self.frames.get(timeout=max(0.0, deadline - time.monotonic()))
+        if frame is None:
+            raise ConnectionError("BlackBoardとの接続が切れました。")
+        return frame
+
+    def wait_for_clients(self, names, timeout=READY_TIMEOUT):  # names がすべて登録されるまで待つ
+        waiting = set(names)
+        send_frame(self.sock, MSG_ROUTE, "CMD", "watch_clients")
+        deadline = time.monotonic() + timeout
+        while waiting:
+            msg_type, sender, content = self._next(deadline)
+            if msg_type == MSG_ROUTE and sender == "CMD":
+                event, _, joined = content.partition(":")
+                if event in ("clients", "joined"):
+                    waiting.difference_update(joined.split(","))
+
+    def stats(self):                              # CMD;stats の応答（クライアントごとの送信キュー統計）を返す
+        send_frame(self.sock, MSG_ROUTE, "CMD", "stats")
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while True:
+            msg_type, sender, content = self._next(deadline)
+            if msg_type == MSG_ROUTE and sender == "CMD" and content.startswith("{"):
+                return json.loads(content)
+
+    def shutdown(self):
+        try:
+            send_frame(self.sock, MSG_ROUTE, "CMD", "shutdown")
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+def run_load(clients, rate, size, duration, topic="Bench", processes=None, in_flight=IN_FLIGHT, port=PORT,
+             save_logs=False, show_output=False):
+    """
+    BlackBoardを起動し、clients 個の疑似クライアントで1条件分の負荷をかけて、集計結果の辞書を返す。
+    """
+    names = [f"{CLIENT_PREFIX}{i}" for i in range(clients)]
+    peers = names[1:] + names[:1]                 # 隣のクライアントに送る（1個なら自分宛て）
+    processes = max(1, min(processes or os.cpu_count() or 1, clients))
+
+    workdir = tempfile.mkdtemp(prefix="bb_bench_")  # BlackBoardは作業ディレクトリの設定を読み、Log/ を作る
+    with open(os.path.join(workdir, "logging_config.json"), "w", encoding="utf-8") as f:
+        json.dump({"save_blackboard_logs": save_logs, "save_blackboard_traffic": False}, f)
+    output = None if show_output else subprocess.DEVNULL
+    server = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, "BlackBoard.py"), "--port", str(port)],
+                              cwd=workdir, stdout=output, stderr=output)
+    result_queue = multiprocessing.Queue()
+    start_time = multiprocessing.Value("d", 0.0)    # 送信開始の perf_counter 時刻（全員の登録後に決める）
+    start_event = multiprocessing.Event()
+    workers = []
+    control = None
+    try:
+        control = ControlClient(port)
+        for i in range(processes):
+            worker = multiprocessing.Process(target=client_worker, daemon=True,
+                                             args=(names[i::processes], peers[i::processes], rate, size, topic, duration, in_flight, port,
+                                                   start_time, start_event, result_queue))
+            worker.start()
+            workers.append(worker)
+        control.wait_for_clients(names)
+
+        start_time.value = time.perf_counter() + 0.1  # ワーカーが開始時刻を読むまでの余裕
+        start_event.set()
+        window_start = start_time.value + WARMUP_TIME
+        window_end = window_start + duration
+        time.sleep(max(0.0, window_start - time.perf_counter()))
+        usage_start = process_usage(server.pid)
+        peak_rss = usage_start[1] if usage_start else None
+        while time.perf_counter() < window_end:
+            time.sleep(min(SAMPLE_INTERVAL, max(0.0, window_end - time.perf_counter())))
+            usage = process_usage(server.pid)
+            if usage and peak_rss is not None:
+                peak_rss = max(peak_rss, usage[1])
+        usage_end = process_usage(server.pid)
+        server_stats = control.stats()            # 計測終了時点の送信キュー統計
+
+        client_results = {}
+        while len(client_results) < clients:
+            kind, name, payload = result_queue.get(timeout=READY_TIMEOUT)
+            if kind == "error":
+                raise ConnectionError(f"{name} のプロセスが接続できませんでした: {payload}")
+            client_results[name] = payload
+    finally:
+        if control:
+            control.shutdown()
+            control.close()
+        try:
+            server.wait(SHUTDOWN_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+        for worker in workers:
+            worker.join(SHUTDOWN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+        if save_logs:
+            print(f"[ベンチマーク] BlackBoardのログ: {os.path.join(workdir, 'Log', 'BlackBoardLog')}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = np.concatenate([r["latencies"] for r in client_results.values()]) / 1e6  # ms
+    received = len(latencies)
+    sent = sum(r["sent_total"] for r in client_results.values())
+    bench_stats = [s for name, s in server_stats.items() if name.startswith(CLIENT_PREFIX)]
+    result = {
+        "clients": clients, "rate": rate, "size": size, "duration": duration, "topic": topic, "processes": processes,
+        "offered_rate": clients * rate if rate > 0 else None,   # 件/秒（0は最大速度）
+        "in_flight": in_flight if rate <= 0 else None,
+        "sent_total": sent,                                     # ウォームアップを含む送信数
+        "received_total": sum(r["received_total"] for r in client_results.values()),  # ウォームアップを含む受信数
+        "received": received,                                   # 計測区間内に送られ、届いたメッセージ数
+        "throughput": received / duration,                      # 件/秒
+        "throughput_mb": received * size / duration / 1e6,      # MB/秒（内容のみ）
+        "errors": sum(r["errors"] for r in client_results.values()),
+        "dropped": sum(s.get("dropped", 0) for s in bench_stats),
+        "conflated": sum(s.get("conflated", 0) for s in bench_stats),
+        "max_queue_depth": max((s.get("max_depth", 0) for s in bench_stats), default=0),
+    }
+    if received:
+        result["latency_ms"] = {
+            "p50": float(np.percentile(latencies, 50)), "p99": float(np.percentile(latencies, 99)),
+            "p999": float(np.percentile(latencies, 99.9)), "max": float(latencies.max()), "mean": float(latencies.mean()),
+        }
+    if usage_start and usage_end:
+        result["cpu_percent"] = (usage_end[0] - usage_start[0]) / duration * 100  # BlackBoardのCPU使用率（1コア=100%）
+        result["rss_mb"] = usage_end[1] / 1e6
+        result["peak_rss_mb"] = peak_rss / 1e6
+    return result
+
+def git_revision():                               # 計測したBlackBoardのバージョン（Gitのコミット）
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="BlackBoardに疑似クライアントで負荷をかけ、スループット・転送遅延・CPU・メモリを計測する")
+    parser.add_argument("--clients", type=int, nargs="+", default=[8], help="疑似クライアント数（複数指定で順に計測）")
+    parser.add_argument("--rate", type=float, nargs="+", default=[100.0], help="1クライアントあたりの送信頻度（件/秒, 0で受信が追いつく範囲の最大速度）")
+    parser.add_argument("--size", type=int, nargs="+", default=[64], help="メッセージ内容のバイト数")
+    parser.add_argument("--duration", type=float, default=10.0, help="1条件あたりの計測秒数（ウォームアップを除く）")
+    parser.add_argument("--topic", default="Bench", help="内容のトピック名（Depth でデータレーンを計測）")
+    parser.add_argument("--in-flight", type=int, default=IN_FLIGHT, help="--rate 0 のとき、1クライアントが受信数より先に送れる件数")
+    parser.add_argument("--processes", type=int, help="疑似クライアントを動かすプロセス数（既定はCPU数とクライアント数の小さい方）")
+    parser.add_argument("--port", type=int, default=PORT, help="計測用BlackBoardのポート番号")
+    parser.add_argument("--save-logs", action="store_true", help="BlackBoardのログを保存する（実運用の設定に近い負荷になる）")
+    parser.add_argument("--show-output", action="store_true", help="BlackBoardの出力を表示する")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    runs = []
+    for clients in args.clients:
+        for rate in args.rate:
+            for size in args.size:
+                print(f"[ベンチマーク] {clients} クライアント × {'最大速度' if rate <= 0 else f'{rate:g}件/秒'} × {size} byte, "
+                      f"{args.duration:g} 秒")
+                result = run_load(clients, rate, size, args.duration, args.topic, args.processes, args.in_flight, args.port,
+                                  args.save_logs, args.show_output)
+                runs.append(result)
+                line = f"  受信 {result['received']} 件（{result['throughput']:.0f} 件/秒, {result['throughput_mb']:.2f} MB/秒）"
+                if "latency_ms" in result:
+                    lat = result["latency_ms"]
+                    line += f"  遅延 p50 {lat['p50']:.2f} / p99 {lat['p99']:.2f} / p999 {lat['p999']:.2f} ms"
+                if "cpu_percent" in result:
+                    line += f"  CPU {result['cpu_percent']:.0f}%  メモリ {result['rss_mb']:.1f} MB（最大 {result['peak_rss_mb']:.1f} MB）"
+                print(line)
+                if result["dropped"] or result["conflated"] or result["errors"]:
+                    print(f"  破棄 {result['dropped']}  上書き {result['conflated']}  エラー {result['errors']}")
+
+    if args.json:
+        summary = {
+            "environment": {"platform": platform.platform(), "python": platform.python_version(),
+                            "cpu_count": os.cpu_count(), "revision": git_revision(),
+                            "usage_source": "psutil" if psutil else "/proc"},
+            "runs": runs,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"[ベンチマーク] 結果を保存しました: {args.json}")
+
+if __name__ == "__main__":
+    main()
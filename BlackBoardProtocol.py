@@ -0,0 +1,160 @@
+# BlackBoardProtocol.py
+
+# BlackBoardと各クライアント間の通信フレーム定義。
+# TCPはバイトストリームなので、recv() 1回分が1メッセージになるとは限らない（結合・分割が起こる）。
+# そのため各メッセージを長さプレフィックス付きのフレームとして送受信する。
+#
+# フレーム形式（ビッグエンディアン）:
+#   [本体長 4byte][種別 1byte][名前長 1byte][名前 UTF-8][内容 UTF-8]
+#   本体長は「種別」以降のバイト数。
+#   名前はクライアント→BlackBoardでは宛先名、BlackBoard→クライアントでは送信元名を表す。
+#
+# クライアントでは受信スレッド（PONGの返信）と送信側のスレッドが同じソケットに書き込むため、
+# send_frame() / send_frames() はソケットごとのロックを取って送る（sendallが途中まで送った状態でフレームが混ざらないように）。
+
+import socket                                   # BlackBoardへの接続用
+import struct                                   # バイナリヘッダのパック/アンパック用
+import threading                                # ソケットごとの送信ロック用
+import time                                     # 接続の再試行用
+import weakref                                  # 閉じたソケットの送信ロックを残さないため
+
+# --- メッセージ種別 ---
+MSG_HELLO = 1                                   # 接続直後の登録（名前=クライアント名, 内容="IP:PORT"）
+MSG_ROUTE = 2                                   # 宛先への転送メッセージ（従来の "宛先;内容"）
+MSG_EXIT = 3                                    # BlackBoard → クライアントの終了指示
+MSG_ACK = 4                                     # クライアント → BlackBoardの受領確認（内容="EXIT_RECEIVED"）
+MSG_ERROR = 5                                   # BlackBoard → クライアントのエラー通知
+MSG_SHM_OFFER = 6                               # 共有メモリ最新値スロットの提供（名前=受け手/提供元, 内容="トピック;セグメント名"。セグメント名が空なら取り下げ）
+MSG_SHM_ACCEPT = 7                              # 共有メモリ最新値スロットの利用状態通知（名前=提供元/受け手, 内容="トピック;1"で利用開始, "トピック;0"で利用終了）
+MSG_PING = 8                                    # BlackBoard → クライアントの生存確認（ハートビート）
+MSG_PONG = 9                                    # クライアント → BlackBoardの生存確認への応答（iter_frames() が自動で返す）
+
+MSG_TYPE_NAMES = {                              # ログ表示用の種別名
+    MSG_HELLO: "HELLO",
+    MSG_ROUTE: "ROUTE",
+    MSG_EXIT: "EXIT",
+    MSG_ACK: "ACK",
+    MSG_ERROR: "ERROR",
+    MSG_SHM_OFFER: "SHM_OFFER",
+    MSG_SHM_ACCEPT: "SHM_ACCEPT",
+    MSG_PING: "PING",
+    MSG_PONG: "PONG",
+}
+
+LENGTH_PREFIX = struct.Struct("!I")             # 本体長フィールド
+BODY_HEADER = struct.Struct("!BB")              # 種別・名前長フィールド
+MAX_FRAME_SIZE = 1024 * 1024                    # 1フレーム本体の上限（不正データでメモリを使い切らないため）
+RECV_BUFFER_SIZE = 65536                        # 1回のrecvで読み込む最大バイト数（複数フレームをまとめて受信する）
+CONNECT_TIMEOUT = 10.0                          # BlackBoardの起動を待って接続を再試行する最大秒数
+CONNECT_RETRY_INTERVAL = 0.05                   # 接続の再試行間隔（秒）
+
+class ProtocolError(ValueError):                # フレーム形式が不正な場合の例外
+    pass
+
+def encode_frame(msg_type, name="", payload=""):
+    """
+    1メッセージ分のフレームをバイト列に変換する。
+    name, payload は str または bytes を受け付ける。
+    """
+    if isinstance(name, str):
+        name = name.encode()
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if len(name) > 255:                                        # 名前長は1byteで表すため255byteまで
+        raise ProtocolError(f"名前が長すぎます: {len(name)} bytes")
+    body_len = BODY_HEADER.size + len(name) + len(payload)
+    if body_len > MAX_FRAME_SIZE:
+        raise ProtocolError(f"フレームが大きすぎます: {body_len} bytes")
+    return LENGTH_PREFIX.pack(body_len) + BODY_HEADER.pack(msg_type, len(name)) + name + payload
+
+class FrameDecoder:
+    """
+    受信したバイト列を蓄積し、完全に揃ったフレームだけを取り出すデコーダ。
+    途中で切れたフレームは次の feed() まで保持される。
+    """
+    def __init__(self):
+        self.buffer = bytearray()                               # 未処理の受信データ
+
+    def feed(self, data):                                      # 受信データを追加し、完成したフレームのリストを返す
+        self.buffer += data
+        frames = []
+        offset = 0
+        buf_len = len(self.buffer)
+        while buf_len - offset >= LENGTH_PREFIX.size:
+            (body_len,) = LENGTH_PREFIX.unpack_from(self.buffer, offset)
+            if body_len < BODY_HEADER.size or body_len > MAX_FRAME_SIZE:
+                raise ProtocolError(f"不正なフレーム長: {body_len}")
+            end = offset + LENGTH_PREFIX.size + body_len
+            if end > buf_len:                                   # 本体がまだ揃っていない
+                break
+            start = offset + LENGTH_PREFIX.size
+            msg_type, name_len = BODY_HEADER.unpack_from(self.buffer, start)
+            name_start = start + BODY_HEADER.size
+            payload_start = name_start + name_len
+            if payload_start > end:
+                raise ProtocolError(f"不正な名前長: {name_len}")
+            name = self.buffer[name_start:payload_start].decode(errors="replace")
+            payload = self.buffer[payload_start:end].decode(errors="replace")
+            frames.append((msg_type, name, payload))
+            offset = end
+        del self.buffer[:offset]                               # 処理済みフレームを捨てる
+        return frames
+
+_send_locks = weakref.WeakKeyDictionary()                      # ソケットごとの送信ロック
+_send_locks_guard = threading.Lock()
+
+def _send_lock(sock):                                          # sock の送信ロック（初めて送るときに作る）
+    with _send_locks_guard:
+        lock = _send_locks.get(sock)
+        if lock is None:
+            lock = _send_locks[sock] = threading.Lock()
+        return lock
+
+def send_frame(sock, msg_type, name="", payload=""):            # 1フレームを送信する（ブロッキングソケット用）
+    data = encode_frame(msg_type, name, payload)
+    with _send_lock(sock):
+        sock.sendall(data)
+
+def send_frames(sock, frames):                                 # 複数フレームを1回のsendallでまとめて送信する
+    data = b"".join(encode_frame(*frame) for frame in frames)
+    with _send_lock(sock):
+        sock.sendall(data)
+
+def connect_blackboard(host, port, timeout=CONNECT_TIMEOUT):
+    """
+    BlackBoardに接続したソケットを返す。BlackBoardがまだ待機を始めていなければ timeout 秒まで再試行する
+    （Supervisor.py で全プロセスを同時に起動した場合など）。期限までに接続できなければ最後の例外を送出する。
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((host, port))
+            return sock
+        except OSError:
+            sock.close()
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(CONNECT_RETRY_INTERVAL)
+
+def send_hello(sock, client_name):                             # 接続直後の登録フレームを送信し、自分のIP/PORTを返す
+    local_ip, local_port = sock.getsockname()
+    send_frame(sock, MSG_HELLO, client_name, f"{local_ip}:{local_port}")
+    return local_ip, local_port
+
+def iter_frames(sock):
+    """
+    ブロッキングソケットからフレームを順に取り出すジェネレータ。
+    相手が接続を閉じると終了する。1回のrecvに含まれる複数フレームはまとめて返される。
+    BlackBoardからの生存確認（PING）にはここでPONGを返し、呼び出し側には渡さない。
+    """
+    decoder = FrameDecoder()
+    while True:
+        data = sock.recv(RECV_BUFFER_SIZE)
+        if not data:                                           # 切断
+            return
+        for frame in decoder.feed(data):
+            if frame[0] == MSG_PING:
+                send_frame(sock, MSG_PONG)
+                continue
+            yield frame
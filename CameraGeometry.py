@@ -0,0 +1,169 @@
+# CameraGeometry.py
+
+# RealSenseのカラー・深度カメラの内部パラメータと外部パラメータ（カメラ間の位置関係）を保持し、
+# 手のランドマークなど少数の点だけをカラー画像から深度画像へ対応付けて3次元座標に変換する。
+# カラーと深度のストリームは位置合わせされていないため、カラー画像のピクセル座標で深度画像を読むと
+# 指先から数ピクセル〜数十ピクセルずれた位置の深度になる。rs.align で毎フレーム全画素を変換する代わりに、
+# 起動時に取得したパラメータを使ってランドマークの点だけをNumPyでまとめて変換する。
+#
+# 計算は librealsense の rs2_project_point_to_pixel / rs2_deproject_pixel_to_point /
+# rs2_project_color_pixel_to_depth_pixel と同じ（距離の単位はmm）。
+# pyrealsense2 は from_realsense_profile() の引数として渡されるオブジェクトを読むだけで、このモジュールでは読み込まない。
+
+import numpy as np                                # 点の一括変換用
+
+DISTORTION_MODELS = ("none", "modified_brown_conrady", "inverse_brown_conrady", "ftheta", "brown_conrady", "kannala_brandt4")  # rs.distortion の並び順
+MAX_LINE_STEPS = 256                              # カラー→深度の対応点を探す線分上の最大候補数
+
+class Intrinsics:
+    """
+    1つのストリームの内部パラメータ（rs.intrinsics と同じ項目）。model は DISTORTION_MODELS の名前。
+    """
+    def __init__(self, width, height, ppx, ppy, fx, fy, model="none", coeffs=(0, 0, 0, 0, 0)):
+        if model not in ("none", "modified_brown_conrady", "inverse_brown_conrady", "brown_conrady"):
+            raise ValueError(f"未対応の歪みモデルです: {model}")
+        self.width, self.height = int(width), int(height)
+        self.ppx, self.ppy, self.fx, self.fy = float(ppx), float(ppy), float(fx), float(fy)
+        self.model = model
+        self.coeffs = [float(c) for c in coeffs]
+
+    @classmethod
+    def from_realsense(cls, intrinsics):          # rs.intrinsics から作る
+        return cls(intrinsics.width, intrinsics.height, intrinsics.ppx, intrinsics.ppy, intrinsics.fx, intrinsics.fy,
+                   DISTORTION_MODELS[int(intrinsics.model)], intrinsics.coeffs)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return {"width": self.width, "height": self.height, "ppx": self.ppx, "ppy": self.ppy,
+                "fx": self.fx, "fy": self.fy, "model": self.model, "coeffs": self.coeffs}
+
+    def project(self, points):                    # カメラ座標の点（N×3）をピクセル座標（N×2, float）に変換する
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = points[:, 0] / points[:, 2]
+            y = points[:, 1] / points[:, 2]
+        c = self.coeffs
+        if self.model in ("modified_brown_conrady", "brown_conrady"):
+            r2 = x * x + y * y
+            f = 1 + c[0] * r2 + c[1] * r2 * r2 + c[4] * r2 * r2 * r2
+            if self.model == "modified_brown_conrady":
+                x, y = x * f, y * f               # 接線方向の歪みも歪ませた後の座標で計算する
+                xf, yf = x, y
+            else:
+                xf, yf = x * f, y * f
+            x, y = (xf + 2 * c[2] * x * y + c[3] * (r2 + 2 * x * x),
+                    yf + 2 * c[3] * x * y + c[2] * (r2 + 2 * y * y))
+        return np.stack([x * self.fx + self.ppx, y * self.fy + self.ppy], axis=1)
+
+    def deproject(self, pixels, depths):          # ピクセル座標（N×2）と深度（N,）をカメラ座標の点（N×3）に変換する
+        x = (pixels[:, 0] - self.ppx) / self.fx
+        y = (pixels[:, 1] - self.ppy) / self.fy
+        c = self.coeffs
+        if self.model == "inverse_brown_conrady":
+            r2 = x * x + y * y
+            f = 1 + c[0] * r2 + c[1] * r2 * r2 + c[4] * r2 * r2 * r2
+            x, y = (x * f + 2 * c[2] * x * y + c[3] * (r2 + 2 * x * x),
+                    y * f + 2 * c[3] * x * y + c[2] * (r2 + 2 * y * y))
+        elif self.model == "brown_conrady":       # 歪みの逆変換を反復計算で求める
+            x0, y0 = x, y
+            for _ in range(10):
+                r2 = x * x + y * y
+                icdist = 1 / (1 + ((c[4] * r2 + c[1]) * r2 + c[0]) * r2)
+                xq, yq = x / icdist, y / icdist
+                delta_x = 2 * c[2] * xq * yq + c[3] * (r2 + 2 * xq * xq)
+                delta_y = 2 * c[3] * xq * yq + c[2] * (r2 + 2 * yq * yq)
+                x, y = (x0 - delta_x) * icdist, (y0 - delta_y) * icdist
+        return np.stack([depths * x, depths * y, depths], axis=1)
+
+class Extrinsics:
+    """
+    カメラ間の座標変換（rs.extrinsics と同じ項目）。rotation は列優先の3×3、translation はメートル。
+    """
+    def __init__(self, rotation, translation):
+        self.rotation = [float(r) for r in rotation]
+        self.translation = [float(t) for t in translation]
+        self.matrix = np.array(self.rotation, np.float64).reshape(3, 3)  # 行ベクトルの点に右から掛ける形（列優先の転置）
+        self.offset_mm = np.array(self.translation, np.float64) * 1000
+
+    @classmethod
+    def from_realsense(cls, extrinsics):
+        return cls(extrinsics.rotation, extrinsics.translation)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return {"rotation": self.rotation, "translation": self.translation}
+
+    def inverse(self):
+        return Extrinsics(self.matrix.T.ravel(), -(self.offset_mm @ self.matrix.T) / 1000)
+
+    def transform(self, points):                  # 点（N×3, mm）を変換先のカメラ座標に移す
+        return points @ self.matrix + self.offset_mm
+
+class CameraGeometry:
+    """
+    カラー・深度カメラのパラメータ一式。depth_unit_mm は深度画像の値1あたりのmm（D400シリーズの既定は1.0）。
+    3次元座標は深度カメラの座標系（原点は深度カメラ、x: 右, y: 下, z: 奥、単位mm）で返す。
+    """
+    def __init__(self, color, depth, depth_to_color, depth_unit_mm=1.0):
+        self.color = color
+        self.depth = depth
+        self.depth_to_color = depth_to_color
+        self.color_to_depth = depth_to_color.inverse()
+        self.depth_unit_mm = float(depth_unit_mm)
+
+    @classmethod
+    def from_realsense_profile(cls, profile):     # 開始したパイプラインの rs.pipeline_profile から作る
+        import pyrealsense2 as rs
+        color = profile.get_stream(rs.stream.color).as_video_stream_profile()
+        depth = profile.get_stream(rs.stream.depth).as_video_stream_profile()
+        depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()  # 深度の値1あたりのメートル
+        return cls(Intrinsics.from_realsense(color.get_intrinsics()), Intrinsics.from_realsense(depth.get_intrinsics()),
+                   Extrinsics.from_realsense(depth.get_extrinsics_to(color)), depth_scale * 1000)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(Intrinsics.from_dict(data["color"]), Intrinsics.from_dict(data["depth"]),
+                   Extrinsics.from_dict(data["depth_to_color"]), data.get("depth_unit_mm", 1.0))
+
+    def to_dict(self):                            # 記録のメタデータに保存する形式
+        return {"color": self.color.to_dict(), "depth": self.depth.to_dict(),
+                "depth_to_color": self.depth_to_color.to_dict(), "depth_unit_mm": self.depth_unit_mm}
+
+    def color_to_depth_pixels(self, color_pixels, depth_image, near_mm, far_mm):
+        """
+        カラー画像のピクセル座標（N×2, float）に対応する深度画像のピクセル座標（N×2, int32）を返す。
+        近い側 near_mm と遠い側 far_mm の深度を仮定したときの深度画像上の2点を結ぶ線分上で、
+        その画素の深度を使ってカラー画像に投影し直したときに元の点に最も近くなる画素を選ぶ。
+        線分上に有効な深度が無い点は線分の中点を返し、found をFalseにする。戻り値は (深度ピクセル座標, found)。
+        """
+        n = len(color_pixels)
+        if n == 0:
+            return np.zeros((0, 2), np.int32), np.zeros(0, bool)
+        color_pixels = np.asarray(color_pixels, np.float64)
+        limits = np.array([self.depth.width - 1, self.depth.height - 1], np.float64)
+        ends = [np.clip(self.depth.project(self.color_to_depth.transform(
+                    self.color.deproject(color_pixels, np.full(n, d, np.float64)))), 0, limits)
+                for d in (near_mm, far_mm)]
+        steps = int(np.clip(np.ceil(np.abs(ends[1] - ends[0]).max()) + 1, 2, MAX_LINE_STEPS))  # 1画素ごと（長すぎる場合は間引く）
+        t = np.linspace(0.0, 1.0, steps)[None, :, None]
+        candidates = np.rint(ends[0][:, None] + (ends[1] - ends[0])[:, None] * t).astype(np.int32)  # N×候補数×2
+        raw = depth_image[candidates[..., 1], candidates[..., 0]]
+        depths = raw.reshape(-1).astype(np.float64) * self.depth_unit_mm
+        reprojected = self.color.project(self.depth_to_color.transform(
+            self.depth.deproject(candidates.reshape(-1, 2), depths))).reshape(n, steps, 2)
+        distances = ((reprojected - color_pixels[:, None]) ** 2).sum(axis=2)
+        distances[raw == 0] = np.inf              # 深度0は無効
+        best = distances.argmin(axis=1)
+        rows = np.arange(n)
+        found = np.isfinite(distances[rows, best])
+        depth_pixels = candidates[rows, best]
+        depth_pixels[~found] = np.rint((ends[0][~found] + ends[1][~found]) / 2).astype(np.int32)
+        return depth_pixels, found
+
+    def deproject_depth(self, depth_pixels, depths_mm):  # 深度画像のピクセル座標と深度[mm]を3次元座標（N×3, mm）に変換する
+        return self.depth.deproject(np.asarray(depth_pixels, np.float64), np.asarray(depths_mm, np.float64))
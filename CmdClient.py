@@ -4,19 +4,19 @@ from tkinter import *                             # GUI作成用のtkinterライ
 from tkinter import messagebox
 import socket                                     # ソケット通信用標準ライブラリ
 import threading                                  # スレッド処理用ライブラリ
+from BlackBoardProtocol import (                  # BlackBoard通信フレームの定義
+    connect_blackboard, send_frame, send_hello, iter_frames, MSG_ROUTE, MSG_EXIT, MSG_ACK, MSG_ERROR,
+)
 
 s = None                                         # ソケットオブジェクト格納用のグローバル変数
 
 def connect_socket():                            # BlackBoardサーバに接続する関数
     global s
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)      # TCPソケットを作成
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)    # アドレス再利用オプションを設定
-    s.connect(('localhost', 9000))                             # localhost:9000へ接続
+    s = connect_blackboard('localhost', 9000)                  # localhost:9000へ接続（起動中なら待って再試行）
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)    # 制御コマンドをNagleで遅延させない
 
-    local_ip, local_port = s.getsockname()                     # 自分側のIP/PORTを取得
     name = "Cmd"                                               # クライアント名としてCmdを使用
-    init_msg = f"{name};{local_ip}:{local_port}"               # 初期メッセージを作成
-    s.send(init_msg.encode())                                  # 初期メッセージを送信
+    local_ip, local_port = send_hello(s, name)                 # 初期メッセージ（HELLO）を送信
     connection_status_label.config(text=f"Connected: {name} ({local_ip}:{local_port})")  # 接続情報をGUIに表示
 
     recv_thread = threading.Thread(target=receive_from_blackboard, daemon=True)  # 受信スレッド作成
@@ -24,27 +24,29 @@ def connect_socket():                            # BlackBoardサーバに接続
 
 def receive_from_blackboard():                                # BlackBoardからのメッセージを受信するスレッド
     global s
-    while True:
-        try:
-            msg = s.recv(1024).decode().strip()               # データを受信してデコード
-            if msg:
-                print(f"[BlackBoard→CmdClient] {msg}")       # 受信メッセージをコンソール表示
-                if msg == "EXIT":                            # EXITを受信した場合
-                    print("[終了指示] EXITを受信しました。ACKを返して終了します。")
-                    try:
-                        s.sendall(b"ACK;EXIT_RECEIVED")      # BlackBoardへACKを送信
-                        print("[ACK送信] EXIT受領確認を送信しました。")
-                    except Exception as e:
-                        print(f"[ACK送信失敗] {e}")
-                    root.quit()                              # GUIを終了
-                    break                                    # スレッドを終了
-        except Exception:
-            break                                            # エラー発生時はスレッド終了
-
-def send_command(command):                                   # コマンドをBlackBoardへ送信する関数
+    try:
+        for msg_type, sender, content in iter_frames(s):      # フレーム単位で受信
+            if msg_type == MSG_EXIT:                         # EXITを受信した場合
+                print("[終了指示] EXITを受信しました。ACKを返して終了します。")
+                try:
+                    send_frame(s, MSG_ACK, "", "EXIT_RECEIVED")  # BlackBoardへACKを送信
+                    print("[ACK送信] EXIT受領確認を送信しました。")
+                except Exception as e:
+                    print(f"[ACK送信失敗] {e}")
+                root.quit()                                  # GUIを終了
+                break                                        # スレッドを終了
+            elif msg_type == MSG_ERROR:
+                print(f"[BlackBoard→CmdClient] {content}")   # エラー通知をコンソール表示
+            else:
+                print(f"[BlackBoard→CmdClient] {sender}: {content}")  # 受信メッセージをコンソール表示
+    except Exception:
+        pass                                                 # エラー発生時はスレッド終了
+
+def send_command(command):                                   # コマンド（"宛先;内容"）をBlackBoardへ送信する関数
     if s:
         try:
-            s.send(command.encode())                         # コマンド送信
+            target, content = command.split(";", 1)          # 宛先と内容を分割
+            send_frame(s, MSG_ROUTE, target, content)        # コマンド送信
             response_label.config(text=f"Sent: {command}")   # GUIに送信結果を表示
         except Exception as e:
             response_label.config(text=f"[エラー] 送信失敗: {e}")  # 送信エラーをGUIに表示
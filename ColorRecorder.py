@@ -0,0 +1,73 @@
+# ColorRecorder.py
+
+# 再生用のカラー映像（オーバーレイを描く前のフレーム）を記録するレコーダ。
+# mp4のエンコード（1280x720で1フレーム10ms以上）をキャプチャ段で行うとカメラからの遅延が増えるため、
+# DepthRecorder と同じく、write() はキューに積むだけにしてエンコードと書き込みは記録スレッドで行う。
+#
+# 出力ファイル（base_path に拡張子を付けたもの）:
+#   .mp4      … 書き込めたフレームだけを記録順に並べたカラー映像
+#   .mp4.idx  … mp4のフレームごとの固定長インデックス（INDEX_DTYPE）。k番目のレコードがmp4のk番目のフレーム。
+# キューが満杯で捨てたフレームはmp4にもインデックスにも載らない。再生側はインデックスの frame_index で深度と対応付ける。
+
+import os                                         # ファイルサイズ取得用
+import queue                                      # 記録スレッドへの受け渡し用
+import threading                                  # 記録スレッド用
+import cv2                                        # mp4の書き込み・読み込み用
+import numpy as np                                # インデックスの読み書き用
+
+INDEX_DTYPE = np.dtype([
+    ("frame_index", "<i8"),                       # VisionManagerのフレーム番号
+    ("timestamp_ms", "<f8"),                      # RealSenseのフレームタイムスタンプ（ミリ秒）
+])
+
+class ColorRecorder:
+    """
+    カラーフレームのレコーダ。write() はキューに積むだけで、エンコードと書き込みは記録スレッドで行う。
+    エンコードが追いつかずキューが満杯になった場合はフレームを捨てて数える。
+    """
+    def __init__(self, base_path, width, height, fps, max_queue=30):
+        self.path = base_path + ".mp4"
+        self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        self.index_file = open(self.path + ".idx", "wb")
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.frames = 0                           # 記録したフレーム数
+        self.dropped = 0                          # 記録できずに捨てたフレーム数
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame_index, timestamp_ms, image):  # カラーフレームを記録キューに積む（ブロックしない）
+        try:
+            self.queue.put_nowait((frame_index, timestamp_ms, image))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):                              # 残りのフレームを書き出してファイルを閉じる
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.release()
+        self.index_file.close()
+
+    def summary(self):                            # 記録結果の集計文字列
+        return f"{self.frames} フレーム, 破棄 {self.dropped}"
+
+    def _run(self):                               # 記録スレッド
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame_index, timestamp_ms, image = item
+            self.writer.write(image)
+            self.index_file.write(np.array([(frame_index, timestamp_ms)], INDEX_DTYPE).tobytes())
+            self.frames += 1
+            if self.queue.empty():                # 溜まっていなければ都度フラッシュして異常終了に備える
+                self.index_file.flush()
+
+def read_color_index(path):
+    """
+    mp4（path）のインデックスを返す。インデックスが無ければNone。
+    """
+    index_path = path + ".idx"
+    if not os.path.exists(index_path):
+        return None
+    count = os.path.getsize(index_path) // INDEX_DTYPE.itemsize  # 途中で途切れたレコードは無視
+    return np.fromfile(index_path, INDEX_DTYPE, count=count)
@@ -0,0 +1,173 @@
+# DepthRecorder.py
+
+# RealSenseの深度フレーム（z16, 16bit, 単位はデバイスの depth scale、D435の既定は1mm）を
+# 可逆圧縮でそのまま記録するレコーダ。カラーマップ化・非可逆なmp4と違い、元の深度値を完全に復元できる。
+#
+# 出力ファイル（base_path に拡張子を付けたもの）:
+#   .depth      … フレームデータ。各フレームを横帯（バンド）に分け、帯ごとに独立して圧縮したチャンクを連結したもの。
+#                  [各チャンクのバイト数 uint32 × バンド数][チャンク0][チャンク1]...
+#   .depth.idx  … フレームごとの固定長インデックス（numpy.memmapでそのまま開ける）。INDEX_DTYPE を参照。
+#   .depth.json … 幅・高さ・圧縮方式などのメタデータ。extra_metadata を渡した場合はその項目も含む（カメラのパラメータ等）。
+#                  閉じるときに記録したフレーム数（"frames"）と、キューが満杯で捨てたフレーム数（"dropped"）を追記する。
+#
+# 捨てたフレームは .depth.idx に載らないため、レコードの位置はフレーム番号と一致しない。
+# 読み出し側は位置ではなく frame_index で対応付ける（DepthRecording.position()）。
+#
+# 圧縮方式:
+#   "zlib" … 横方向の差分 → 上位/下位バイト分離 → zlib(RLE, レベル1)。バンドごとにスレッドプールで並列に圧縮する（zlibはGILを解放する）。
+#   "none" … 無圧縮。.depth 自体もmemmapで直接参照できる。
+
+import json                                       # メタデータ出力用
+import os                                         # ファイルサイズ取得用
+import queue                                      # 記録スレッドへの受け渡し用
+import struct                                     # チャンク長の書き込み用
+import threading                                  # 記録スレッド用
+import time                                       # 圧縮時間計測用
+import zlib                                       # 可逆圧縮用
+from concurrent.futures import ThreadPoolExecutor # バンドの並列圧縮用
+import numpy as np                                # 深度配列の変換用
+
+INDEX_DTYPE = np.dtype([
+    ("frame_index", "<i8"),                       # VisionManagerのフレーム番号
+    ("timestamp_ms", "<f8"),                      # RealSenseのフレームタイムスタンプ（ミリ秒）
+    ("offset", "<u8"),                            # .depth 内の先頭位置
+    ("nbytes", "<u4"),                            # .depth 内のバイト数
+    ("num_chunks", "<u4"),                        # バンド（チャンク）数
+])
+CODECS = ("zlib", "none")
+
+def _encode_band(band, codec, level):             # 1バンドを圧縮する
+    if codec == "none":
+        return band.tobytes()
+    delta = np.diff(band, axis=1, prepend=np.zeros((band.shape[0], 1), np.uint16))  # 横方向の差分（uint16の桁あふれで可逆）
+    shuffled = delta.view(np.uint8).reshape(-1, 2).T.tobytes()                        # 上位バイト列と下位バイト列に分離
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, zlib.Z_RLE)
+    return compressor.compress(shuffled) + compressor.flush()
+
+def _decode_band(data, rows, width, codec):        # 1バンドを復元する
+    if codec == "none":
+        return np.frombuffer(data, np.uint16).reshape(rows, width)
+    shuffled = np.frombuffer(zlib.decompress(data), np.uint8).reshape(2, -1)
+    delta = np.ascontiguousarray(shuffled.T).view(np.uint16).reshape(rows, width)
+    return np.cumsum(delta, axis=1, dtype=np.uint16)                                   # 差分を積算して元に戻す
+
+def _band_rows(height, bands):                    # 各バンドの行範囲
+    edges = np.linspace(0, height, bands + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+class DepthRecorder:
+    """
+    深度フレームの可逆レコーダ。write() はキューに積むだけで、圧縮と書き込みは記録スレッドで行う。
+    ディスクや圧縮が追いつかずキューが満杯になった場合はフレームを捨てて数え、閉じるときにメタデータへ書く。
+    """
+    def __init__(self, base_path, width, height, codec="zlib", level=1, bands=4, workers=None, max_queue=30, extra_metadata=None):
+        if codec not in CODECS:
+            raise ValueError(f"未対応の圧縮方式です: {codec}")
+        self.base_path = base_path
+        self.width, self.height = width, height
+        self.codec, self.level = codec, level
+        self.bands = _band_rows(height, bands)
+        self.pool = ThreadPoolExecutor(max_workers=workers or min(bands, os.cpu_count() or 1))
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.frames = 0                           # 記録したフレーム数
+        self.dropped = 0                          # 記録できずに捨てたフレーム数
+        self.bytes_in = 0                         # 圧縮前の合計バイト数
+        self.bytes_out = 0                        # 圧縮後の合計バイト数
+        self.encode_time = 0.0                    # 圧縮に費やした合計時間（秒、壁時計）
+
+        self.metadata = {"width": width, "height": height, "dtype": "uint16", "codec": codec,
+                         "level": level, "bands": [list(map(int, rows)) for rows in self.bands],
+                         "index_dtype": INDEX_DTYPE.descr, **(extra_metadata or {})}
+        self._write_metadata()
+        self.data_file = open(base_path + ".depth", "wb")
+        self.index_file = open(base_path + ".depth.idx", "wb")
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame_index, timestamp_ms, depth_image):  # 深度フレームを記録キューに積む（ブロックしない）
+        try:
+            self.queue.put_nowait((frame_index, timestamp_ms, depth_image))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_metadata(self):
+        with open(self.base_path + ".depth.json", "w", encoding="utf-8") as f:
+            json.dump(self.metadata, f, indent=2)
+
+    def close(self):                              # 残りのフレームを書き出してファイルを閉じ、記録・破棄したフレーム数をメタデータに書く
+        self.queue.put(None)
+        self.thread.join()
+        self.pool.shutdown()
+        self.data_file.close()
+        self.index_file.close()
+        self.metadata.update(frames=self.frames, dropped=self.dropped)
+        self._write_metadata()
+
+    def summary(self):                            # 記録結果の集計文字列
+        if not self.frames:
+            return f"0 フレーム, 破棄 {self.dropped}"
+        return (f"{self.frames} フレーム, 破棄 {self.dropped}, "
+                f"{self.bytes_out / self.frames / 1024:.1f} KiB/frame（圧縮率 {self.bytes_out / self.bytes_in:.2f}）, "
+                f"圧縮 {self.encode_time / self.frames * 1000:.1f} ms/frame")
+
+    def _run(self):                               # 記録スレッド
+        offset = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame_index, timestamp_ms, depth_image = item
+            t0 = time.perf_counter()
+            chunks = list(self.pool.map(
+                lambda rows: _encode_band(depth_image[rows[0]:rows[1]], self.codec, self.level), self.bands))
+            self.encode_time += time.perf_counter() - t0
+            blob = struct.pack(f"<{len(chunks)}I", *map(len, chunks)) + b"".join(chunks)
+            self.data_file.write(blob)
+            record = np.array([(frame_index, timestamp_ms, offset, len(blob), len(chunks))], INDEX_DTYPE)
+            self.index_file.write(record.tobytes())
+            offset += len(blob)
+            self.frames += 1
+            self.bytes_in += depth_image.nbytes
+            self.bytes_out += len(blob)
+            if self.queue.empty():                # 溜まっていなければ都度フラッシュして異常終了に備える
+                self.data_file.flush()
+                self.index_file.flush()
+
+class DepthRecording:
+    """
+    DepthRecorder で記録したファイルを読み出す。index はmemmapされたフレームごとのインデックス。
+    記録中に捨てたフレームは index に無いため、フレーム番号からは position() で位置を求める。
+    dropped は記録時に捨てたフレーム数（閉じずに終了した記録や古い記録ではNone）。
+    """
+    def __init__(self, base_path):
+        with open(base_path + ".depth.json", "r", encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        self.width, self.height = self.metadata["width"], self.metadata["height"]
+        self.codec = self.metadata["codec"]
+        self.bands = self.metadata["bands"]
+        self.dropped = self.metadata.get("dropped")
+        index_path = base_path + ".depth.idx"
+        count = os.path.getsize(index_path) // INDEX_DTYPE.itemsize  # 途中で途切れたレコードは無視
+        self.index = np.memmap(index_path, INDEX_DTYPE, mode="r", shape=(count,)) if count else np.zeros(0, INDEX_DTYPE)
+        self.data = np.memmap(base_path + ".depth", np.uint8, mode="r") if count else np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def position(self, frame_index):              # フレーム番号 frame_index のレコードの位置（記録されていなければNone）
+        i = int(np.searchsorted(self.index["frame_index"], frame_index))  # フレーム番号は記録順に増える
+        if i < len(self.index) and self.index[i]["frame_index"] == frame_index:
+            return i
+        return None
+
+    def read(self, i):                            # i番目のフレームを uint16 の (高さ, 幅) 配列で返す
+        entry = self.index[i]
+        blob = self.data[int(entry["offset"]):int(entry["offset"]) + int(entry["nbytes"])]
+        num_chunks = int(entry["num_chunks"])
+        lengths = struct.unpack_from(f"<{num_chunks}I", blob)
+        pos = 4 * num_chunks
+        bands = []
+        for (start, end), length in zip(self.bands, lengths):
+            bands.append(_decode_band(blob[pos:pos + length].tobytes(), end - start, self.width, self.codec))
+            pos += length
+        return np.vstack(bands)
@@ -0,0 +1,171 @@
+# FrameSource.py
+
+# VisionManagerにカラー・深度フレームを供給するフレームソース。
+#   RealSenseSource  … 接続中のRealSense（ライブ）、または .bag ファイルの再生
+#   RecordingSource  … VisionManagerが記録した再生用のカラーmp4と深度の可逆記録（DepthRecorder）の再生
+# どのソースも start() / read() / stop() を持ち、read() はフレーム辞書（終端ではNone）を返す。
+# RecordingSource と pyrealsense2 未導入の環境でも使えるよう、pyrealsense2 は RealSenseSource の中でだけ読み込む。
+# start() の後の geometry は、カラー・深度カメラのパラメータ（CameraGeometry、取得できない場合はNone）。
+
+import os                                         # 記録ファイルの確認用
+import time                                       # 再生速度の調整用
+import cv2                                        # 記録済みカラー映像の読み込み用
+import numpy as np                                # フレームのNumPy配列化用
+from DepthRecorder import DepthRecording          # 深度の可逆記録の読み込み用
+from ColorRecorder import read_color_index        # 再生用のカラー映像のインデックスの読み込み用
+from CameraGeometry import CameraGeometry         # カラー・深度カメラのパラメータ
+
+def safe_wait_for_frames(pipeline, max_retries=5):  # フレーム取得をリトライ付きで行う関数
+    for i in range(max_retries):                    # 最大max_retries回までリトライ
+        try:
+            return pipeline.wait_for_frames()       # フレームを取得
+        except RuntimeError as e:                   # 取得に失敗した場合
+            print(f"[警告] フレームの取得に失敗（{i+1}/{max_retries}）: {e}")  # 警告を表示
+            time.sleep(0.5)                         # 0.5秒待って再試行
+    raise RuntimeError("フレーム取得に連続で失敗しました。")  # 最大リトライを超えた場合は例外を送出
+
+class RealSenseSource:
+    """
+    RealSenseのライブ映像、または bag_path を指定した場合は .bag ファイルの再生。
+    realtime=False の .bag 再生は記録時の速度に縛られず、処理できる最大速度でフレームを供給する。
+    serial を指定した場合はそのシリアル番号のカメラを使う（複数台接続時）。
+    """
+    def __init__(self, width, height, fps, bag_path=None, realtime=True, serial=None):
+        self.width, self.height, self.fps = width, height, fps
+        self.bag_path = bag_path
+        self.serial = serial
+        self.live = bag_path is None              # ライブ映像ならTrue（後段が遅い場合はフレームを捨てる）
+        self.realtime = realtime or self.live
+        self.pipeline = None
+        self.playback = None
+        self.geometry = None
+
+    def start(self):
+        import pyrealsense2 as rs                 # Intel RealSense用Pythonラッパー（RealSense使用時のみ必要）
+        self.rs = rs
+        self.pipeline = rs.pipeline()             # RealSense用のパイプラインを作成
+        config = rs.config()                      # RealSense用設定オブジェクトを作成
+        if self.bag_path:
+            config.enable_device_from_file(self.bag_path, repeat_playback=False)  # .bagファイルから再生
+        elif self.serial:
+            config.enable_device(self.serial)     # 指定したカメラだけを使う
+        config.enable_stream(rs.stream.color, self.width, self.height, rs.format.bgr8, self.fps)  # カラーストリーム設定
+        config.enable_stream(rs.stream.depth, self.width, self.height, rs.format.z16, self.fps)   # 深度ストリーム設定
+        profile = self.pipeline.start(config)     # RealSenseパイプラインを開始する
+        try:
+            self.geometry = CameraGeometry.from_realsense_profile(profile)  # 内部・外部パラメータは起動時に1回だけ取得する
+        except Exception as e:
+            print(f"[警告] カメラのパラメータを取得できません（深度の位置合わせを行いません）: {e}")
+        if self.bag_path:
+            self.playback = profile.get_device().as_playback()
+            self.playback.set_real_time(self.realtime)  # Falseなら記録時の速度を無視して読み出す
+
+    def read(self):                               # 次のフレームを返す（.bagの終端ではNone）
+        while True:
+            if self.playback is not None:
+                ok, frames = self.pipeline.try_wait_for_frames(1000)
+                if not ok:
+                    if self.playback.current_status() == self.rs.playback_status.stopped:
+                        return None               # .bagの終端
+                    continue
+            else:
+                frames = safe_wait_for_frames(self.pipeline)  # RealSenseからフレームを取得
+            color_frame = frames.get_color_frame()       # カラーフレームを取得
+            depth_frame = frames.get_depth_frame()       # 深度フレームを取得
+            if not color_frame or not depth_frame:       # いずれかのフレームが無効な場合はスキップ
+                continue
+            frames.keep()                                # 後段で使い終わるまでフレームバッファを保持する
+            return {
+                "timestamp_ms": depth_frame.get_timestamp(),           # RealSenseのフレームタイムスタンプ（ミリ秒）
+                "image": np.asanyarray(color_frame.get_data()),        # カラーフレームをNumPy配列に変換
+                "depth_image": np.asanyarray(depth_frame.get_data()),  # 深度フレームをNumPy配列に変換
+            }
+
+    def stop(self):
+        if self.pipeline:
+            self.pipeline.stop()                  # RealSenseパイプラインを停止する
+
+class RecordingSource:
+    """
+    VisionManagerの記録（log{N}_colorRaw.mp4 と log{N}_depthRaw.depth）を再生する。
+    log_prefix には "Log/VideoLog/log3" のように拡張子・種別を除いたパスを渡す。
+    colorRaw.mp4 の各フレームのフレーム番号をインデックス（.mp4.idx）から読み、深度のインデックスの frame_index で対応付ける
+    （カラー・深度のどちらかの記録で捨てたフレームは飛ばす）。
+    colorRaw.mp4 が無い古い記録では、オーバーレイが描き込まれた colorVideo.mp4 を深度と記録順に対応付ける
+    （描画段でフレームを捨てていると、カラーと深度がずれる）。
+    """
+    def __init__(self, log_prefix, realtime=False):
+        self.color_path = f"{log_prefix}_colorRaw.mp4"
+        self.by_frame_index = os.path.exists(self.color_path)  # Falseなら古い記録（記録順に対応付ける）
+        if not self.by_frame_index:
+            self.color_path = f"{log_prefix}_colorVideo.mp4"
+        self.depth_path = f"{log_prefix}_depthRaw"
+        self.live = False
+        self.realtime = realtime                  # Trueなら記録時のタイムスタンプ間隔で再生する
+        self.capture = None
+        self.depth = None
+        self.geometry = None
+
+    def start(self):
+        self.depth = DepthRecording(self.depth_path)
+        self.capture = cv2.VideoCapture(self.color_path)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"カラー映像を開けません: {self.color_path}")
+        self.width, self.height = self.depth.width, self.depth.height
+        if "camera_geometry" in self.depth.metadata:  # 記録時のカメラのパラメータ（古い記録には無い）
+            self.geometry = CameraGeometry.from_dict(self.depth.metadata["camera_geometry"])
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30
+        self.color_frames = read_color_index(self.color_path) if self.by_frame_index else None  # カラーフレームごとのフレーム番号
+        self.color_position = 0                   # 次に読むカラーフレームの位置
+        self.start_time = None
+        if not self.by_frame_index:
+            print(f"[入力] {self.color_path} はオーバーレイ入りの古い記録です。深度とは記録順に対応付けます。")
+        elif self.depth.dropped:
+            print(f"[入力] 深度の記録で捨てた {self.depth.dropped} フレームは飛ばして再生します。")
+
+    def read(self):                               # 次のフレームを返す（終端ではNone）
+        while True:
+            ok, image = self.capture.read()
+            if not ok:
+                return None
+            frame_index = self.color_position
+            if self.color_frames is not None:     # インデックスが無い記録ではk番目のフレームをフレーム番号kとみなす
+                if self.color_position >= len(self.color_frames):
+                    return None
+                frame_index = int(self.color_frames[self.color_position]["frame_index"])
+            self.color_position += 1
+            position = self.depth.position(frame_index) if self.by_frame_index else frame_index
+            if position is not None and position < len(self.depth):
+                break                             # 深度が記録されていないフレームは飛ばす
+            if not self.by_frame_index:
+                return None
+        timestamp_ms = float(self.depth.index[position]["timestamp_ms"])
+        depth_image = self.depth.read(position)
+        if self.realtime:                         # 記録時の間隔に合わせて待つ
+            if self.start_time is None:
+                self.start_time = (time.perf_counter(), timestamp_ms)
+            wait = (timestamp_ms - self.start_time[1]) / 1000 - (time.perf_counter() - self.start_time[0])
+            if wait > 0:
+                time.sleep(wait)
+        return {"timestamp_ms": timestamp_ms, "image": image, "depth_image": depth_image}
+
+    def stop(self):
+        if self.capture:
+            self.capture.release()
+
+def list_realsense_devices():                     # 接続中のRealSenseのシリアル番号のリスト
+    import pyrealsense2 as rs
+    return [device.get_info(rs.camera_info.serial_number) for device in rs.context().query_devices()]
+
+def create_frame_source(kind, path, width, height, fps, realtime=True):
+    """
+    設定値からフレームソースを作る。
+      kind: "realsense"（ライブ）, "bag"（pathの.bagを再生）, "recording"（pathの記録を再生）
+    """
+    if kind == "realsense":
+        return RealSenseSource(width, height, fps)
+    if kind == "bag":
+        return RealSenseSource(width, height, fps, bag_path=path, realtime=realtime)
+    if kind == "recording":
+        return RecordingSource(path, realtime=realtime)
+    raise ValueError(f"未対応のフレームソースです: {kind}")
@@ -0,0 +1,159 @@
+# HandFilter.py
+
+# 手のランドマークの時間方向の平滑化と、推論しないフレームでの位置の予測。
+# MediaPipeの結果はフレームごとに独立しているため、ランドマークや深度が細かく揺れる。
+# 手ごとに One Euro Filter（動きが遅いときは強く、速いときは弱く平滑化するローパスフィルタ）をかけ、
+# フィルタが推定した速度で、推論しなかったフレームの位置を等速運動として予測する。
+#
+# 手の同一性は、左右判定が同じで、前の位置（ランドマークの重心）に最も近い検出を同じ手とみなして追跡する。
+# smoothing=False では平滑化せずに検出・測定値をそのまま返し、推論しなかったフレームの予測だけを行う（推論の間引きだけを使う場合）。
+# 時刻はカメラのタイムスタンプ（秒）を使うため、記録を最大速度で再生しても結果は変わらない。
+#
+# 参考: Casiez et al., "1€ Filter: A Simple Speed-based Low-pass Filter for Noisy Input in Interactive Systems" (CHI 2012)
+
+import math                                       # 平滑化係数の計算用
+import numpy as np                                # ランドマークをまとめてフィルタするため
+
+class OneEuroFilter:
+    """
+    配列の要素ごとに One Euro Filter をかける。min_cutoff[Hz] は静止時の遮断周波数、
+    beta は速度（単位/秒）に応じて遮断周波数を上げる係数、d_cutoff[Hz] は速度の推定に使う遮断周波数。
+    NaN の要素（無効な測定）は予測値で置き換え、まだ値が無い要素はNaNのまま返す。
+    """
+    def __init__(self, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        self.min_cutoff, self.beta, self.d_cutoff = min_cutoff, beta, d_cutoff
+        self.value = None                         # 平滑化した値
+        self.velocity = None                      # 平滑化した速度（単位/秒）
+        self.t = None                             # 最後に更新した時刻（秒）
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def predict(self, t):                         # 時刻 t の値を等速運動で予測する（状態は変えない）
+        if self.value is None:
+            return None
+        return self.value + self.velocity * max(0.0, t - self.t)
+
+    def __call__(self, x, t):                     # 測定値 x（時刻 t）で更新し、平滑化した値を返す
+        x = np.asarray(x, np.float64)
+        if self.value is None:
+            self.value, self.velocity, self.t = x.copy(), np.zeros_like(x), t
+            return self.value.copy()
+        dt = t - self.t
+        if dt <= 0:                               # 同じ時刻（または古い時刻）の測定では更新しない
+            return self.value.copy()
+        unset = np.isnan(self.value)              # これまで無効だった要素は最初の有効な値から始める
+        x = np.where(np.isnan(x), self.value + self.velocity * dt, x)  # 無効な測定は予測値で補う
+        self.value = np.where(unset, x, self.value)
+        velocity = np.where(unset, 0.0, (x - self.value) / dt)
+        self.velocity += self._alpha(self.d_cutoff, dt) * (velocity - self.velocity)
+        cutoff = self.min_cutoff + self.beta * np.abs(self.velocity)
+        tau = 1.0 / (2 * math.pi * cutoff)
+        self.value += (x - self.value) / (1.0 + tau / dt)
+        self.t = t
+        return self.value.copy()
+
+class HandTrack:
+    """
+    追跡中の手1つ分。ランドマークのピクセル座標・深度・3次元座標をそれぞれフィルタする。
+    """
+    def __init__(self, track_id, handedness, score, params):
+        self.id = track_id
+        self.handedness = handedness
+        self.score = score
+        self.pixels = OneEuroFilter(**params)     # カラー画像上の座標（21×2, ピクセル）
+        self.depths = OneEuroFilter(**params)     # ランドマークの深度（21, mm）
+        self.points = OneEuroFilter(**params)     # 深度カメラ座標系の3次元座標（21×3, mm）
+        self.last_inference = None                # 最後に推論で見つかった時刻（秒）
+
+    def center(self, t):                          # 時刻 t のランドマークの重心（予測）
+        return self.pixels.predict(t).mean(axis=0)
+
+class HandTracker:
+    """
+    フレームごとの検出結果を手の同一性で対応付け、手ごとにフィルタをかける。
+    推論したフレームでは update()、推論しなかったフレームでは predict() でピクセル座標を求め、
+    その位置で読んだ深度・3次元座標を smooth_measurements() でフィルタする。
+    smoothing=False では update() は検出した座標を、smooth_measurements() は深度・3次元座標をそのまま返す
+    （座標のフィルタは遮断周波数を無限大にして、予測に使う速度の推定だけに使う）。
+    """
+    def __init__(self, min_cutoff=1.0, beta=0.01, d_cutoff=1.0, match_distance=150.0, max_prediction=0.2, smoothing=True):
+        self.smoothing = smoothing
+        if smoothing:
+            self.params = {"min_cutoff": min_cutoff, "beta": beta, "d_cutoff": d_cutoff}
+        else:                                     # 値は測定値に一致させ、速度だけを推定する
+            self.params = {"min_cutoff": math.inf, "beta": 0.0, "d_cutoff": d_cutoff}
+        self.match_distance = match_distance      # 同じ手とみなす重心の最大移動量（ピクセル）
+        self.max_prediction = max_prediction      # 推論せずに位置を予測し続ける最大秒数
+        self.tracks = []                          # 追跡中の手（出力の並び順）
+        self.next_id = 0
+
+    def _match(self, centers, handedness, t):     # 検出ごとに対応する追跡中の手（無ければNone）を返す
+        pairs = []
+        for i, (center, label) in enumerate(zip(centers, handedness)):
+            for track in self.tracks:
+                if track.handedness == label:
+                    distance = float(np.linalg.norm(track.center(t) - center))
+                    if distance <= self.match_distance:
+                        pairs.append((distance, i, track))
+        matched, used = [None] * len(centers), set()
+        for distance, i, track in sorted(pairs, key=lambda pair: pair[0]):  # 近い組から順に確定する
+            if matched[i] is None and track.id not in used:
+                matched[i] = track
+                used.add(track.id)
+        return matched
+
+    def update(self, color_pixels, handedness, scores, t):
+        """
+        推論結果（手の数×21×2 のカラー画像上の座標, 左右判定, 信頼度）で追跡を更新し、平滑化した座標を返す。
+        見つからなかった手の追跡は終える。
+        """
+        matched = self._match(color_pixels.mean(axis=1), handedness, t)
+        tracks, smoothed = [], []
+        for pixels, label, score, track in zip(color_pixels, handedness, scores, matched):
+            if track is None:
+                track = HandTrack(self.next_id, label, score, self.params)
+                self.next_id += 1
+            track.score = score
+            track.last_inference = t
+            smoothed.append(track.pixels(pixels, t))
+            tracks.append(track)
+        self.tracks = tracks
+        if not self.smoothing:
+            return self._stack(list(color_pixels), (0, 21, 2))
+        return self._stack(smoothed, (0, 21, 2))
+
+    def predict(self, t):
+        """
+        推論しなかったフレームの各手の座標を予測して返す。max_prediction 秒以上推論で見つかっていない手は追跡を終える。
+        """
+        self.tracks = [track for track in self.tracks if t - track.last_inference <= self.max_prediction]
+        return self._stack([track.pixels.predict(t) for track in self.tracks], (0, 21, 2))
+
+    def smooth_measurements(self, depths, points, t):  # 現在の手の並びで、深度（手の数×21）と3次元座標（手の数×21×3）をフィルタする
+        if not self.smoothing:
+            return depths, points
+        depths = self._stack([track.depths(d, t) for track, d in zip(self.tracks, depths)], (0, 21))
+        points = self._stack([track.points(p, t) for track, p in zip(self.tracks, points)], (0, 21, 3))
+        return depths, points
+
+    @property
+    def handedness(self):
+        return [track.handedness for track in self.tracks]
+
+    @property
+    def scores(self):
+        return [track.score for track in self.tracks]
+
+    @property
+    def ids(self):
+        return [track.id for track in self.tracks]
+
+    def reset(self):                              # 手を見失った（推論を省略した）ときに追跡を終える
+        self.tracks = []
+
+    @staticmethod
+    def _stack(arrays, empty_shape):
+        return np.stack(arrays).astype(np.float32) if arrays else np.zeros(empty_shape, np.float32)
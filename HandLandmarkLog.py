@@ -0,0 +1,208 @@
+# HandLandmarkLog.py
+
+# 手ランドマークログをセッション中に逐次ファイルへ書き出すバックグラウンドライター。
+# フレームごとの記録はキューに積むだけで、変換・書き込みは専用スレッドが行う。
+# 一定間隔でファイルへフラッシュし、一定サイズでファイルを切り替えるため、
+# 長時間のセッションでもメモリ使用量は一定で、異常終了してもそれまでの記録は残る。
+#
+# 形式:
+#   "columnar" (既定) … 列指向のバイナリ形式（.hlm）。
+#       ファイル先頭: [b"HLM1"][メタデータ長 uint32][メタデータ JSON]
+#       以降チャンクの繰り返し: [b"HLMC"][フレーム数 uint32][手の総数 uint32] に続けて下記の列
+#         frame_index int64[F], timestamp float64[F]（UNIX時刻）, hand_count uint8[F], min_depth float32[F],
+#         handedness uint8[H]（0=Left, 1=Right）, score float32[H], hand_min_depth float32[H],
+#         pixels int16[H,21,2], depths float32[H,21]（無効はNaN）
+#   "ndjson" … 1行目にメタデータ、以降1フレーム1行のJSON（従来のJSONログと同じフレーム構造）。
+
+import json                                       # メタデータ・NDJSON出力用
+import queue                                      # 書き込みスレッドへの受け渡し用
+import struct                                     # チャンクヘッダ用
+import threading                                  # 書き込みスレッド用
+import time                                       # フラッシュ間隔・時刻変換用
+import numpy as np                                # 列データ変換用
+
+FILE_MAGIC = b"HLM1"
+CHUNK_HEADER = struct.Struct("<4sII")             # マジック, フレーム数, 手の総数
+CHUNK_MAGIC = b"HLMC"
+HANDEDNESS_CODES = {"Left": 0, "Right": 1}        # 左右判定の符号化
+HANDEDNESS_LABELS = {code: label for label, code in HANDEDNESS_CODES.items()}
+EXTENSIONS = {"columnar": ".hlm", "ndjson": ".ndjson"}
+
+class HandLandmarkLogWriter:
+    """
+    手ランドマークログのバックグラウンドライター。
+    write() はキューに積むだけなので、フレーム処理側をブロックしない。
+    """
+    def __init__(self, base_path, image_resolution, log_format="columnar",
+                 flush_interval=1.0, rotate_bytes=64 * 1024 * 1024, max_queue=1024):
+        if log_format not in EXTENSIONS:
+            raise ValueError(f"未対応のログ形式です: {log_format}")
+        self.base_path = base_path                # 拡張子・パート番号を除いた出力ファイルパス
+        self.metadata = {"image_resolution": image_resolution, "format": log_format, "format_version": 1}
+        self.log_format = log_format
+        self.flush_interval = flush_interval      # ファイルへフラッシュする間隔（秒）
+        self.rotate_bytes = rotate_bytes          # このサイズを超えたら次のファイルに切り替える
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0                          # キューが満杯で記録できなかったフレーム数
+        self.written = 0                          # 書き込んだフレーム数
+        self.part = 0                             # 現在のファイル番号
+        self.file = None
+        self.paths = []                           # 書き出したファイルの一覧
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame_index, timestamp, hand_arrays):
+        """
+        1フレーム分の記録を積む。hand_arrays は VisionManager.extract_hand_arrays() の戻り値。
+        キューが満杯（ディスクが追いつかない）の場合は記録を捨てて数える。
+        """
+        try:
+            self.queue.put_nowait((frame_index, timestamp, hand_arrays))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):                              # 残りの記録を書き出してファイルを閉じる
+        self.queue.put(None)
+        self.thread.join()
+
+    # --- 以下は書き込みスレッド内でのみ呼ばれる ---
+    def _open_next(self):
+        self.part += 1
+        path = f"{self.base_path}_part{self.part}{EXTENSIONS[self.log_format]}"
+        self.file = open(path, "wb")
+        self.paths.append(path)
+        metadata = json.dumps(self.metadata, ensure_ascii=False).encode()
+        if self.log_format == "columnar":
+            self.file.write(FILE_MAGIC + struct.pack("<I", len(metadata)) + metadata)
+        else:
+            self.file.write(metadata + b"\n")
+
+    def _run(self):
+        self._open_next()
+        pending = []
+        next_flush = time.monotonic() + self.flush_interval
+        closing = False
+        while not closing:
+            try:
+                item = self.queue.get(timeout=max(0.0, next_flush - time.monotonic()))
+                if item is None:
+                    closing = True
+                else:
+                    pending.append(item)
+            except queue.Empty:
+                pass
+            if closing or time.monotonic() >= next_flush:
+                if pending:
+                    if self.file is None:         # 前のファイルがサイズ上限に達していれば次のファイルを開く
+                        self._open_next()
+                    self._write_records(pending)
+                    self.written += len(pending)
+                    pending = []
+                    self.file.flush()             # 異常終了しても直前のフラッシュまでは残る
+                    if self.file.tell() >= self.rotate_bytes:
+                        self.file.close()
+                        self.file = None
+                next_flush = time.monotonic() + self.flush_interval
+        if self.file:
+            self.file.close()
+
+    def _write_records(self, records):
+        if self.log_format == "columnar":
+            self.file.write(encode_columnar_chunk(records))
+        else:
+            self.file.write("".join(encode_ndjson_line(record) for record in records).encode())
+
+def _frame_min_depth(min_depths):                  # フレーム内で最も近い手の深度（無ければNaN）
+    valid = min_depths[~np.isnan(min_depths)]
+    return valid.min() if len(valid) else np.nan
+
+def encode_columnar_chunk(records):                # 複数フレーム分の記録を1チャンクの列データに変換する
+    all_arrays = [arrays for _, _, arrays in records]
+    hand_counts = [len(arrays["min_depths"]) for arrays in all_arrays]
+    columns = [
+        np.array([frame_index for frame_index, _, _ in records], "<i8"),
+        np.array([timestamp for _, timestamp, _ in records], "<f8"),
+        np.array(hand_counts, "u1"),
+        np.array([_frame_min_depth(arrays["min_depths"]) for arrays in all_arrays], "<f4"),
+        np.array([HANDEDNESS_CODES.get(label, 255) for arrays in all_arrays for label in arrays["handedness"]], "u1"),
+        np.array([score for arrays in all_arrays for score in arrays["scores"]], "<f4"),
+        np.concatenate([arrays["min_depths"] for arrays in all_arrays]).astype("<f4"),
+        np.concatenate([arrays["pixels"] for arrays in all_arrays]).astype("<i2"),
+        np.concatenate([arrays["depths"] for arrays in all_arrays]).astype("<f4"),
+    ]
+    return CHUNK_HEADER.pack(CHUNK_MAGIC, len(records), sum(hand_counts)) + b"".join(column.tobytes() for column in columns)
+
+def hand_arrays_to_dicts(hand_arrays):
+    """
+    配列形式の手情報を、各手のhand_id, handedness, confidence, landmarks情報を含む辞書リストに変換する。
+    NDJSONログなど辞書形式が必要な場合にのみ呼び出す。
+    """
+    all_hands_data = []                            # 全ての手データを格納するリスト
+    depths = hand_arrays["depths"].tolist()
+    pixels = hand_arrays["pixels"].tolist()
+    in_frame = hand_arrays["in_frame"].tolist()
+    for i, min_depth in enumerate(hand_arrays["min_depths"].tolist()):
+        landmarks_list = [                         # この手のランドマーク情報リスト
+            {
+                "landmark_id": idx,
+                "pixel_x": px,
+                "pixel_y": py,
+                "depth": d if inside and d == d else None   # 画像外・無効（NaN）の場合はNone
+            }
+            for idx, ((px, py), d, inside) in enumerate(zip(pixels[i], depths[i], in_frame[i]))
+        ]
+        all_hands_data.append({                    # 手情報を辞書にまとめる
+            "hand_id": i,
+            "handedness": hand_arrays["handedness"][i],
+            "hand_confidence": hand_arrays["scores"][i],
+            "min_depth": min_depth if min_depth == min_depth else None,
+            "landmarks": landmarks_list
+        })
+    return all_hands_data
+
+def encode_ndjson_line(record):                    # 1フレーム分の記録を従来のJSONログと同じ構造の1行にする
+    frame_index, timestamp, arrays = record
+    frame_log = {
+        "frame_index": frame_index,                                                  # フレーム番号
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp)),  # フレームのタイムスタンプ
+        "hands": hand_arrays_to_dicts(arrays),                                       # 検出された手のデータ
+    }
+    return json.dumps(frame_log, ensure_ascii=False) + "\n"
+
+def read_columnar_log(path):
+    """
+    列指向バイナリログを読み出す。(メタデータ, チャンクのジェネレータ) を返す。
+    各チャンクは列名 → NumPy配列の辞書。書き込み途中で途切れた末尾チャンクは無視する。
+    """
+    f = open(path, "rb")
+    if f.read(4) != FILE_MAGIC:
+        f.close()
+        raise ValueError(f"手ランドマークログではありません: {path}")
+    (meta_len,) = struct.unpack("<I", f.read(4))
+    metadata = json.loads(f.read(meta_len))
+
+    def chunks():
+        with f:
+            while True:
+                header = f.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    return
+                magic, num_frames, num_hands = CHUNK_HEADER.unpack(header)
+                if magic != CHUNK_MAGIC:
+                    return
+                layout = [
+                    ("frame_index", "<i8", (num_frames,)), ("timestamp", "<f8", (num_frames,)),
+                    ("hand_count", "u1", (num_frames,)), ("min_depth", "<f4", (num_frames,)),
+                    ("handedness", "u1", (num_hands,)), ("score", "<f4", (num_hands,)),
+                    ("hand_min_depth", "<f4", (num_hands,)),
+                    ("pixels", "<i2", (num_hands, 21, 2)), ("depths", "<f4", (num_hands, 21)),
+                ]
+                chunk = {}
+                for name, dtype, shape in layout:
+                    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                    data = f.read(size)
+                    if len(data) < size:
+                        return                    # 途切れたチャンク
+                    chunk[name] = np.frombuffer(data, dtype).reshape(shape)
+                yield chunk
+    return metadata, chunks()
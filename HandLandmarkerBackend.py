@@ -0,0 +1,67 @@
+# HandLandmarkerBackend.py
+
+# MediaPipe Tasks の HandLandmarker をライブストリームモード（非同期）で使う手検出バックエンド。
+# 従来の mp.solutions.hands.Hands.process() は推論が終わるまで戻らないが、detect_async() はすぐに戻り、
+# 結果はMediaPipeのスレッドからコールバックで届く。推論中に次のフレームの切り出し・色変換・深度判定を進められる。
+# ライブストリームモードでは、推論中に渡したフレームはMediaPipeが捨てる（そのフレームの結果は届かない）。
+#
+# 結果は従来の Hands.process() と同じ形（multi_hand_landmarks / multi_handedness）に変換して渡すため、
+# VisionManager の extract_hand_arrays()・描画・ログ保存はそのまま使える。
+#
+# モデル（hand_landmarker.task）は次のURLから取得し、vision_config.json の "hand_landmarker_model" に置く:
+#   https://storage.googleapis.com/mediapipe-models/hand_landmarker/hand_landmarker/float16/latest/hand_landmarker.task
+
+import os                                         # モデルファイルの確認用
+import mediapipe as mp                            # MediaPipe（Tasks API）
+from mediapipe.tasks.python import BaseOptions, vision
+from mediapipe.framework.formats import landmark_pb2, classification_pb2  # 従来APIと同じ結果の型
+
+class LegacyHandResults:
+    """
+    HandLandmarkerResult を従来の Hands.process() の結果と同じ属性で参照できるようにしたもの。
+    """
+    def __init__(self, result):
+        self.multi_hand_landmarks = [
+            landmark_pb2.NormalizedLandmarkList(landmark=[
+                landmark_pb2.NormalizedLandmark(x=lm.x, y=lm.y, z=lm.z) for lm in hand])
+            for hand in result.hand_landmarks
+        ] or None                                 # 従来APIと同様に、手が無ければNone
+        self.multi_handedness = [
+            classification_pb2.ClassificationList(classification=[
+                classification_pb2.Classification(index=c.index, score=c.score, label=c.category_name) for c in categories])
+            for categories in result.handedness
+        ] or None
+
+class AsyncHandLandmarker:
+    """
+    HandLandmarker（ライブストリームモード）。submit() でRGB画像を渡すと、推論後に on_result(results, timestamp_ms) が
+    MediaPipeのスレッドから呼ばれる（results は LegacyHandResults）。timestamp_ms は呼び出しごとに増加させる。
+    """
+    def __init__(self, model_path, max_num_hands=2, min_detection_confidence=0.5, min_tracking_confidence=0.5):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"HandLandmarkerのモデルがありません: {model_path}")
+        self.model_path = model_path
+        self.options = dict(num_hands=max_num_hands, min_hand_detection_confidence=min_detection_confidence,
+                            min_hand_presence_confidence=min_detection_confidence,
+                            min_tracking_confidence=min_tracking_confidence)
+        self.on_result = None
+        self.landmarker = None
+
+    def __enter__(self):
+        options = vision.HandLandmarkerOptions(
+            base_options=BaseOptions(model_asset_path=self.model_path),
+            running_mode=vision.RunningMode.LIVE_STREAM,
+            result_callback=self._callback,
+            **self.options)
+        self.landmarker = vision.HandLandmarker.create_from_options(options)
+        return self
+
+    def __exit__(self, *exc):
+        self.landmarker.close()                   # 推論中の結果を待ってから閉じる
+
+    def _callback(self, result, output_image, timestamp_ms):
+        if self.on_result:
+            self.on_result(LegacyHandResults(result), timestamp_ms)
+
+    def submit(self, image_rgb, timestamp_ms):    # 推論を依頼してすぐに戻る
+        self.landmarker.detect_async(mp.Image(image_format=mp.ImageFormat.SRGB, data=image_rgb), timestamp_ms)
@@ -0,0 +1,153 @@
+# LatencyTrace.py
+
+# カメラのフレーム取得からサーボへの指令までの遅延を計測するためのトレース。
+# VisionManagerがフレームごとにトレース（フレーム番号をトレースIDとする）を作り、
+# 各プロセスが通過時刻（ホップ）を書き足していく。BehaviorManagerが最後に集計し、終了時に出力する。
+#
+# ホップ（時刻は time.perf_counter() の秒。同一PC内のプロセス間で比較できる）:
+#   cap … VisionManagerがフレームを受け取った時刻
+#   inf … 手検出・深度抽出が終わった時刻
+#   vm  … VisionManagerが送信（共有メモリ書き込み / BlackBoardへの送信）した時刻
+#   bb  … BlackBoardが転送した時刻（TCP経由の場合のみ）
+#   bm  … BehaviorManagerが受け取った時刻
+#   ser … BehaviorManagerの送信スレッドがArduinoへの書き込みを終えた時刻（SerialLink）
+#   ard … ArduinoからのACKをBehaviorManagerが受け取った時刻
+# その他の値:
+#   id  … トレースID（VisionManagerのフレーム番号）
+#   hw  … RealSenseのハードウェアタイムスタンプ（ミリ秒）
+#   cam … RealSenseのタイムスタンプからフレームを受け取るまでの遅延（ミリ秒、ライブ映像のみ）
+#
+# BlackBoard経由のメッセージでは、本文の後ろに "|id=12,hw=...,cap=..." の形でトレースを付ける。
+
+import json                                       # 集計結果の出力用
+import threading                                  # 集計の排他制御用
+import time                                       # ホップ時刻の取得用
+from collections import OrderedDict               # Arduino応答待ちトレースの保持用
+import numpy as np                                # パーセンタイル・ヒストグラム計算用
+
+TRACE_SEPARATOR = "|"                             # 本文とトレースの区切り
+TRACE_MARKER = TRACE_SEPARATOR + "id="            # トレース付きメッセージの目印（トレースは必ずidから始める）
+HOPS = ("cap", "inf", "vm", "bb", "bm", "ser", "ard")  # ホップの順序
+SEGMENT_NAMES = {                                 # 連続するホップ間の区間名
+    "inf": "inference", "vm": "publish", "bb": "blackboard", "bm": "delivery", "ser": "serial_write", "ard": "arduino_reply",
+}
+HISTOGRAM_EDGES_MS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]  # ヒストグラムの区切り（ミリ秒）
+
+def now():                                        # ホップ時刻（秒）
+    return time.perf_counter()
+
+def _format_value(value):
+    return f"{value:.6f}" if isinstance(value, float) else str(value)
+
+def attach_trace(content, trace):                 # 本文にトレースを付ける
+    fields = {"id": trace["id"], **trace}
+    return content + TRACE_SEPARATOR + ",".join(f"{key}={_format_value(value)}" for key, value in fields.items())
+
+def add_hop(content, hop, t=None):                # トレース付きの本文にホップ時刻を書き足す
+    return f"{content},{hop}={now() if t is None else t:.6f}"
+
+def split_trace(content):                         # 本文とトレースに分ける（トレースが無ければ None）
+    index = content.rfind(TRACE_MARKER)
+    if index < 0:
+        return content, None
+    body, fields = content[:index], content[index + len(TRACE_SEPARATOR):]
+    trace = {}
+    for field in fields.split(","):
+        key, _, value = field.partition("=")
+        try:
+            trace[key] = float(value)
+        except ValueError:
+            pass
+    return body, trace
+
+class LatencyStats:
+    """
+    トレースを受け取り、区間ごとと全体（cap → ser, cap → ard）の遅延を集計する。
+    サンプルは区間ごとに最大 max_samples 件まで保持し、それ以降は古いものから上書きする。
+    Arduinoの応答を待つトレースは pending に保持し、応答が来たとき（または溢れたとき）に集計する。
+    """
+    def __init__(self, max_samples=100000, max_pending=256):
+        self.max_samples = max_samples
+        self.max_pending = max_pending
+        self.samples = {}                         # 区間名 → 遅延（ミリ秒）のリスト
+        self.counts = {}                          # 区間名 → 集計したサンプル数
+        self.pending = OrderedDict()              # トレースID → Arduino応答待ちのトレース
+        self.lock = threading.Lock()
+
+    def _add(self, name, value_ms):
+        samples = self.samples.setdefault(name, [])
+        count = self.counts.get(name, 0)
+        if len(samples) < self.max_samples:
+            samples.append(value_ms)
+        else:
+            samples[count % self.max_samples] = value_ms
+        self.counts[name] = count + 1
+
+    def record(self, trace):                      # 1トレース分の遅延を集計する
+        with self.lock:
+            if "cam" in trace:
+                self._add("camera", trace["cam"])
+            previous = None
+            for hop in HOPS:
+                if hop not in trace:
+                    continue
+                if previous is not None:
+                    self._add(SEGMENT_NAMES[hop], (trace[hop] - trace[previous]) * 1000)
+                previous = hop
+            if "cap" in trace:
+                for hop, name in (("ser", "end_to_end_write"), ("ard", "end_to_end_reply")):
+                    if hop in trace:
+                        self._add(name, (trace[hop] - trace["cap"]) * 1000)
+
+    def wait_for_reply(self, trace):              # Arduinoの応答を待つトレースとして保持する
+        with self.lock:
+            self.pending[int(trace["id"])] = trace
+            overflow = []
+            while len(self.pending) > self.max_pending:
+                overflow.append(self.pending.popitem(last=False)[1])  # 応答の来なかったトレース
+        for lost in overflow:
+            self.record(lost)
+
+    def reply_received(self, trace_id):           # Arduinoの応答が届いたトレースを集計する
+        with self.lock:
+            trace = self.pending.pop(trace_id, None)
+        if trace is not None:
+            trace["ard"] = now()
+            self.record(trace)
+
+    def flush_pending(self):                      # 応答待ちのトレースを応答無しとして集計する
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for trace in pending:
+            self.record(trace)
+
+    def summary(self):                            # 区間名 → {count, p50, p99, mean, max, histogram} の辞書
+        with self.lock:
+            result = {}
+            for name, samples in self.samples.items():
+                values = np.asarray(samples, dtype=np.float64)
+                histogram, _ = np.histogram(values, bins=HISTOGRAM_EDGES_MS + [np.inf])
+                result[name] = {
+                    "count": self.counts[name],
+                    "p50_ms": float(np.percentile(values, 50)),
+                    "p99_ms": float(np.percentile(values, 99)),
+                    "mean_ms": float(values.mean()),
+                    "max_ms": float(values.max()),
+                    "histogram": {"edges_ms": HISTOGRAM_EDGES_MS, "counts": histogram.tolist()},
+                }
+            return result
+
+    def summary_lines(self):                      # 表示用の集計行
+        order = ["camera"] + [SEGMENT_NAMES[hop] for hop in HOPS[1:]] + ["end_to_end_write", "end_to_end_reply"]
+        summary = self.summary()
+        lines = []
+        for name in order:
+            if name in summary:
+                st = summary[name]
+                lines.append(f"{name}: n={st['count']}, p50 {st['p50_ms']:.2f} ms, p99 {st['p99_ms']:.2f} ms, 最大 {st['max_ms']:.2f} ms")
+        return lines
+
+    def dump(self, path):                         # 集計結果をJSONで保存する
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
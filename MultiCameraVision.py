@@ -0,0 +1,219 @@
+# MultiCameraVision.py
+
+# 複数のRealSense（または複数の記録）を使って広い範囲の手を検出する、VisionManagerの複数カメラ版。
+# カメラ1台ごとに別プロセスでVisionManagerのパイプライン（キャプチャ → 推論）を動かし、CPUの複数コアを使う。
+# 各プロセスは最新の手情報を自分の共有メモリスロット（SharedLatestValue）に書き込み、
+# このプロセスの統合段がすべてのスロットを読んで最も近い手を選び、VM としてBlackBoard経由でBMに送る。
+# BMから見ると単一のVisionManagerと同じ（共有メモリスロットの提供、またはTCPの "Depth:..."）。
+#
+# 使い方:
+#   python MultiCameraVision.py                                  # 接続中のRealSenseをすべて使う
+#   python MultiCameraVision.py --serials 123456789012 234567890123
+#   python MultiCameraVision.py --recordings Log/VideoLog/log3 Log/VideoLog/log4 --no-blackboard   # 記録の同時処理（スループット計測）
+#
+# 注意:
+#   - 各カメラのプロセスは画面表示・ログ保存を行わない。
+#   - 共有メモリで渡すランドマークのピクセル座標・3次元座標は、最も近い手を検出したカメラの座標系になる。
+#   - D435を複数台使う場合は、カメラごとに別のUSBコントローラ（ポート）に接続する。
+
+import argparse                                   # コマンドライン引数の解析用
+import json                                       # 結果のJSON出力用
+import multiprocessing                            # カメラごとのワーカープロセス用
+import queue                                      # ワーカーからの通知の受信待ち用
+import threading                                  # ワーカー内の停止監視用
+import time                                       # 統合段のポーリング用
+import VisionManager                              # パイプライン（ワーカー）とBlackBoard接続・送信処理（統合段）
+import LatencyTrace                               # 統合後のトレースの送信時刻用
+from SharedLatestValue import LatestValueReader, LatestValueWriter  # ワーカーとの共有メモリスロット
+from FrameSource import RealSenseSource, RecordingSource, list_realsense_devices
+
+FUSION_MAX_AGE = 0.2                              # この秒数より古いカメラの値は統合に使わない（止まったカメラの値を使い続けない）
+READY_TIMEOUT = 60.0                              # ワーカーの起動（MediaPipe・カメラの初期化）を待つ最大秒数
+POLL_INTERVAL = 0.001                             # どのスロットも更新されていないときの待ち時間（秒）
+STATS_INTERVAL = 5.0                              # カメラごとの受信数を表示する間隔（秒）
+
+def camera_worker(index, kind, path, width, height, fps, realtime, status_queue, stop_event):
+    """
+    1台分のワーカープロセス。VisionManagerのパイプラインを画面表示・BlackBoard接続無しで動かし、
+    結果を自分の共有メモリスロットに書き込む。スロット名と終了時の集計値は status_queue で親に通知する。
+    """
+    VisionManager.SAVE_VIDEO_LOGS = False         # ログのファイル名がカメラ間で衝突するため保存しない
+    VisionManager.SAVE_HANDLANDMARK_LOGS = False
+    VisionManager.SAVE_RAW_DEPTH_LOGS = False
+    VisionManager.SAVE_QUALITY_LOGS = False
+    VisionManager.shm_writer = LatestValueWriter(max_hands=VisionManager.MAX_NUM_HANDS)  # main() の終了時に解放される
+
+    if kind == "recording":
+        source = RecordingSource(path, realtime=realtime)
+    elif kind == "bag":
+        source = RealSenseSource(width, height, fps, bag_path=path, realtime=realtime)
+    else:
+        source = RealSenseSource(width, height, fps, serial=path)
+
+    def watch_stop():                             # 親の停止指示でパイプラインを止める
+        while True:                               # wait() で待つと、このプロセスの終了後に親の set() が戻らなくなるためポーリングする
+            if stop_event.is_set():               # main() が running を初期化する前に指示が来た場合も止まるよう、繰り返し設定する
+                VisionManager.running = False
+            time.sleep(0.1)
+    threading.Thread(target=watch_stop, daemon=True).start()
+
+    status_queue.put(("ready", index, VisionManager.shm_writer.name))
+    result = None
+    try:
+        result = VisionManager.main(source=source, use_blackboard=False, display=False)
+    except KeyboardInterrupt:
+        pass                                      # Ctrl+Cは親プロセスが処理する
+    finally:
+        status_queue.put(("done", index, result))
+
+class NearestHandFusion:
+    """
+    各カメラの最新値（共有メモリスロットの読み出し結果）を保持し、最も近い手を選ぶ。
+    """
+    def __init__(self, max_age=FUSION_MAX_AGE):
+        self.max_age = max_age
+        self.latest = {}                          # カメラ番号 → (受け取った時刻, 値)
+
+    def update(self, index, value):
+        self.latest[index] = (time.monotonic(), value)
+
+    def nearest(self):                            # (カメラ番号, 値)。どのカメラにも手が無ければ (None, None)
+        now = time.monotonic()
+        candidates = [(value["min_depth"], index, value) for index, (received, value) in self.latest.items()
+                      if now - received <= self.max_age and value["min_depth"] is not None]
+        if not candidates:
+            return None, None
+        _, index, value = min(candidates, key=lambda candidate: candidate[0])
+        return index, value
+
+def run_fusion(readers, workers, use_blackboard):
+    """
+    すべてのワーカーのスロットを読み、更新があるたびに最も近い手の深度をBMに送る。
+    ワーカーがすべて終了するか、BlackBoardからEXITが届くまで続ける。
+    """
+    if use_blackboard:
+        VisionManager.connect_to_blackboard()     # このプロセスが VM として接続し、統合結果用の共有メモリスロットも提供する
+    fusion = NearestHandFusion()
+    received = {index: 0 for index in readers}
+    published = 0
+    start = last_report = time.perf_counter()
+    while VisionManager.running and any(worker.is_alive() for worker in workers):
+        updated = False
+        for index, reader in readers.items():
+            value = reader.read()
+            if value is not None:
+                fusion.update(index, value)
+                received[index] += 1
+                updated = True
+        if not updated:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        camera, value = fusion.nearest()
+        published += 1
+        min_depth = value["min_depth"] if value else None
+        trace = None
+        if value and value["trace"]:              # トレースIDは統合後の送信番号にする（カメラ間でフレーム番号が重なるため）
+            trace = {**value["trace"], "id": published, "vm": LatencyTrace.now()}
+        if VisionManager.shm_writer:
+            VisionManager.shm_writer.publish(published, time.time(), min_depth,
+                                             value["landmarks"] if value else None,
+                                             value["num_hands"] if value else 0, trace)
+        VisionManager.send_depth_to_blackboard(min_depth, trace)
+
+        now = time.perf_counter()
+        if now - last_report >= STATS_INTERVAL:
+            print(f"[統合] 送信 {published} 件, カメラごとの受信 {received}, 最も近い手: カメラ{camera} {min_depth}")
+            last_report = now
+    return {"published": published, "received": received, "wall_time": time.perf_counter() - start}
+
+def main():
+    parser = argparse.ArgumentParser(description="複数のRealSense・記録を別プロセスで処理し、最も近い手の深度をBMに送る")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--serials", nargs="+", help="使うRealSenseのシリアル番号（省略時は接続中のすべて）")
+    group.add_argument("--bags", nargs="+", help="RealSenseの .bag ファイル")
+    group.add_argument("--recordings", nargs="+", help="VisionManagerの記録のパス（例: Log/VideoLog/log3）")
+    parser.add_argument("--width", type=int, default=1280, help="横解像度")
+    parser.add_argument("--height", type=int, default=720, help="縦解像度")
+    parser.add_argument("--fps", type=int, default=30, help="フレームレート")
+    parser.add_argument("--realtime", action="store_true", help="記録・.bagを記録時の速度で再生する（既定は最大速度）")
+    parser.add_argument("--no-blackboard", action="store_true", help="BlackBoardに接続しない（スループット計測用）")
+    parser.add_argument("--json", help="カメラごとの集計結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    if args.recordings:
+        cameras = [("recording", path) for path in args.recordings]
+    elif args.bags:
+        cameras = [("bag", path) for path in args.bags]
+    else:
+        cameras = [("realsense", serial) for serial in (args.serials or list_realsense_devices())]
+    if not cameras:
+        raise SystemExit("使用できるカメラ・記録がありません。")
+    print(f"[複数カメラ] {len(cameras)} 台: " + ", ".join(path for _, path in cameras))
+
+    context = multiprocessing.get_context("spawn")  # Windowsと同じ起動方式（MediaPipe・カメラをプロセスごとに初期化する）
+    status_queue = context.Queue()
+    stop_event = context.Event()
+    workers = [context.Process(target=camera_worker, daemon=True,
+                               args=(index, kind, path, args.width, args.height, args.fps, args.realtime, status_queue, stop_event))
+               for index, (kind, path) in enumerate(cameras)]
+    for worker in workers:
+        worker.start()
+
+    readers = {}
+    results = {}
+    fusion_result = None
+    try:
+        deadline = time.monotonic() + READY_TIMEOUT
+        while len(readers) + len(results) < len(workers):  # すべてのワーカーのスロットが作られるまで待つ
+            try:
+                status, index, payload = status_queue.get(timeout=max(deadline - time.monotonic(), 0.1))
+            except queue.Empty:
+                raise SystemExit("ワーカーの起動がタイムアウトしました。")
+            if status == "ready":
+                readers[index] = LatestValueReader(payload, untrack=False)  # spawnしたワーカーとはresource_trackerを共有している
+                print(f"[複数カメラ] カメラ{index} 起動: {cameras[index][1]}")
+            else:
+                results[index] = payload          # 起動直後に終了した（カメラを開けなかった等）
+        fusion_result = run_fusion(readers, workers, not args.no_blackboard)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()                          # ワーカーに終了を指示し、集計値を受け取る
+        while len(results) < len(workers):
+            try:
+                status, index, payload = status_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break                         # 集計値を送らずに終了したワーカーがある
+                continue
+            if status == "done":
+                results[index] = payload
+        for worker in workers:
+            worker.join(timeout=5.0)
+        for reader in readers.values():
+            reader.close()
+        VisionManager.disconnect_from_blackboard()  # 統合結果用の共有メモリスロットを解放し、BlackBoardとの接続を閉じる
+
+    total_fps = 0.0
+    summary = {"cameras": {}, "fusion": fusion_result}
+    for index, (kind, path) in enumerate(cameras):
+        result = results.get(index)
+        if not result:
+            print(f"[複数カメラ] カメラ{index} ({path}): 結果なし")
+            continue
+        frames = result["stages"]["inference"]["processed"]
+        fps = frames / result["wall_time"] if result["wall_time"] > 0 else 0.0
+        total_fps += fps
+        summary["cameras"][path] = {"frames": frames, "fps": fps, **result}
+        print(f"[複数カメラ] カメラ{index} ({path}): {frames} フレーム, {fps:.1f} fps")
+    summary["total_fps"] = total_fps
+    print(f"[複数カメラ] 合計 {total_fps:.1f} fps（{len(cameras)} 台, CPU {multiprocessing.cpu_count()} コア）")
+    if fusion_result:
+        print(f"[統合] 送信 {fusion_result['published']} 件, カメラごとの受信 {fusion_result['received']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# QualityController.py
+
+# フレームごとの処理時間を目標の予算（既定はカメラのフレーム間隔）と比べ、品質レベルを上下させる制御。
+# レベル0が最高品質で、数字が大きいほど処理が軽い（何を変えるかは VisionManager の QUALITY_LEVELS で決める）。
+#
+# 揺れ（上げては下げるの繰り返し）を防ぐため、上げ下げの条件に差を付ける:
+#   - window フレームごとに処理時間の p90 を求め、予算を超えていれば1段下げる。
+#   - p90 が予算の upgrade_ratio 倍未満の区間が upgrade_windows 回続いたら1段上げる。
+#   - 上げた直後の区間で下げることになった場合は、次に上げるまでに必要な区間数を倍にする（最大 MAX_BACKOFF 倍）。
+
+import numpy as np                                # 処理時間の集計用
+
+MAX_BACKOFF = 8                                   # 上げるのに必要な区間数を増やす最大の倍率
+
+class QualityController:
+    """
+    add() で1フレームの処理時間（ミリ秒）を渡す。レベルを変えた場合は (変更前, 変更後, p90[ms]) を返し、変えなければNoneを返す。
+    """
+    def __init__(self, num_levels, budget_ms, window=30, upgrade_ratio=0.6, upgrade_windows=3):
+        self.num_levels = num_levels
+        self.budget_ms = budget_ms
+        self.window = window
+        self.upgrade_ratio = upgrade_ratio
+        self.upgrade_windows = upgrade_windows
+        self.level = 0                            # 現在のレベル（0が最高品質）
+        self.samples = []                         # 現在の区間の処理時間
+        self.good_windows = 0                     # 余裕のある区間が続いた数
+        self.backoff = 1                          # 上げるのに必要な区間数の倍率
+        self.just_upgraded = False                # 直前の区間でレベルを上げたか
+
+    def add(self, elapsed_ms):
+        self.samples.append(elapsed_ms)
+        if len(self.samples) < self.window:
+            return None
+        p90 = float(np.percentile(self.samples, 90))
+        self.samples = []
+        old = self.level
+        if p90 > self.budget_ms:
+            self.good_windows = 0
+            if self.just_upgraded:                # 上げた段では予算に収まらなかった
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.level = min(self.level + 1, self.num_levels - 1)
+        else:
+            if self.just_upgraded:                # 上げた段で予算に収まったので倍率を戻す
+                self.backoff = 1
+            if p90 < self.budget_ms * self.upgrade_ratio:
+                self.good_windows += 1
+            else:                                 # 予算内だが余裕は少ない: 今のレベルを保つ
+                self.good_windows = 0
+            if self.level > 0 and self.good_windows >= self.upgrade_windows * self.backoff:
+                self.level -= 1
+                self.good_windows = 0
+        self.just_upgraded = self.level < old
+        return (old, self.level, p90) if self.level != old else None
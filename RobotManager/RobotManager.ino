@@ -2,6 +2,7 @@
 
 #define BAUDRATE         57600                // Dynamixelとの通信速度
 #define PROTOCOL_VERSION 2.0                  // 使用するDynamixelのプロトコルバージョン
+#define SERIAL_BAUD      115200               // PCとの通信速度（SerialLink.py の SERIAL_BAUD と合わせる）
 
 DynamixelShield dxl;                          // Dynamixel通信用オブジェクト作成
 
@@ -9,13 +10,143 @@ const uint8_t DXL_ID1 = 1;                    // モーター1のID
 const uint8_t DXL_ID2 = 2;                    // モーター2のID
 const uint16_t BASE_POSITION = 1000;          // モーター初期位置
 const uint16_t OFFSET = 100;                  // 移動時のオフセット量
-const uint16_t DEPTH_TRIGGER = 500;           // Depthトリガー閾値
+const unsigned long MOTION_STEP_MS = 3000;    // 動作の各段階の時間
+
+// --- PCとのバイナリフレーム（SerialLink.py と同じ定義） ---
+// [SYNC 0xA5][種別][シーケンス番号 uint32 LE][ペイロード長][ペイロード][CRC-8（種別〜ペイロード）]
+// 深度の閾値判定はPC側（BehaviorManager）で行い、近づいたときだけ CMD_TRIGGER が届く。
+const uint8_t FRAME_SYNC = 0xA5;
+const uint8_t HEADER_SIZE = 7;
+const uint8_t MAX_PAYLOAD = 32;
+const uint8_t CMD_DEPTH = 0x01;               // 最新の深度 [uint16 mm, 0xFFFFは手なし]
+const uint8_t CMD_TRIGGER = 0x02;             // 動作開始
+const uint8_t CMD_RESET = 0x03;               // 初期位置に戻す
+const uint8_t CMD_CONDITION = 0x04;           // 条件ごとの移動 [条件 uint8]
+const uint8_t REPLY_ACK = 0x81;               // [コマンド種別][結果]
+const uint8_t REPLY_TEXT = 0x82;              // 表示用メッセージ
+const uint8_t REPLY_STATE = 0x83;             // [動作中]
+const uint8_t STATUS_OK = 0;
+const uint8_t STATUS_BUSY = 1;
+const uint8_t STATUS_UNKNOWN = 2;
+
+uint8_t rxBuffer[HEADER_SIZE + MAX_PAYLOAD + 1];  // 受信中のフレーム
+uint8_t rxLength = 0;                         // 受信済みのバイト数
+uint16_t lastDepth = 0xFFFF;                  // 最後に受け取った深度
+uint8_t motionStep = 0;                       // 動作の段階（0: 停止中）
+unsigned long motionDeadline = 0;             // 次の段階に進む時刻
+
+uint8_t crc8(const uint8_t* data, uint8_t length) {  // CRC-8（多項式0x07, 初期値0）
+  uint8_t crc = 0;
+  for (uint8_t i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (uint8_t)((crc << 1) ^ 0x07) : (uint8_t)(crc << 1);
+    }
+  }
+  return crc;
+}
+
+void sendFrame(uint8_t type, uint32_t seq, const uint8_t* payload, uint8_t length) {  // PCにフレームを送る
+  uint8_t frame[HEADER_SIZE + MAX_PAYLOAD + 1];
+  frame[0] = FRAME_SYNC;
+  frame[1] = type;
+  for (uint8_t i = 0; i < 4; i++) frame[2 + i] = (uint8_t)(seq >> (8 * i));
+  frame[6] = length;
+  memcpy(frame + HEADER_SIZE, payload, length);
+  frame[HEADER_SIZE + length] = crc8(frame + 1, HEADER_SIZE - 1 + length);
+  Serial.write(frame, HEADER_SIZE + length + 1);
+}
+
+void sendAck(uint8_t command, uint32_t seq, uint8_t status) {
+  uint8_t payload[2] = {command, status};
+  sendFrame(REPLY_ACK, seq, payload, 2);
+}
+
+void sendText(const char* text) {             // 表示用メッセージ（従来のSerial.printlnの代わり）
+  uint8_t length = min(strlen(text), (size_t)MAX_PAYLOAD);
+  sendFrame(REPLY_TEXT, 0, (const uint8_t*)text, length);
+}
+
+void sendState() {                            // 動作中かどうかを通知
+  uint8_t moving = motionStep != 0;
+  sendFrame(REPLY_STATE, 0, &moving, 1);
+}
+
+void startMotion() {                          // 動作開始（ID1 +200 → -200 → 初期位置）。delayを使わずloop()で進める
+  motionStep = 1;
+  dxl.setGoalPosition(DXL_ID1, BASE_POSITION + 200); // ID1を+200移動
+  motionDeadline = millis() + MOTION_STEP_MS;
+  sendState();
+}
 
-String inputBuffer = "";                      // シリアル入力用バッファ
-bool isMoving = false;                        // モーターが動作中かを示すフラグ
+void updateMotion() {                         // 時間が来たら動作を次の段階に進める
+  if (motionStep == 0 || (long)(millis() - motionDeadline) < 0) return;
+  if (motionStep == 1) {
+    dxl.setGoalPosition(DXL_ID1, BASE_POSITION - 200); // ID1を-200移動
+  } else if (motionStep == 2) {
+    dxl.setGoalPosition(DXL_ID1, BASE_POSITION);       // ID1を初期位置へ戻す
+  } else {
+    motionStep = 0;                           // 動作完了
+    sendText("motion done");
+    sendState();
+    return;
+  }
+  motionStep++;
+  motionDeadline = millis() + MOTION_STEP_MS;
+}
+
+void handleFrame(uint8_t type, uint32_t seq, const uint8_t* payload, uint8_t length) {  // 受信したコマンドを実行してACKを返す
+  uint8_t status = STATUS_OK;
+  if (type == CMD_DEPTH && length >= 2) {
+    lastDepth = payload[0] | (payload[1] << 8);
+  }
+  else if (type == CMD_TRIGGER) {
+    if (motionStep == 0) startMotion();
+    else status = STATUS_BUSY;                // 動作中のため無視
+  }
+  else if (type == CMD_RESET) {
+    dxl.setGoalPosition(DXL_ID1, BASE_POSITION); // ID1を初期位置に移動
+    dxl.setGoalPosition(DXL_ID2, BASE_POSITION); // ID2を初期位置に移動
+    if (motionStep != 0) {
+      motionStep = 0;                         // 動作を中断
+      sendState();
+    }
+  }
+  else if (type == CMD_CONDITION && length >= 1 && payload[0] == 1) {
+    dxl.setGoalPosition(DXL_ID1, BASE_POSITION + OFFSET); // 条件1: ID1を+100に移動
+  }
+  else if (type == CMD_CONDITION && length >= 1 && payload[0] == 2) {
+    dxl.setGoalPosition(DXL_ID2, BASE_POSITION + OFFSET); // 条件2: ID2を+100に移動
+  }
+  else {
+    status = STATUS_UNKNOWN;                  // 不明なコマンド
+  }
+  sendAck(type, seq, status);
+}
+
+void pollSerial() {                           // 受信したバイトからフレームを組み立てる
+  while (Serial.available()) {
+    uint8_t c = Serial.read();
+    if (rxLength == 0 && c != FRAME_SYNC) continue;  // 同期バイトまで読み捨てる
+    rxBuffer[rxLength++] = c;
+    if (rxLength < HEADER_SIZE) continue;
+    uint8_t length = rxBuffer[6];
+    if (length > MAX_PAYLOAD) {               // 同期バイトの誤検出
+      rxLength = 0;
+      continue;
+    }
+    if (rxLength < HEADER_SIZE + length + 1) continue;
+    if (crc8(rxBuffer + 1, HEADER_SIZE - 1 + length) == rxBuffer[HEADER_SIZE + length]) {
+      uint32_t seq = 0;
+      for (uint8_t i = 0; i < 4; i++) seq |= (uint32_t)rxBuffer[2 + i] << (8 * i);
+      handleFrame(rxBuffer[1], seq, rxBuffer + HEADER_SIZE, length);
+    }
+    rxLength = 0;                             // CRC不一致のフレームは捨てる
+  }
+}
 
 void setup() {
-  Serial.begin(9600);                         // PCとのシリアル通信を9600bpsで開始
+  Serial.begin(SERIAL_BAUD);                  // PCとのシリアル通信を開始
   while (!Serial);                            // シリアルポートが開くまで待機
 
   dxl.begin(BAUDRATE);                        // Dynamixelとの通信開始
@@ -31,70 +162,10 @@ void setup() {
   dxl.setGoalPosition(DXL_ID1, BASE_POSITION); // モーターID1を初期位置に移動
   dxl.setGoalPosition(DXL_ID2, BASE_POSITION); // モーターID2を初期位置に移動
 
-  Serial.println("Dynamixel Ready");          // 初期化完了をシリアル出力
+  sendText("Dynamixel Ready");                // 初期化完了を通知
 }
 
 void loop() {
-  while (Serial.available()) {                // シリアルにデータがあれば
-    char c = Serial.read();                   // 1文字読み込み
-
-    if (c == '\n') {                          // 改行文字で1コマンドの終端と判定
-      inputBuffer.trim();                     // 受信文字列の前後空白を削除
-
-      if (inputBuffer.length() > 0) {         // 入力が空でなければ
-        Serial.print("受信: ");               // 入力内容を表示
-        Serial.println(inputBuffer);
-
-        if (inputBuffer == "reset") {         // "reset"コマンド受信時
-          dxl.setGoalPosition(DXL_ID1, BASE_POSITION); // ID1を初期位置に移動
-          dxl.setGoalPosition(DXL_ID2, BASE_POSITION); // ID2を初期位置に移動
-          isMoving = false;                   // 動作フラグをリセット
-          Serial.println("→ Reset: ID1 & ID2 を 1000 に設定");
-        }
-        else if (inputBuffer.startsWith("Depth:")) {   // "Depth:xxx"形式受信時
-          if (!isMoving) {                  // 動作中でない場合のみ
-            float depth = inputBuffer.substring(6).toFloat(); // Depth値を取得
-            Serial.print("→ Depth受信: ");
-            Serial.println(depth);
-
-            if (depth < DEPTH_TRIGGER) {    // 閾値より小さい場合
-              isMoving = true;              // 動作フラグをセット
-              Serial.println("→ 動作開始（ID1 +200 → -200 → 初期位置）");
-
-              dxl.setGoalPosition(DXL_ID1, BASE_POSITION + 200); // ID1を+200移動
-              delay(3000);                 // 3秒待機
-              dxl.setGoalPosition(DXL_ID1, BASE_POSITION - 200); // ID1を-200移動
-              delay(3000);                 // 3秒待機
-              dxl.setGoalPosition(DXL_ID1, BASE_POSITION);       // ID1を初期位置へ戻す
-              delay(3000);                 // 3秒待機
-
-              Serial.println("→ 動作完了、初期位置へ戻る");
-
-              while (Serial.available()) Serial.read(); // 残りの受信データをクリア
-              isMoving = false;           // 動作フラグをリセット
-            } else {
-              Serial.println("→ Depthは閾値より大きいため無視");
-            }
-          } else {
-            Serial.println("→ 動作中のため無視");
-          }
-        }
-        else if (inputBuffer.startsWith("ID:") && inputBuffer.indexOf("Cond:1") != -1) {
-          dxl.setGoalPosition(DXL_ID1, BASE_POSITION + OFFSET); // 条件1: ID1を+100に移動
-          Serial.println("→ ID1 を +100 に移動");
-        }
-        else if (inputBuffer.startsWith("ID:") && inputBuffer.indexOf("Cond:2") != -1) {
-          dxl.setGoalPosition(DXL_ID2, BASE_POSITION + OFFSET); // 条件2: ID2を+100に移動
-          Serial.println("→ ID2 を +100 に移動");
-        }
-        else {
-          Serial.println("→ 未知のコマンド");       // 不明なコマンド時
-        }
-      }
-
-      inputBuffer = "";                     // バッファをリセット
-    } else {
-      inputBuffer += c;                     // 受信文字をバッファに追加
-    }
-  }
+  pollSerial();                               // 動作中もコマンドを受け付ける（動作開始は動作中なら無視）
+  updateMotion();
 }
@@ -3,20 +3,7 @@
 set SCRIPT_DIR=%~dp0
 cd /d %SCRIPT_DIR%
 
-:: /c は終了後自動的にcmdウインドウが閉じる
-:: /k は終了後もcmdウィンドウは開いたまま
-
-:: BlackBoard.py を新しいウィンドウで起動
-start "BlackBoard" cmd /c "call .\VE\Scripts\activate && python BlackBoard.py"
-
-:: BlackBoardが安定するまで5秒待機
-timeout /t 3 /nobreak >nul
-
-:: BehaviorManager.py を新しいウィンドウで起動
-start "BehaviorManager" cmd /c "call .\VE\Scripts\activate && python BehaviorManager.py"
-
-:: VisionManager.py を新しいウィンドウで起動
-start "VisionManager" cmd /c "call .\VE\Scripts\activate && python VisionManager.py"
-
-:: CmdClient.py を新しいウィンドウで起動
-start  "CmdClient" cmd /c "call .\VE\Scripts\activate && python CmdClient.py"
\ No newline at end of file
+:: Supervisor.py が BlackBoard・BehaviorManager・VisionManager・CmdClient を同時に起動し、
+:: BlackBoardの待機開始と各クライアントの登録を確認して準備完了を表示する（固定の待ち時間は置かない）。
+:: 異常終了したプロセスは再起動する。--new-consoles で従来どおりプロセスごとにウィンドウを開く。
+call .\VE\Scripts\activate && python Supervisor.py --new-consoles
@@ -0,0 +1,239 @@
+# SerialLink.py
+
+# BehaviorManager と Arduino（RobotManager.ino）の間のバイナリのシリアル通信。
+# 文字列を1行ずつ送る方式では、30fpsの深度値で9600bpsの回線が飽和してコマンドが滞留していたため、
+#   - 深度値は最新の1つだけを保持し、送信中に届いた古い値は捨てる（コアレス）
+#   - 閾値判定（ヒステリシス付き）はPC側で行い、Arduinoには「動作開始」を1回だけ送る
+#   - 小さな固定形式のフレームを高いボーレートで送る
+# ようにした。Arduinoは受け取ったフレームごとにACKを返す（遅延トレースの応答時刻に使う）。
+#
+# フレーム形式（リトルエンディアン）:
+#   [SYNC 0xA5][種別 uint8][シーケンス番号 uint32][ペイロード長 uint8][ペイロード][CRC-8]
+#   CRC-8（多項式0x07）は種別からペイロードの末尾までに対して計算する。
+# PC → Arduino:
+#   CMD_DEPTH     [深度 uint16, mm。0xFFFFは手なし]   最新の深度（表示・状態確認用）
+#   CMD_TRIGGER   なし                               動作開始（PC側で閾値を下回ったとき）
+#   CMD_RESET     なし                               初期位置に戻す（従来の "reset"）
+#   CMD_CONDITION [条件 uint8]                       条件ごとの移動（従来の "ID:..Cond:1/2"）
+# Arduino → PC:
+#   REPLY_ACK     [受け取ったコマンド種別 uint8][結果 uint8]  シーケンス番号は受け取ったフレームと同じ
+#   REPLY_TEXT    [UTF-8文字列]                      表示用メッセージ
+#   REPLY_STATE   [動作中 uint8]                     動作の開始・終了の通知
+
+import struct                                     # フレームのヘッダ読み書き用
+import threading                                  # 送信・受信スレッド用
+import time                                       # 受信待ちの間隔用
+from collections import deque                     # 制御コマンドの送信キュー用
+from LatencyTrace import now                      # 遅延トレースの送信時刻用
+
+SERIAL_BAUD = 115200                              # PCとArduinoの通信速度（RobotManager.ino の SERIAL_BAUD と合わせる）
+FRAME_SYNC = 0xA5                                 # フレーム先頭の同期バイト
+FRAME_HEADER = struct.Struct("<BBIB")             # 同期バイト, 種別, シーケンス番号, ペイロード長
+MAX_PAYLOAD = 32                                  # ペイロードの最大長
+
+CMD_DEPTH = 0x01
+CMD_TRIGGER = 0x02
+CMD_RESET = 0x03
+CMD_CONDITION = 0x04
+REPLY_ACK = 0x81
+REPLY_TEXT = 0x82
+REPLY_STATE = 0x83
+FRAME_TYPE_NAMES = {
+    CMD_DEPTH: "DEPTH", CMD_TRIGGER: "TRIGGER", CMD_RESET: "RESET", CMD_CONDITION: "CONDITION",
+    REPLY_ACK: "ACK", REPLY_TEXT: "TEXT", REPLY_STATE: "STATE",
+}
+STATUS_OK = 0                                     # 実行した
+STATUS_BUSY = 1                                   # 動作中のため無視した
+STATUS_UNKNOWN = 2                                # 未知のコマンド
+NO_DEPTH = 0xFFFF                                 # 手が無いことを表す深度値
+
+def crc8(data):                                   # CRC-8（多項式0x07, 初期値0）
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+def encode_serial_frame(frame_type, seq=0, payload=b""):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"ペイロードが長すぎます: {len(payload)} bytes")
+    header = FRAME_HEADER.pack(FRAME_SYNC, frame_type, seq & 0xFFFFFFFF, len(payload))
+    return header + payload + bytes([crc8(header[1:] + payload)])
+
+class SerialFrameDecoder:
+    """
+    受信したバイト列からフレームを取り出す。同期バイトが見つかるまで読み捨て、CRCが合わないフレームは捨てて再同期する。
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.errors = 0                           # CRC不一致などで捨てたフレーム数
+
+    def feed(self, data):                         # (種別, シーケンス番号, ペイロード) のリストを返す
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(FRAME_SYNC)
+            if start < 0:
+                self.buffer.clear()
+                return frames
+            del self.buffer[:start]
+            if len(self.buffer) < FRAME_HEADER.size:
+                return frames
+            _, frame_type, seq, length = FRAME_HEADER.unpack_from(self.buffer)
+            if length > MAX_PAYLOAD:
+                self.errors += 1
+                del self.buffer[:1]               # 同期バイトの誤検出なので次を探す
+                continue
+            total = FRAME_HEADER.size + length + 1
+            if len(self.buffer) < total:
+                return frames
+            body = bytes(self.buffer[1:total - 1])
+            if crc8(body) != self.buffer[total - 1]:
+                self.errors += 1
+                del self.buffer[:1]
+                continue
+            frames.append((frame_type, seq, body[FRAME_HEADER.size - 1:]))
+            del self.buffer[:total]
+
+class ArduinoLink:
+    """
+    Arduinoとのシリアル通信。送信スレッドが制御コマンドを順に送り、その合間に最新の深度値だけを送る。
+    port は serial.Serial など write / read / close を持つオブジェクト。
+    深度値の閾値判定もここで行い、trigger_mm を下回ったときに CMD_TRIGGER を1回送る。
+    trigger_mm + hysteresis_mm を上回る（または手が無くなるか、rearm_timeout 秒以上深度が届かない）まで次の CMD_TRIGGER は送らない。
+    動作中に送った CMD_TRIGGER が STATUS_BUSY で返された場合は、動作の終了（REPLY_STATE）で再び送れるようにする。
+    latency_stats（LatencyTrace.LatencyStats）を渡すと、深度の送信時刻とACKの受信時刻を遅延トレースに記録する。
+    """
+    def __init__(self, port, trigger_mm=500, hysteresis_mm=50, rearm_timeout=1.0, latency_stats=None, on_text=None):
+        self.port = port
+        self.trigger_mm = trigger_mm
+        self.hysteresis_mm = hysteresis_mm
+        self.rearm_timeout = rearm_timeout
+        self.last_update = 0.0                    # 最後に深度値を受け取った時刻
+        self.latency_stats = latency_stats
+        self.on_text = on_text or (lambda text: print(f"[Arduino→BM] {text}"))
+        self.commands = deque()                   # 送信待ちの制御コマンド（捨てない）
+        self.latest_depth = None                  # 送信待ちの最新の深度値 (深度, トレース)
+        self.armed = True                         # 次に閾値を下回ったときに動作開始を送るか
+        self.moving = False                       # Arduinoが動作中か（REPLY_STATE で更新）
+        self.retrigger = False                    # 動作中で無視された動作開始を、動作の終了後に送り直すか
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.running = False
+        self.stats = {"depth_sent": 0, "depth_coalesced": 0, "commands_sent": 0, "triggers": 0,
+                      "acks": 0, "busy": 0, "retriggers": 0, "bytes_sent": 0, "decode_errors": 0}
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self._write_loop, daemon=True),
+                        threading.Thread(target=self._read_loop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):                              # 送信待ちのコマンドを送り終えてから止める
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        for thread in self.threads:
+            thread.join(timeout=1.0)
+
+    def _next_seq(self):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return self.seq
+
+    def send_command(self, frame_type, payload=b"", seq=None):  # 制御コマンドを送信キューに積む
+        with self.cond:
+            self.commands.append(encode_serial_frame(frame_type, self._next_seq() if seq is None else seq, payload))
+            self.cond.notify()
+
+    def update_depth(self, depth_mm, trace=None):
+        """
+        最新の深度値（手が無い場合はNone）を渡す。まだ送られていない前の値は捨てる。
+        閾値を下回った瞬間には CMD_TRIGGER を深度値より先に送る。
+        """
+        with self.cond:
+            if self.latest_depth is not None:
+                self.stats["depth_coalesced"] += 1
+                dropped_trace = self.latest_depth[1]
+                if dropped_trace is not None and self.latency_stats:
+                    self.latency_stats.record(dropped_trace)  # 送られなかった値もBMまでの遅延は集計する
+            self.latest_depth = (depth_mm, trace)
+            previous_update, self.last_update = self.last_update, time.monotonic()
+            if (depth_mm is None or depth_mm > self.trigger_mm + self.hysteresis_mm
+                    or self.last_update - previous_update > self.rearm_timeout):
+                self.armed = True                 # 手が離れたので次の接近で再び動作させる
+            if depth_mm is not None and depth_mm < self.trigger_mm and self.armed:
+                self.armed = False
+                self.stats["triggers"] += 1
+                seq = int(trace["id"]) if trace else self._next_seq()
+                self.commands.append(encode_serial_frame(CMD_TRIGGER, seq))
+            self.cond.notify()
+
+    def _write_loop(self):                        # 送信スレッド
+        while True:
+            with self.cond:
+                while self.running and not self.commands and self.latest_depth is None:
+                    self.cond.wait(0.5)
+                trace = None
+                if self.commands:
+                    frame = self.commands.popleft()
+                    self.stats["commands_sent"] += 1
+                elif self.latest_depth is not None and self.running:
+                    depth_mm, trace = self.latest_depth
+                    self.latest_depth = None
+                    seq = int(trace["id"]) if trace else self._next_seq()
+                    value = NO_DEPTH if depth_mm is None else min(int(round(depth_mm)), NO_DEPTH - 1)
+                    frame = encode_serial_frame(CMD_DEPTH, seq, struct.pack("<H", value))
+                    self.stats["depth_sent"] += 1
+                else:
+                    return                        # 終了指示（送信待ちのコマンドは送り終えた）
+            try:
+                self.port.write(frame)            # 回線が詰まっている間はここで待つ（その間の深度値は上書きされる）
+                self.stats["bytes_sent"] += len(frame)
+            except Exception as e:
+                print(f"[Arduino送信エラー] {e}")
+                continue
+            if trace is not None and self.latency_stats:
+                trace["ser"] = now()
+                self.latency_stats.wait_for_reply(trace)
+
+    def _read_loop(self):                         # 受信スレッド
+        decoder = SerialFrameDecoder()
+        while self.running:
+            try:
+                data = self.port.read(self.port.in_waiting or 1)  # タイムアウト付きで1バイト以上を待つ
+            except Exception as e:
+                print(f"[Arduino受信エラー] {e}")
+                time.sleep(1)
+                continue
+            if not data:
+                continue
+            for frame_type, seq, payload in decoder.feed(data):
+                self._handle_reply(frame_type, seq, payload)
+            self.stats["decode_errors"] = decoder.errors
+
+    def _handle_reply(self, frame_type, seq, payload):
+        if frame_type == REPLY_ACK and len(payload) >= 2:
+            command, status = payload[0], payload[1]
+            self.stats["acks"] += 1
+            if status == STATUS_BUSY:
+                self.stats["busy"] += 1
+                if command == CMD_TRIGGER:        # 動作開始が無視された: 手が近いままなら動作の終了後に再び動作させる
+                    with self.cond:
+                        if self.moving:
+                            self.retrigger = True
+                        else:
+                            self.armed = True
+            if command == CMD_DEPTH and self.latency_stats:
+                self.latency_stats.reply_received(seq)
+        elif frame_type == REPLY_TEXT:
+            self.on_text(payload.decode(errors="ignore"))
+        elif frame_type == REPLY_STATE and payload:
+            with self.cond:
+                self.moving = bool(payload[0])
+                if not self.moving and self.retrigger:  # 次に閾値を下回る深度値で CMD_TRIGGER を送る
+                    self.retrigger = False
+                    self.armed = True
+                    self.stats["retriggers"] += 1
@@ -0,0 +1,163 @@
+# SharedLatestValue.py
+
+# 同一PC内のプロセス間で「最新の手の情報」だけを共有するための共有メモリスロット。
+# VisionManagerが書き込み、BehaviorManagerが読み出す。BlackBoardを経由しないため、
+# 高頻度の深度値がTCP送受信・エンコード・ログ出力を通らずに届く。
+#
+# 書き込みはシーケンスロック方式:
+#   書き込み前にシーケンス番号を奇数にし、書き込み後に偶数へ進める。
+#   読み出し側は前後でシーケンス番号を読み、偶数かつ一致したときだけ値を採用する（書き込み途中の値は読み直す）。
+#
+# 読み出し側の待機はポーリングで、間隔は遅延とCPU使用率の兼ね合いで決める:
+#   - 更新が続いている間は POLL_INTERVAL（2ms、30fpsのフレーム間隔33msに対して小さい）ごとに確認する。
+#   - IDLE_AFTER 秒以上更新が無い（VMが止まっている等）と IDLE_POLL_INTERVAL（20ms）に延ばし、待機中の起床を減らす。
+#     その代わり、更新が再開した直後の値は最大 IDLE_POLL_INTERVAL 遅れて届く。
+#
+# レイアウト（リトルエンディアン）:
+#   [seq uint64][timestamp float64][frame_index uint64][min_depth float32][num_hands uint32]
+#   [hw_timestamp float64][camera_latency float64][capture_time float64][inference_time float64][publish_time float64]
+#   [landmarks float32 × max_hands × 21 × 6]  （各ランドマークの pixel_x, pixel_y, depth, x, y, z。無効値はNaN）
+# x, y, z は深度カメラ座標系の3次元座標[mm]（VisionManagerがカメラのパラメータを持たない場合はNaN）。
+# hw_timestamp 以降の5つは遅延計測用のトレース（LatencyTrace の hw, cam, cap, inf, vm）。トレースしない場合はNaN。
+
+import struct                                     # 共有メモリ上のヘッダ読み書き用
+import time                                       # ポーリング待機用
+import math                                       # NaN判定用
+import uuid                                       # 共有メモリ名の生成用
+from multiprocessing import shared_memory         # プロセス間共有メモリ
+
+NUM_LANDMARKS = 21                                # 1つの手のランドマーク数
+LANDMARK_FIELDS = 6                               # pixel_x, pixel_y, depth, x, y, z
+LANDMARK = struct.Struct("<" + "f" * LANDMARK_FIELDS)  # 1ランドマーク分
+SEQ = struct.Struct("<Q")                         # シーケンス番号
+HEADER = struct.Struct("<dQfI")                   # timestamp, frame_index, min_depth, num_hands
+TRACE = struct.Struct("<ddddd")                  # hw_timestamp, camera_latency, capture_time, inference_time, publish_time
+TRACE_KEYS = ("hw", "cam", "cap", "inf", "vm")    # LatencyTrace のトレースのキー（TRACE の並び順）
+POLL_INTERVAL = 0.002                             # 更新が続いている間のポーリング間隔（秒）
+IDLE_POLL_INTERVAL = 0.02                         # 更新が途絶えた後のポーリング間隔（秒）
+IDLE_AFTER = 1.0                                  # この秒数更新が無ければ IDLE_POLL_INTERVAL に切り替える
+HEADER_OFFSET = SEQ.size
+TRACE_OFFSET = HEADER_OFFSET + HEADER.size
+LANDMARK_OFFSET = TRACE_OFFSET + TRACE.size
+LANDMARK_BYTES = NUM_LANDMARKS * LANDMARK_FIELDS * 4  # 手1つ分のランドマークのバイト数（float32）
+
+def segment_size(max_hands):                      # 指定した最大手数に必要な共有メモリサイズ
+    return LANDMARK_OFFSET + max_hands * LANDMARK_BYTES
+
+def _untrack(shm):
+    """
+    attachしただけの共有メモリをresource_trackerの管理から外す。
+    POSIXでは外さないと、読み出し側プロセスの終了時に書き込み側のセグメントまで削除されてしまう。
+    """
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass                                      # Windowsではresource_trackerを使わないので何もしない
+
+class LatestValueWriter:
+    """
+    最新値スロットを作成して書き込む側（VisionManager）。
+    """
+    def __init__(self, max_hands=2, name=None):
+        self.max_hands = max_hands
+        name = name or f"expodev_{uuid.uuid4().hex[:12]}"
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=segment_size(max_hands))
+        self.name = self.shm.name                 # BlackBoard経由で読み出し側に通知する名前
+        self.seq = 0
+        SEQ.pack_into(self.shm.buf, 0, self.seq)
+
+    def publish(self, frame_index, timestamp, min_depth, landmarks=None, num_hands=0, trace=None):
+        """
+        最新値を書き込む。landmarks は float32・C連続の (num_hands, 21, 6) 配列など
+        バッファプロトコルに対応したオブジェクト。min_depth が None の場合はNaNを書き込む。
+        trace は LatencyTrace のトレース（辞書）。無いキーはNaNを書き込む。
+        """
+        trace = trace or {}
+        buf = self.shm.buf
+        num_hands = min(num_hands, self.max_hands)
+        self.seq += 1                                            # 奇数: 書き込み中
+        SEQ.pack_into(buf, 0, self.seq)
+        HEADER.pack_into(buf, HEADER_OFFSET, timestamp, frame_index,
+                         math.nan if min_depth is None else min_depth, num_hands)
+        TRACE.pack_into(buf, TRACE_OFFSET, *(trace.get(key, math.nan) for key in TRACE_KEYS))
+        if landmarks is not None and num_hands:
+            data = memoryview(landmarks).cast("B")[:num_hands * LANDMARK_BYTES]
+            buf[LANDMARK_OFFSET:LANDMARK_OFFSET + len(data)] = data
+        self.seq += 1                                            # 偶数: 書き込み完了
+        SEQ.pack_into(buf, 0, self.seq)
+
+    def close(self):                                             # 共有メモリを解放する（作成側なので削除も行う）
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+def unpack_landmarks(landmarks):                  # read() の landmarks を手ごとの [(pixel_x, pixel_y, depth, x, y, z) × 21] に変換する
+    values = list(LANDMARK.iter_unpack(landmarks))
+    return [values[i:i + NUM_LANDMARKS] for i in range(0, len(values), NUM_LANDMARKS)]
+
+class LatestValueReader:
+    """
+    最新値スロットにattachして読み出す側（BehaviorManager）。
+    書き込み側が自分の子プロセスで、resource_trackerを共有している場合は untrack=False にする（書き込み側の登録を消さない）。
+    """
+    def __init__(self, name, max_hands=2, untrack=True):
+        self.shm = shared_memory.SharedMemory(name=name)
+        if untrack:
+            _untrack(self.shm)
+        self.max_hands = max_hands
+        self.last_seq = 0                                        # 最後に読んだシーケンス番号
+        self.last_update = time.monotonic()                      # 最後に新しい値を読んだ時刻（ポーリング間隔の切り替え用）
+
+    def read(self, max_retries=100):
+        """
+        新しい値があれば辞書で返し、前回から更新が無ければNoneを返す。
+        landmarks は float32 の生バイト列（num_hands × 21 × 6）。unpack_landmarks() でタプルのリストにできる。trace は書き込み側のトレース（無い値は含まない）。
+        """
+        buf = self.shm.buf
+        for _ in range(max_retries):
+            (seq_before,) = SEQ.unpack_from(buf, 0)
+            if seq_before == self.last_seq:
+                return None                                      # 更新なし
+            if seq_before & 1:
+                continue                                         # 書き込み中なので読み直す
+            timestamp, frame_index, min_depth, num_hands = HEADER.unpack_from(buf, HEADER_OFFSET)
+            num_hands = min(num_hands, self.max_hands)
+            trace_values = TRACE.unpack_from(buf, TRACE_OFFSET)
+            landmarks = bytes(buf[LANDMARK_OFFSET:LANDMARK_OFFSET + num_hands * LANDMARK_BYTES])
+            (seq_after,) = SEQ.unpack_from(buf, 0)
+            if seq_after == seq_before:                          # 読み出し中に書き換えられていなければ採用
+                self.last_seq = seq_before
+                self.last_update = time.monotonic()
+                return {
+                    "seq": seq_before,
+                    "timestamp": timestamp,
+                    "frame_index": frame_index,
+                    "min_depth": None if math.isnan(min_depth) else min_depth,
+                    "num_hands": num_hands,
+                    "landmarks": landmarks,
+                    "trace": {key: value for key, value in zip(TRACE_KEYS, trace_values) if not math.isnan(value)},
+                }
+        return None
+
+    def wait_for_update(self, timeout=None, poll_interval=POLL_INTERVAL, idle_poll_interval=IDLE_POLL_INTERVAL, idle_after=IDLE_AFTER):
+        """
+        新しい値が来るまでポーリングで待つ。最後の更新から idle_after 秒以上経っていれば idle_poll_interval ごとに確認する。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            value = self.read()
+            if value is not None:
+                return value
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return None
+            interval = idle_poll_interval if now - self.last_update >= idle_after else poll_interval
+            if deadline is not None:
+                interval = min(interval, deadline - now)
+            time.sleep(interval)
+
+    def close(self):                                             # attachを解除する（セグメントは削除しない）
+        self.shm.close()
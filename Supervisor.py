@@ -0,0 +1,324 @@
+# Supervisor.py
+
+# RunAll.bat の代わりに BlackBoard / BehaviorManager / VisionManager / CmdClient を起動・監視するランチャー（Windows / Linux）。
+# 固定の待ち時間を置かずに全プロセスを同時に起動する（各クライアントはBlackBoardが待機を始めるまで接続を再試行する）。
+# 起動完了は実際の状態で判定する:
+#   - BlackBoard: このプロセスが接続できた時点（待機中）
+#   - 各クライアント: BlackBoardに登録された時点（CMD;watch_clients で接続・切断の通知を受け取る）
+# 全コンポーネントの起動完了までの時間を表示し、異常終了したコンポーネントは再起動する。
+# CmdClient の Exit All（CMD;shutdown）ではこのプロセスにもEXITが届き、全プロセスの終了を待って終了する。
+#
+# 使い方:
+#   python Supervisor.py                              # すべて起動（出力は1つのコンソールにコンポーネント名付きで表示）
+#   python Supervisor.py --skip VisionManager         # カメラの無いPCなど、一部を起動しない
+#   python Supervisor.py --arduino-port /dev/pts/5    # BehaviorManagerに渡す（ArduinoEmulator.py と組み合わせる）
+#   python Supervisor.py --new-consoles               # Windowsで従来どおりコンポーネントごとにウィンドウを開く
+#   Ctrl+C で CMD;shutdown を送り、全体を終了する（2回押すと強制終了）。
+
+import argparse                                   # コマンドライン引数の解析用
+import json                                       # 起動時間のJSON出力用
+import os                                         # スクリプトのディレクトリ・環境変数用
+import queue                                      # 監視スレッドからのイベント受け渡し用
+import signal                                     # 終了シグナルの処理用
+import subprocess                                 # コンポーネントのプロセス起動用
+import sys                                        # 同じPython（仮想環境）でコンポーネントを起動するため
+import threading                                  # 出力の中継・BlackBoard受信用スレッド
+import time                                       # 起動時間の計測用
+from BlackBoardProtocol import (                  # BlackBoard通信フレームの定義
+    connect_blackboard, send_frame, send_hello, iter_frames, MSG_ROUTE, MSG_EXIT, MSG_ACK,
+)
+
+HOST = 'localhost'                                # BlackBoardサーバのホスト名
+PORT = 9000                                       # BlackBoardサーバのポート番号
+CLIENT_NAME = 'Supervisor'                        # このプロセスのクライアント名
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # 各スクリプトの場所（RunAll.bat と同様に作業ディレクトリにする）
+
+COMPONENTS = [                                    # (表示名, スクリプト, BlackBoardでのクライアント名。Noneならサーバ本体)
+    ("BlackBoard", "BlackBoard.py", None),
+    ("BehaviorManager", "BehaviorManager.py", "BM"),
+    ("VisionManager", "VisionManager.py", "VM"),
+    ("CmdClient", "CmdClient.py", "Cmd"),
+]
+READY_TIMEOUT = 60.0                              # この秒数で起動が完了しないコンポーネントを警告する
+RESTART_DELAY = 1.0                               # 異常終了から再起動までの秒数（CmdClientの Exit All 直後の終了と区別するため少し待つ）
+MAX_RESTARTS = 5                                  # コンポーネントごとの再起動の上限
+SHUTDOWN_TIMEOUT = 10.0                           # 終了指示からこの秒数で終わらないプロセスは強制終了する
+KILL_DELAY = 2.0                                  # 再起動のために止めたプロセスがこの秒数で終わらなければ強制終了する
+TICK = 0.1                                        # 再起動・タイムアウトの確認間隔（秒）
+
+class Component:
+    """
+    1つのコンポーネント（子プロセス）の状態。出力の中継と終了待ちは専用スレッドで行い、終了は events に通知する。
+    """
+    def __init__(self, name, script, client_name, args=()):
+        self.name = name
+        self.script = script
+        self.client_name = client_name
+        self.args = list(args)
+        self.process = None
+        self.started_at = None                    # 最後に起動した時刻（time.perf_counter）
+        self.ready_at = None                      # 最後の起動で準備完了した時刻
+        self.first_ready_s = None                 # 初回起動の準備完了までの秒数（セッション開始から）
+        self.restarts = 0
+        self.restart_at = None                    # 再起動予定時刻
+        self.force_restart = False                # このプロセスから止めた場合は終了コードに関わらず再起動する
+        self.stop_requested_at = None             # 終了を指示した時刻（応答しないプロセスを強制終了するため）
+        self.exit_code = None
+
+    def start(self, events, new_console=False):
+        env = dict(os.environ, PYTHONUNBUFFERED="1", PYTHONIOENCODING="utf-8")  # 出力を遅らせず、文字化けさせない
+        kwargs = {"cwd": BASE_DIR, "env": env, "stdin": subprocess.DEVNULL}
+        if os.name == "nt":                       # コンソールのCtrl+Cは子プロセスに届けず、このプロセスが終了手順を進める
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+            if new_console:
+                kwargs["creationflags"] |= subprocess.CREATE_NEW_CONSOLE
+        else:
+            kwargs["start_new_session"] = True
+        if not new_console:
+            kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.started_at = time.perf_counter()
+        self.ready_at = None
+        self.restart_at = None
+        self.force_restart = False
+        self.stop_requested_at = None
+        self.exit_code = None
+        self.process = subprocess.Popen([sys.executable, self.script, *self.args], **kwargs)
+        threading.Thread(target=self._watch, args=(self.process, events), daemon=True).start()
+
+    def _watch(self, process, events):            # 出力に表示名を付けて中継し、終了したら通知する
+        if process.stdout:
+            for line in process.stdout:
+                print(f"[{self.name}] {line.decode('utf-8', errors='replace').rstrip()}", flush=True)
+        events.put(("exited", self, process.wait()))
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, kill=False):
+        if self.alive():
+            self.stop_requested_at = self.stop_requested_at or time.perf_counter()
+            self.process.kill() if kill else self.process.terminate()
+
+class Supervisor:
+    def __init__(self, components, restart=True, new_console=False):
+        self.components = components
+        self.by_client = {c.client_name: c for c in components if c.client_name}
+        self.blackboard = next((c for c in components if c.client_name is None), None)
+        self.restart = restart
+        self.new_console = new_console
+        self.events = queue.Queue()
+        self.sock = None                          # BlackBoardとの接続（終了指示の送受信用）
+        self.stopping = False
+        self.stop_requested_at = None
+        self.all_ready_s = None                   # 全コンポーネントが初めて揃うまでの秒数
+        self.start_time = None
+
+    # --- BlackBoardとの接続 ---
+    def watch_blackboard(self):
+        """
+        BlackBoardに接続して接続・切断の通知を受け取る。BlackBoardが再起動した場合は接続し直す。
+        """
+        while not self.stopping:
+            try:
+                sock = connect_blackboard(HOST, PORT, timeout=READY_TIMEOUT)
+            except OSError:
+                continue                          # 起動に時間がかかっている（または再起動待ち）
+            self.events.put(("listening", None, None))
+            try:
+                send_hello(sock, CLIENT_NAME)
+                self.sock = sock
+                send_frame(sock, MSG_ROUTE, "CMD", "watch_clients")
+                for msg_type, sender, content in iter_frames(sock):
+                    if msg_type == MSG_EXIT:      # CMD;shutdown による全体終了
+                        send_frame(sock, MSG_ACK, "", "EXIT_RECEIVED")
+                        self.events.put(("shutdown", None, None))
+                    elif msg_type == MSG_ROUTE and sender == "CMD":
+                        event, _, names = content.partition(":")
+                        if event == "clients":    # 登録済みの一覧（既に接続していたクライアントも準備完了とみなす）
+                            for name in filter(None, names.split(",")):
+                                self.events.put(("joined", None, name))
+                        elif event in ("joined", "left"):
+                            self.events.put((event, None, names))
+            except OSError:
+                pass
+            finally:
+                self.sock = None
+                sock.close()
+            self.events.put(("disconnected", None, None))
+
+    def request_shutdown(self):                   # BlackBoard経由で全体に終了を指示する（接続が無ければ直接止める）
+        if self.stopping:
+            return
+        sock = self.sock
+        if sock:
+            try:
+                send_frame(sock, MSG_ROUTE, "CMD", "shutdown")
+                print("[Supervisor] CMD;shutdown を送信しました。")
+                return                            # EXITが届いた時点で終了待ちに入る
+            except OSError:
+                pass
+        self.begin_stop()
+        for component in self.components:
+            component.stop()
+
+    def begin_stop(self):
+        if not self.stopping:
+            self.stopping = True
+            self.stop_requested_at = time.perf_counter()
+
+    # --- イベント処理 ---
+    def elapsed(self, since=None):
+        return time.perf_counter() - (self.start_time if since is None else since)
+
+    def mark_ready(self, component):
+        if component is None or component.ready_at is not None or not component.alive():
+            return
+        component.ready_at = time.perf_counter()
+        took = component.ready_at - component.started_at
+        if component.first_ready_s is None:
+            component.first_ready_s = self.elapsed()
+        print(f"[Supervisor] {component.name} 準備完了（起動から {took:.2f} 秒）")
+        if self.all_ready_s is None and all(c.ready_at is not None for c in self.components):
+            self.all_ready_s = self.elapsed()
+            print(f"[Supervisor] 全コンポーネントの準備完了: {self.all_ready_s:.2f} 秒")
+
+    def handle_exit(self, component, code):
+        component.exit_code = code
+        if self.stopping:
+            print(f"[Supervisor] {component.name} 終了（終了コード {code}）")
+            return
+        if component is self.blackboard:         # サーバが止まるとクライアントは再接続しないため、まとめて起動し直す
+            if code == 0 and not component.force_restart:
+                print("[Supervisor] BlackBoardが終了しました。全体を終了します。")
+                self.begin_stop()
+                return
+            for client in self.by_client.values():
+                if client.alive():
+                    client.force_restart = True
+                    client.stop()
+        if code == 0 and not component.force_restart:
+            print(f"[Supervisor] {component.name} が終了しました（再起動しません）")
+            return
+        if not self.restart or component.restarts >= MAX_RESTARTS:
+            print(f"[Supervisor] {component.name} が異常終了しました（終了コード {code}）。再起動しません。")
+            return
+        component.restart_at = time.perf_counter() + RESTART_DELAY
+        print(f"[Supervisor] {component.name} が異常終了しました（終了コード {code}）。{RESTART_DELAY:.1f} 秒後に再起動します。")
+
+    def tick(self):                               # 再起動の実行と、終了待ち・起動待ちのタイムアウト判定
+        now = time.perf_counter()
+        if self.stopping:
+            waited = now - self.stop_requested_at
+            for component in self.components:
+                component.restart_at = None       # 終了中は再起動しない
+                if component.alive() and waited >= SHUTDOWN_TIMEOUT:
+                    print(f"[Supervisor] {component.name} が終了しないため強制終了します。")
+                    component.stop(kill=waited >= SHUTDOWN_TIMEOUT + 2.0)
+            return
+        for component in self.components:
+            if component.force_restart and component.alive() and now - component.stop_requested_at >= KILL_DELAY:
+                component.stop(kill=True)         # ハングしていて終了指示に応答しない
+            if component.restart_at is not None and now >= component.restart_at:
+                component.restarts += 1
+                print(f"[Supervisor] {component.name} を再起動します（{component.restarts}回目）")
+                component.start(self.events, self.new_console)
+            elif (component.alive() and component.ready_at is None and component.started_at is not None
+                  and now - component.started_at >= READY_TIMEOUT):
+                print(f"[Supervisor] {component.name} が {READY_TIMEOUT:.0f} 秒以内に準備完了になりません。")
+                component.started_at = now        # 警告を繰り返しすぎないよう、次の警告まで待つ
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        for component in self.components:         # 固定の待ち時間を置かずに同時に起動する
+            component.start(self.events, self.new_console)
+        threading.Thread(target=self.watch_blackboard, daemon=True).start()
+        interrupted = False
+        try:
+            while not self.all_exited() or any(c.restart_at is not None for c in self.components):
+                try:
+                    try:
+                        kind, component, payload = self.events.get(timeout=TICK)
+                    except queue.Empty:
+                        kind = None
+                    if kind == "listening":
+                        self.mark_ready(self.blackboard)
+                    elif kind == "joined":
+                        self.mark_ready(self.by_client.get(payload))
+                    elif kind == "left":
+                        client = self.by_client.get(payload)
+                        if client and client.alive() and not self.stopping:  # クライアントは再接続しないため、起動し直す
+                            print(f"[Supervisor] {client.name} がBlackBoardから切断されました（応答なし等）。再起動します。")
+                            client.force_restart = True
+                            client.stop()
+                    elif kind == "shutdown":
+                        print("[Supervisor] 終了指示を受信しました。全プロセスの終了を待ちます。")
+                        self.begin_stop()
+                    elif kind == "exited":
+                        self.handle_exit(component, payload)
+                    self.tick()
+                except KeyboardInterrupt:
+                    if interrupted:               # 2回目のCtrl+Cは待たずに止める
+                        self.begin_stop()
+                        for c in self.components:
+                            c.stop(kill=True)
+                    else:
+                        interrupted = True
+                        print("[Supervisor] Ctrl+C を受け取りました。全体を終了します（もう一度押すと強制終了）。")
+                        self.request_shutdown()
+        finally:                                  # このプロセスが止められた場合（SIGTERM等）も子プロセスを残さない
+            for c in self.components:
+                c.stop()
+        self.begin_stop()
+        return self.summary()
+
+    def all_exited(self):                         # すべてのプロセスが終了し、終了通知も処理済みか
+        return all(c.process is None or (c.process.poll() is not None and c.exit_code is not None)
+                   for c in self.components)
+
+    def summary(self):
+        shutdown_s = self.elapsed(self.stop_requested_at) if self.stop_requested_at else None
+        result = {
+            "ready_s": self.all_ready_s,
+            "shutdown_s": shutdown_s,
+            "components": {c.name: {"ready_s": c.first_ready_s, "restarts": c.restarts, "exit_code": c.exit_code}
+                           for c in self.components},
+        }
+        print("[Supervisor] 起動時間（セッション開始から準備完了まで）:")
+        for c in self.components:
+            ready = f"{c.first_ready_s:.2f} 秒" if c.first_ready_s is not None else "準備完了せず"
+            print(f"  {c.name:16s} {ready}, 再起動 {c.restarts} 回, 終了コード {c.exit_code}")
+        if self.all_ready_s is not None:
+            print(f"  全体: {self.all_ready_s:.2f} 秒")
+        if shutdown_s is not None:
+            print(f"  終了指示から全プロセス終了まで: {shutdown_s:.2f} 秒")
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(description="BlackBoardと各クライアントを起動・監視する（RunAll.bat の代わり）")
+    parser.add_argument("--skip", nargs="+", default=[], metavar="NAME",
+                        help="起動しないコンポーネント（BlackBoard, BehaviorManager, VisionManager, CmdClient）")
+    parser.add_argument("--arduino-port", help="BehaviorManagerに渡すシリアルポート")
+    parser.add_argument("--no-restart", action="store_true", help="異常終了したコンポーネントを再起動しない")
+    parser.add_argument("--new-consoles", action="store_true", help="コンポーネントごとにコンソールウィンドウを開く（Windowsのみ）")
+    parser.add_argument("--json", help="起動時間・再起動回数をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    components = []
+    for name, script, client_name in COMPONENTS:
+        if name in args.skip or (client_name and client_name in args.skip):
+            continue
+        extra = ["--arduino-port", args.arduino_port] if name == "BehaviorManager" and args.arduino_port else []
+        components.append(Component(name, script, client_name, extra))
+    if not components:
+        raise SystemExit("起動するコンポーネントがありません。")
+    print("[Supervisor] 起動: " + ", ".join(c.name for c in components))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))  # 終了させられたときも子プロセスを止める
+    supervisor = Supervisor(components, restart=not args.no_restart, new_console=args.new_consoles and os.name == "nt")
+    result = supervisor.run()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# TrafficCapture.py
+
+# BlackBoardが転送したメッセージを記録するバイナリ形式のキャプチャ（TrafficReplay.py で再生する）。
+# テキストのログ（log*_blackBoard.log）と違い、受信時刻・送信元・宛先・内容をそのまま残すため、
+# 展示中のセッションの通信を後から同じ間隔で再現できる。
+#
+# ファイル形式（リトルエンディアン）:
+#   ヘッダ  : MAGIC（6byte）, 記録開始時のUNIX時刻（float64）
+#   レコード: [受信時刻 float64（記録開始からの秒, time.monotonic 基準）][種別 uint8][送信元名長 uint8][宛先名長 uint8]
+#             [内容長 uint32][送信元名 UTF-8][宛先名 UTF-8][内容 UTF-8]
+#   レコードはファイルの終わりまで続く（途中で途切れたレコードは読み出し時に無視する）。
+
+import queue                                      # 記録スレッドへの受け渡し用
+import struct                                     # ヘッダ・レコードのパック用
+import threading                                  # 記録スレッド用
+import time                                       # 受信時刻用
+
+MAGIC = b"BBCAP\x01"                              # ファイルの先頭（形式の版を含む）
+FILE_HEADER = struct.Struct("<d")                 # 記録開始時のUNIX時刻
+RECORD_HEADER = struct.Struct("<dBBBI")           # 受信時刻, 種別, 送信元名長, 宛先名長, 内容長
+
+class TrafficRecorder:
+    """
+    BlackBoardの転送メッセージのレコーダ。record() はキューに積むだけで、エンコードと書き込みは記録スレッドで行う。
+    ディスクが追いつかずキューが満杯になった場合はメッセージを捨てて数える（転送処理は待たせない）。
+    """
+    def __init__(self, path, max_queue=100000):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + FILE_HEADER.pack(time.time()))
+        self.start = time.monotonic()
+        self.queue = queue.Queue(max_queue)
+        self.recorded = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, msg_type, source, target, payload):  # 受信したメッセージを1件記録する（payload は str）
+        try:
+            self.queue.put_nowait((time.monotonic() - self.start, msg_type, source, target, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:                      # close() からの終了の合図
+                break
+            t, msg_type, source, target, payload = item
+            source, target, payload = source.encode(), target.encode(), payload.encode()
+            self.file.write(RECORD_HEADER.pack(t, msg_type, len(source), len(target), len(payload)) + source + target + payload)
+            self.recorded += 1
+            if self.queue.empty():
+                self.file.flush()                 # 途中で強制終了されても、ここまでのレコードは残す
+
+    def close(self):                              # キューに残ったメッセージを書き出して閉じる
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+class TrafficCapture:
+    """
+    TrafficRecorder で記録したファイルを読み出す。反復すると (受信時刻, 種別, 送信元, 宛先, 内容) を記録順に返す。
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(len(MAGIC) + FILE_HEADER.size)
+        if len(header) < len(MAGIC) + FILE_HEADER.size or not header.startswith(MAGIC):
+            raise ValueError(f"BlackBoardのキャプチャではありません: {path}")
+        (self.start_time,) = FILE_HEADER.unpack_from(header, len(MAGIC))  # 記録開始時のUNIX時刻
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        pos = len(MAGIC) + FILE_HEADER.size
+        while pos + RECORD_HEADER.size <= len(data):
+            t, msg_type, source_len, target_len, payload_len = RECORD_HEADER.unpack_from(data, pos)
+            pos += RECORD_HEADER.size
+            end = pos + source_len + target_len + payload_len
+            if end > len(data):                   # 記録中に終了して途切れたレコード
+                break
+            source = data[pos:pos + source_len].decode(errors="replace")
+            target = data[pos + source_len:pos + source_len + target_len].decode(errors="replace")
+            payload = data[pos + source_len + target_len:end].decode(errors="replace")
+            pos = end
+            yield t, msg_type, source, target, payload
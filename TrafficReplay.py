@@ -0,0 +1,152 @@
+# TrafficReplay.py
+
+# BlackBoardのキャプチャ（Log/BlackBoardLog/log*_traffic.bbcap）を、動作中のBlackBoardに記録時の送信元として送り直す。
+# 展示中のセッションの通信（VMの Depth、Cmd の操作など）を同じ間隔・倍速・最大速度で再現し、
+# BlackBoardやBehaviorManagerの負荷試験を繰り返し行えるようにする。
+#
+# 使い方（BlackBoardと、再生先のクライアント（BehaviorManager等）は先に起動しておく）:
+#   python TrafficReplay.py Log/BlackBoardLog/log3_traffic.bbcap              # 記録時と同じ速度
+#   python TrafficReplay.py Log/BlackBoardLog/log3_traffic.bbcap --speed 4    # 4倍速
+#   python TrafficReplay.py Log/BlackBoardLog/log3_traffic.bbcap --speed 0    # 待ち時間無し（最大速度）
+#   python TrafficReplay.py log3_traffic.bbcap --sources VM                   # VMの送信だけ再現する（実際のBMに送る）
+#
+# 注意:
+#   - 送信元と同じ名前のクライアントが接続中だと登録を拒否される（--suffix で名前を変えられる）。
+#   - CMD;shutdown は再生しない。その他の CMD 宛て（stats等）は --include-cmd を付けた場合のみ再生する。
+#   - 遅延トレースは記録時の時刻のままでは意味が無いため、既定では取り除いて送る。
+
+import argparse                                   # コマンドライン引数の解析用
+import json                                       # 結果のJSON出力用
+import socket                                     # TCP_NODELAYの設定用
+import threading                                  # 受信スレッド用
+import time                                       # 送信時刻の管理用
+import numpy as np                                # 送信遅れの集計用
+from BlackBoardProtocol import (                  # BlackBoard通信フレームの定義
+    connect_blackboard, send_frame, send_hello, iter_frames, MSG_ROUTE, MSG_EXIT, MSG_ACK, MSG_ERROR,
+)
+from TrafficCapture import TrafficCapture         # キャプチャの読み出し
+import LatencyTrace                               # 遅延トレースの除去用
+
+HOST = 'localhost'                                # BlackBoardサーバのホスト名
+PORT = 9000                                       # BlackBoardサーバのポート番号
+SETTLE_TIME = 0.2                                 # 登録後、拒否（名前の重複等）の通知を待つ秒数
+
+class ReplayClient:
+    """
+    記録時の送信元1つ分の接続。受信スレッドでEXITにACKを返し、エラー通知を表示する。
+    """
+    def __init__(self, name, stop_event):
+        self.name = name
+        self.stop_event = stop_event
+        self.sock = connect_blackboard(HOST, PORT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 記録時の間隔を崩さないよう、まとめて送らない
+        self.rejected = False
+        send_hello(self.sock, name)
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):
+        try:
+            for msg_type, sender, content in iter_frames(self.sock):
+                if msg_type == MSG_EXIT:          # BlackBoardの終了に合わせて再生を止める
+                    send_frame(self.sock, MSG_ACK, "", "EXIT_RECEIVED")
+                    print(f"[再生] {self.name}: EXITを受信しました。再生を止めます。")
+                    self.stop_event.set()
+                    break
+                if msg_type == MSG_ERROR:
+                    print(f"[再生] {self.name}: {content}")
+        except OSError:
+            pass
+        self.rejected = True                      # 切断された（登録の拒否を含む）
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def load_records(path, sources=None, include_cmd=False, keep_traces=False):
+    """
+    キャプチャから再生するメッセージを (受信時刻, 送信元, 宛先, 内容) のリストで返す。
+    """
+    records = []
+    for t, msg_type, source, target, payload in TrafficCapture(path):
+        if msg_type != MSG_ROUTE or (sources and source not in sources):
+            continue
+        if target == "CMD" and (not include_cmd or payload == "shutdown"):
+            continue
+        if not keep_traces:
+            payload, _ = LatencyTrace.split_trace(payload)
+        records.append((t, source, target, payload))
+    return records
+
+def replay(records, speed=1.0, suffix=""):
+    """
+    records を speed 倍の速度で送る（0以下なら待たずに送る）。送信数と、予定時刻からの送信の遅れを返す。
+    """
+    stop_event = threading.Event()
+    clients = {}
+    for source in dict.fromkeys(source for _, source, _, _ in records):  # 記録順に、送信元ごとに接続する
+        clients[source] = ReplayClient(source + suffix, stop_event)
+    time.sleep(SETTLE_TIME)
+    for client in clients.values():
+        if client.rejected:
+            raise SystemExit(f"{client.name} として登録できませんでした（同じ名前のクライアントが接続中なら --suffix を指定する）。")
+
+    sent = {source: 0 for source in clients}
+    lateness = []
+    first = records[0][0] if records else 0.0
+    start = time.perf_counter()
+    try:
+        for t, source, target, payload in records:
+            if stop_event.is_set():
+                break
+            if speed > 0:
+                due = start + (t - first) / speed
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                lateness.append(time.perf_counter() - due)
+            send_frame(clients[source].sock, MSG_ROUTE, target, payload)
+            sent[source] += 1
+    except OSError as e:
+        print(f"[再生] 送信に失敗しました: {e}")
+    wall = time.perf_counter() - start
+    for client in clients.values():
+        client.close()
+    return sent, wall, np.array(lateness)
+
+def main():
+    parser = argparse.ArgumentParser(description="BlackBoardのキャプチャを記録時の送信元として送り直す")
+    parser.add_argument("capture", help="キャプチャファイル（log*_traffic.bbcap）")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率（0で待ち時間無し）")
+    parser.add_argument("--sources", nargs="+", help="再生する送信元（省略時はすべて）")
+    parser.add_argument("--suffix", default="", help="送信元名に付ける文字列（実際のクライアントと同時に接続する場合）")
+    parser.add_argument("--include-cmd", action="store_true", help="CMD宛てのメッセージも再生する（shutdownは除く）")
+    parser.add_argument("--keep-traces", action="store_true", help="遅延トレースを取り除かずに送る")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    capture = TrafficCapture(args.capture)
+    records = load_records(args.capture, args.sources, args.include_cmd, args.keep_traces)
+    if not records:
+        raise SystemExit("再生するメッセージがありません。")
+    duration = records[-1][0] - records[0][0]
+    print(f"[再生] {len(records)} 件（記録開始 {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(capture.start_time))}, "
+          f"{duration:.1f} 秒分）を{'最大速度' if args.speed <= 0 else f'{args.speed:g}倍速'}で再生します。")
+
+    sent, wall, lateness = replay(records, args.speed, args.suffix)
+    total = sum(sent.values())
+    print(f"[再生] 送信 {total} 件 / {wall:.2f} 秒（{total / wall if wall > 0 else 0:.0f} 件/秒）, 送信元ごと: {sent}")
+    result = {"capture": args.capture, "speed": args.speed, "records": len(records), "sent": sent,
+              "wall_time": wall, "capture_duration": duration}
+    if len(lateness):
+        result["lateness_ms"] = {"p50": float(np.percentile(lateness, 50) * 1000), "p99": float(np.percentile(lateness, 99) * 1000),
+                                 "max": float(lateness.max() * 1000)}
+        print(f"[再生] 予定時刻からの送信の遅れ: p50 {result['lateness_ms']['p50']:.2f} ms, "
+              f"p99 {result['lateness_ms']['p99']:.2f} ms, 最大 {result['lateness_ms']['max']:.2f} ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# VisionBenchmark.py
+
+# カメラ無しでVisionManagerの処理パイプライン（キャプチャ → 推論 → 送信 / 描画）を計測するベンチマーク。
+# 記録済みの入力（RealSenseの .bag、またはVisionManagerの記録 log{N}_colorRaw.mp4 + log{N}_depthRaw）を
+# 最大速度で再生し、フレームを捨てずに全フレームを処理したときのスループットと段ごとの処理時間を表示する。
+# BlackBoardへの接続・画面表示・ログ保存は行わない。pyrealsense2 は .bag を使う場合のみ必要。
+#
+# 使い方:
+#   python VisionBenchmark.py --recording Log/VideoLog/log3
+#   python VisionBenchmark.py --bag sample.bag --json result.json
+#   python VisionBenchmark.py --recording Log/VideoLog/log3 --realtime   # 記録時の速度で再生
+#   python VisionBenchmark.py --recording Log/VideoLog/log3 --stride 3   # 3フレームに1回推論し、間は予測する
+#   python VisionBenchmark.py --recording Log/VideoLog/log3 --stride 3 --no-filter  # 平滑化せずに間引きだけを計測する
+#   python VisionBenchmark.py --recording Log/VideoLog/log3 --stride 1 --no-filter  # 平滑化・推論の間引きを無効にして比べる
+#   python VisionBenchmark.py --recording Log/VideoLog/log3 --no-adaptive  # 品質を自動調整せず最高品質のまま計測する
+#   python VisionBenchmark.py --recording Log/VideoLog/log3 --budget-ms 20  # 1フレーム20msの予算で品質を自動調整する
+
+import argparse                                   # コマンドライン引数の解析用
+import json                                       # 結果のJSON出力用
+import os                                         # CPU数の取得用
+import platform                                   # 実行環境の記録用
+import VisionManager                              # 計測対象のパイプライン
+from FrameSource import RealSenseSource, RecordingSource
+
+def run_benchmark(source, save_logs=False):
+    """
+    source を入力にVisionManagerのパイプラインを1回実行し、集計結果の辞書を返す。
+    save_logs=False（既定）では映像・手ランドマーク・深度のログを保存しない。
+    """
+    if not save_logs:
+        VisionManager.SAVE_VIDEO_LOGS = False
+        VisionManager.SAVE_HANDLANDMARK_LOGS = False
+        VisionManager.SAVE_RAW_DEPTH_LOGS = False
+        VisionManager.SAVE_QUALITY_LOGS = False
+    result = VisionManager.main(source=source, use_blackboard=False, display=False)
+    if result is None:
+        raise SystemExit("フレームソースを開始できませんでした。")
+    frames = result["stages"]["inference"]["processed"]
+    result["frames"] = frames
+    result["fps"] = frames / result["wall_time"] if result["wall_time"] > 0 else 0.0
+    result["environment"] = {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count()}
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="VisionManagerのパイプラインを記録済み入力で計測する")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--bag", help="RealSenseの .bag ファイル")
+    group.add_argument("--recording", help="VisionManagerの記録のパス（例: Log/VideoLog/log3）")
+    parser.add_argument("--width", type=int, default=VisionManager.frame_width, help=".bag再生時の横解像度")
+    parser.add_argument("--height", type=int, default=VisionManager.frame_height, help=".bag再生時の縦解像度")
+    parser.add_argument("--fps", type=int, default=VisionManager.frame_rate, help=".bag再生時のフレームレート")
+    parser.add_argument("--realtime", action="store_true", help="最大速度ではなく記録時の速度で再生する")
+    parser.add_argument("--save-logs", action="store_true", help="logging_config.json に従ってログも保存する")
+    parser.add_argument("--stride", type=int, help="何フレームに1回推論するか（vision_config.json の inference_stride を上書き）")
+    parser.add_argument("--filter", dest="filter", action="store_true", default=None, help="ランドマークの平滑化を有効にする")
+    parser.add_argument("--no-filter", dest="filter", action="store_false", help="ランドマークの平滑化を無効にする（推論の間引きは --stride に従う）")
+    parser.add_argument("--adaptive", dest="adaptive", action="store_true", default=None, help="処理時間に応じて品質を自動調整する")
+    parser.add_argument("--no-adaptive", dest="adaptive", action="store_false", help="品質を自動調整せず最高品質のまま処理する")
+    parser.add_argument("--budget-ms", type=float, help="1フレームの処理時間の予算[ms]（vision_config.json の frame_budget_ms を上書き）")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    if args.filter is not None:
+        VisionManager.LANDMARK_FILTER = args.filter
+    if args.stride:
+        VisionManager.INFERENCE_STRIDE = max(1, args.stride)
+    if args.adaptive is not None:
+        VisionManager.ADAPTIVE_QUALITY = args.adaptive
+    if args.budget_ms:
+        VisionManager.FRAME_BUDGET_MS = args.budget_ms
+
+    if args.bag:
+        source = RealSenseSource(args.width, args.height, args.fps, bag_path=args.bag, realtime=args.realtime)
+    else:
+        source = RecordingSource(args.recording, realtime=args.realtime)
+
+    result = run_benchmark(source, args.save_logs)
+    result["input"] = args.bag or args.recording
+    result["realtime"] = args.realtime
+    result["landmark_filter"] = VisionManager.LANDMARK_FILTER
+    result["inference_stride"] = VisionManager.INFERENCE_STRIDE
+    result["adaptive_quality"] = VisionManager.ADAPTIVE_QUALITY
+
+    print(f"\n[ベンチマーク] {result['frames']} フレーム / {result['wall_time']:.2f} 秒 = {result['fps']:.1f} fps")
+    for name, st in result["stages"].items():
+        print(f"  {name:<10} {st['fps']:7.1f} fps  平均 {st['avg_ms']:6.1f} ms/frame  "
+              f"処理 {st['processed']}  破棄 {st['dropped']}")
+    print("  推論: " + ", ".join(f"{name} {count}" for name, count in result["inference_counts"].items()))
+    if result["depth"]["jitter_mm"] is not None:
+        print(f"  深度: 送信 {result['depth']['frames']} フレーム, 揺れ {result['depth']['jitter_mm']:.2f} mm")
+    if result["adaptive_quality"]:
+        print(f"  品質: レベルの変更 {len(result['quality']['changes'])} 回, "
+              f"レベルごとのフレーム数 {result['quality']['frames_per_level']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"[ベンチマーク] 結果を保存しました: {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,7 @@
 
 running = True  # VisionManager全体の稼働フラグをTrueに設定する
 
-import socket                                    # ソケット通信を行うためのライブラリをインポート
 import threading                                 # スレッド処理用のライブラリをインポート
-import pyrealsense2 as rs                        # Intel RealSense用Pythonラッパーをインポート
 import mediapipe as mp                           # MediaPipeライブラリをインポート
 import cv2                                       # OpenCVライブラリをインポート
 import numpy as np                               # NumPyライブラリをインポート
@@ -15,6 +13,21 @@ import os                                       # OS操作用ライブラリを
 import glob                                     # ファイルパスの検索に使用するライブラリをインポート
 import re                                       # 正規表現操作用ライブラリをインポート
 import json                                     # JSONファイル読み書き用ライブラリをインポート
+import queue                                    # パイプライン段の間をつなぐキュー用ライブラリをインポート
+from collections import deque                   # 非同期推論の結果待ちフレームの保持用
+from BlackBoardProtocol import (                # BlackBoard通信フレームの定義をインポート
+    connect_blackboard, send_frame, send_hello, iter_frames, MSG_ROUTE, MSG_EXIT, MSG_ACK, MSG_SHM_OFFER, MSG_SHM_ACCEPT,
+)
+from SharedLatestValue import LatestValueWriter # 同一PC内の共有メモリ最新値スロットをインポート
+from HandLandmarkLog import HandLandmarkLogWriter, hand_arrays_to_dicts  # 手ランドマークログのライターをインポート
+from DepthRecorder import DepthRecorder         # 深度の可逆記録用レコーダをインポート
+from ColorRecorder import ColorRecorder         # 再生用のカラー映像のレコーダをインポート
+from FrameSource import create_frame_source     # カメラ・記録ファイルのフレームソースをインポート
+import LatencyTrace                             # カメラからサーボ指令までの遅延トレース
+from HandLandmarkerBackend import AsyncHandLandmarker  # MediaPipe Tasks の非同期手検出バックエンド
+from HandFilter import HandTracker               # 手ごとのランドマーク平滑化と位置の予測
+from QualityController import QualityController  # 処理時間に応じた品質レベルの制御
+from mediapipe.framework.formats import landmark_pb2  # 平滑化・予測したランドマークの描画用
 
 # --- ログ設定読み込み ---
 try:
@@ -22,11 +35,80 @@ try:
         config_data = json.load(f)                                  # JSONデータとして読み込む
     SAVE_VIDEO_LOGS = config_data.get("save_video_logs", False)     # 映像ログ記録設定を取得（無ければFalse）
     SAVE_HANDLANDMARK_LOGS = config_data.get("save_handLandmark_logs", False) # 手ランドマークログ設定を取得（無ければFalse）
-    print(f"[設定] SAVE_VIDEO_LOGS={SAVE_VIDEO_LOGS}, SAVE_HANDLANDMARK_LOGS={SAVE_HANDLANDMARK_LOGS}")  # 設定内容を表示
+    HANDLANDMARK_LOG_FORMAT = config_data.get("handLandmark_log_format", "columnar")  # 手ランドマークログ形式（columnar / ndjson）
+    SAVE_RAW_DEPTH_LOGS = config_data.get("save_raw_depth_logs", False)  # 深度の可逆記録設定を取得（無ければFalse）
+    TRACE_LATENCY = config_data.get("trace_latency", False)         # 遅延トレースを付けるか（無ければFalse）
+    SAVE_QUALITY_LOGS = config_data.get("save_quality_logs", False) # 品質レベルの変更ログ設定を取得（無ければFalse）
+    print(f"[設定] SAVE_VIDEO_LOGS={SAVE_VIDEO_LOGS}, SAVE_HANDLANDMARK_LOGS={SAVE_HANDLANDMARK_LOGS}, "
+          f"HANDLANDMARK_LOG_FORMAT={HANDLANDMARK_LOG_FORMAT}, SAVE_RAW_DEPTH_LOGS={SAVE_RAW_DEPTH_LOGS}, "
+          f"TRACE_LATENCY={TRACE_LATENCY}, SAVE_QUALITY_LOGS={SAVE_QUALITY_LOGS}")  # 設定内容を表示
 except Exception as e:
     print(f"[設定エラー] logging_config.json の読み込みに失敗しました: {e}")  # 設定読み込み失敗時にエラーメッセージを表示
     SAVE_VIDEO_LOGS = False                                       # 設定失敗時はFalseに設定
     SAVE_HANDLANDMARK_LOGS = False                               # 設定失敗時はFalseに設定
+    HANDLANDMARK_LOG_FORMAT = "columnar"                          # 設定失敗時は既定の形式
+    SAVE_RAW_DEPTH_LOGS = False                                   # 設定失敗時はFalseに設定
+    TRACE_LATENCY = False                                         # 設定失敗時はFalseに設定
+    SAVE_QUALITY_LOGS = False                                     # 設定失敗時はFalseに設定
+
+# --- 映像入力設定読み込み ---
+try:
+    with open("vision_config.json", "r", encoding="utf-8") as f:   # 映像入力設定ファイルを読み込み
+        vision_config = json.load(f)
+    FRAME_SOURCE = vision_config.get("frame_source", "realsense")   # realsense / bag / recording
+    FRAME_SOURCE_PATH = vision_config.get("frame_source_path", "")  # bagファイル、または記録のパス（log{N}まで）
+    REALTIME_PLAYBACK = vision_config.get("realtime_playback", True)  # 再生時に記録時の速度に合わせるか
+    print(f"[設定] FRAME_SOURCE={FRAME_SOURCE}, FRAME_SOURCE_PATH={FRAME_SOURCE_PATH}, REALTIME_PLAYBACK={REALTIME_PLAYBACK}")
+except FileNotFoundError:
+    vision_config = {}                                              # 設定ファイルが無ければRealSenseを使う
+    FRAME_SOURCE, FRAME_SOURCE_PATH, REALTIME_PLAYBACK = "realsense", "", True
+except Exception as e:
+    print(f"[設定エラー] vision_config.json の読み込みに失敗しました: {e}")
+    vision_config = {}
+    FRAME_SOURCE, FRAME_SOURCE_PATH, REALTIME_PLAYBACK = "realsense", "", True
+
+# --- 推論範囲の設定 ---
+ROI_TRACKING = vision_config.get("roi_tracking", False)             # 前フレームの手の周辺だけを推論するか
+ROI_MARGIN = vision_config.get("roi_margin", 0.4)                   # 手の外接矩形を各辺この割合だけ広げて推論範囲にする
+ROI_FULL_FRAME_INTERVAL = vision_config.get("roi_full_frame_interval", 30)  # 追跡中もこのフレーム数ごとに全体を推論する（新しい手の検出用）
+INFERENCE_SCALE = vision_config.get("inference_scale", 1.0)         # 推論前に画像（または推論範囲）を縮小する倍率
+
+# --- 手検出バックエンドの設定 ---
+HAND_BACKEND = vision_config.get("hand_backend", "solutions")       # solutions: mp.solutions.hands（同期） / tasks: HandLandmarker（非同期）
+HAND_LANDMARKER_MODEL = vision_config.get("hand_landmarker_model", "Models/hand_landmarker.task")  # tasks で使うモデルファイル
+
+# --- ランドマークの平滑化と推論の間引き設定 ---
+LANDMARK_FILTER = vision_config.get("landmark_filter", False)       # 手ごとにランドマークと深度を平滑化するか（HandFilter.py）
+INFERENCE_STRIDE = max(1, int(vision_config.get("inference_stride", 1)))  # 何フレームに1回推論するか（間のフレームは予測した位置で深度を読む）
+FILTER_MIN_CUTOFF = vision_config.get("filter_min_cutoff", 1.0)     # 静止時の遮断周波数[Hz]（小さいほど強く平滑化する）
+FILTER_BETA = vision_config.get("filter_beta", 0.01)                # 動きの速さ（ピクセル/秒, mm/秒）に応じて平滑化を弱める係数
+FILTER_D_CUTOFF = vision_config.get("filter_d_cutoff", 1.0)         # 速度の推定に使う遮断周波数[Hz]
+FILTER_MAX_PREDICTION = vision_config.get("filter_max_prediction", 0.2)  # 推論せずに位置を予測し続ける最大秒数
+
+# --- 処理時間に応じた品質の自動調整設定 ---
+ADAPTIVE_QUALITY = vision_config.get("adaptive_quality", False)     # 推論の処理時間が予算を超えたら品質レベルを下げるか
+FRAME_BUDGET_MS = vision_config.get("frame_budget_ms", 0)           # 1フレームの処理時間の予算[ms]（0ならカメラのフレーム間隔）
+QUALITY_WINDOW = vision_config.get("quality_window", 30)            # 処理時間のp90を求めるフレーム数（この区間ごとにレベルを判断する）
+QUALITY_UPGRADE_RATIO = vision_config.get("quality_upgrade_ratio", 0.6)  # p90が予算のこの倍率未満なら余裕があるとみなす
+QUALITY_UPGRADE_WINDOWS = vision_config.get("quality_upgrade_windows", 3)  # 余裕のある区間がこの数続いたらレベルを1段上げる
+
+# --- 深度による推論の省略設定 ---
+DEPTH_GATING = vision_config.get("depth_gating", False)             # 深度の範囲内に何も無いフレームは推論しないか
+DEPTH_GATE_NEAR_MM = vision_config.get("depth_gate_near_mm", 100)   # 対象とする深度範囲の手前側[mm]
+DEPTH_GATE_FAR_MM = vision_config.get("depth_gate_far_mm", 700)     # 対象とする深度範囲の奥側[mm]（BehaviorManagerの DEPTH_TRIGGER より少し奥）
+DEPTH_GATE_MIN_PIXELS = vision_config.get("depth_gate_min_pixels", 20)  # 範囲内の画素（間引き後）がこの数以上あれば推論する
+DEPTH_GATE_DECIMATION = vision_config.get("depth_gate_decimation", 8)   # 判定に使う深度画像の間引き間隔（縦横）
+DEPTH_GATE_MOTION = vision_config.get("depth_gate_motion", False)   # 範囲内で前フレームから動いた画素があることも条件にするか
+DEPTH_GATE_MOTION_MM = vision_config.get("depth_gate_motion_mm", 30)  # 動いたとみなす深度の変化量[mm]
+
+# --- ランドマークの深度の位置合わせ設定 ---
+DEPTH_ALIGNMENT = vision_config.get("depth_alignment", True)       # ランドマークの点だけをカラー画像から深度画像に対応付けて深度を読むか
+ALIGNMENT_NEAR_MM = vision_config.get("alignment_near_mm", 100)     # 対応点を探す深度の範囲の手前側[mm]
+ALIGNMENT_FAR_MM = vision_config.get("alignment_far_mm", 1500)      # 対応点を探す深度の範囲の奥側[mm]
+
+# --- 画面表示の設定 ---
+DISPLAY_MODE = vision_config.get("display_mode", "window")          # window: 毎フレーム表示 / preview: PREVIEW_FPSで間引いて表示 / headless: 表示しない
+PREVIEW_FPS = vision_config.get("preview_fps", 10)                  # preview での画面の更新頻度
 
 # --- BlackBoard通信設定 ---
 HOST = 'localhost'                              # BlackBoardサーバのホストアドレス
@@ -34,6 +116,14 @@ PORT = 9000                                     # BlackBoardサーバのポー
 CLIENT_NAME = 'VM'                              # クライアント名を設定（VisionManagerを意味する）
 s = None                                        # ソケット接続オブジェクトの初期化
 
+# --- 共有メモリ最新値スロット設定 ---
+USE_SHARED_MEMORY = True                        # 手の深度・ランドマークを共有メモリでBMに渡すか（FalseならTCPのみ）
+SHM_TOPIC = "Hand"                              # 共有メモリスロットのトピック名
+SHM_CONSUMER = "BM"                             # 共有メモリスロットの受け手
+MAX_NUM_HANDS = 2                               # 検出する手の最大数（共有メモリスロットの大きさにも使う）
+shm_writer = None                               # 共有メモリ最新値スロットの書き込みオブジェクト
+shm_consumers = set()                           # 共有メモリスロットを利用中のクライアント名（これらにはDepthをTCPで送らない）
+
 # --- 解像度・フレームレート設定 ---
 #frame_width = 640          # （コメントアウト）横解像度
 #frame_height = 480         # （コメントアウト）縦解像度
@@ -46,24 +136,13 @@ mp_hands = mp.solutions.hands                  # MediaPipeの手検出モジュ
 mp_drawing = mp.solutions.drawing_utils       # MediaPipeの描画ユーティリティを初期化
 mp_drawing_styles = mp.solutions.drawing_styles  # MediaPipeの描画スタイルを初期化
 
-# --- RealSense パイプラインの初期化 ---
-pipeline = rs.pipeline()                      # RealSense用のパイプラインを作成
-config = rs.config()                          # RealSense用設定オブジェクトを作成
-config.enable_stream(rs.stream.color, frame_width, frame_height, rs.format.bgr8, frame_rate)  # カラーストリーム設定
-config.enable_stream(rs.stream.depth, frame_width, frame_height, rs.format.z16, frame_rate)   # 深度ストリーム設定
-
-# --- 映像ログ記録用関数 ---
-def initialize_video_logging():
+# --- ログ番号取得関数 ---
+def current_log_index():
     """
-    BlackBoardログ番号に合わせてカラー/深度のビデオログファイルを用意し、
-    OpenCVのVideoWriterを返す。
+    RunAll.bat実行時に先に作成されるBlackBoardログの番号（最大値）を返す。各種ログのファイル名をこの番号に合わせる。
     """
     blackboard_log_dir = "Log/BlackBoardLog"           # BlackBoardログ保存ディレクトリ
-    video_log_dir = "Log/VideoLog"                     # 映像ログ保存ディレクトリ
-
     os.makedirs(blackboard_log_dir, exist_ok=True)     # ログフォルダが存在しない場合は作成
-    os.makedirs(video_log_dir, exist_ok=True)          # 映像ログフォルダが存在しない場合は作成
-
     existing_logs = glob.glob(os.path.join(blackboard_log_dir, "log*_blackBoard.log"))  # 既存BlackBoardログを検索
 
     max_index = 0                                      # 最大ログ番号の初期値
@@ -73,8 +152,19 @@ def initialize_video_logging():
             idx = int(match.group(1))                  # ログ番号を整数に変換
             if idx > max_index:                        # 最大値を更新
                 max_index = idx
+    return max_index
+
+# --- 映像ログ記録用関数 ---
+def initialize_video_logging():
+    """
+    BlackBoardログ番号に合わせてカラー/深度のビデオログファイルを用意し、
+    OpenCVのVideoWriterを返す。
+    深度を可逆記録する設定（save_raw_depth_logs）の場合は深度のmp4は作らず、深度のVideoWriterはNoneとなる。
+    """
+    video_log_dir = "Log/VideoLog"                     # 映像ログ保存ディレクトリ
+    os.makedirs(video_log_dir, exist_ok=True)          # 映像ログフォルダが存在しない場合は作成
 
-    log_index = max_index                              # RunAll.bat実行時、先に作成されるBlackBoardログ番号を基準にする
+    log_index = current_log_index()                    # RunAll.bat実行時、先に作成されるBlackBoardログ番号を基準にする
     print(f"[ログ初期化] ログ番号: {log_index}")
 
     color_video_filename = os.path.join(video_log_dir, f"log{log_index}_colorVideo.mp4")  # カラーログファイル名
@@ -82,287 +172,1111 @@ def initialize_video_logging():
 
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')           # MP4形式用のコーデックを取得
     log_color_writer = cv2.VideoWriter(color_video_filename, fourcc, frame_rate, (frame_width, frame_height))  # カラー映像用VideoWriter
-    log_depth_writer = cv2.VideoWriter(depth_video_filename, fourcc, frame_rate, (frame_width, frame_height))  # 深度映像用VideoWriter
+    log_depth_writer = None
+    if not SAVE_RAW_DEPTH_LOGS:                        # 可逆記録しない場合のみカラーマップのmp4で記録する
+        log_depth_writer = cv2.VideoWriter(depth_video_filename, fourcc, frame_rate, (frame_width, frame_height))  # 深度映像用VideoWriter
 
     return log_color_writer, log_depth_writer          # 生成したVideoWriterを返す
 
-# --- フレームごとの手ランドマークデータ記録関数 ---
-frame_logs = []  # フレームごとのランドマークログを蓄積するリスト
-def record_frame_data(frame_idx, timestamp, hands_data, processing_time_ms):
+# --- 深度の可逆記録用関数 ---
+depth_recorder = None  # 深度フレームの可逆レコーダ
+color_recorder = None  # 再生用のカラー映像（オーバーレイ無し）のレコーダ
+def initialize_depth_recording(geometry=None):
     """
-    フレームごとの手ランドマーク情報を辞書形式でframe_logsに追加する。
+    BlackBoardログ番号に合わせて深度の可逆記録（z16の生データ、圧縮・インデックス付き）を開始する。
+    圧縮と書き込みはレコーダのスレッドで行うため、キャプチャ段はキューに積むだけ。
+    geometry（カメラのパラメータ）はメタデータに保存し、再生時の位置合わせに使う。
+    再生用に、オーバーレイを描く前のカラー映像（log{N}_colorRaw.mp4 と .mp4.idx）も記録する。
+    こちらもエンコードはレコーダのスレッドで行い、深度の記録とはインデックスの frame_index で対応付ける。
     """
-    frame_log = {
-        "frame_index": frame_idx,                     # フレーム番号
-        "timestamp": timestamp,                       # フレームのタイムスタンプ
-        "hands": hands_data                           # 検出された手のデータ
-    }
-    frame_logs.append(frame_log)                      # ログに追加
-
-# --- ログファイル保存関数 ---
-def save_all_frame_logs():
+    global depth_recorder, color_recorder
+    if not SAVE_RAW_DEPTH_LOGS:
+        return
+    video_log_dir = "Log/VideoLog"                     # 映像ログ保存ディレクトリ
+    os.makedirs(video_log_dir, exist_ok=True)
+    log_index = current_log_index()
+    base_path = os.path.join(video_log_dir, f"log{log_index}_depthRaw")
+    try:
+        extra = {"camera_geometry": geometry.to_dict()} if geometry else None
+        depth_recorder = DepthRecorder(base_path, frame_width, frame_height, extra_metadata=extra)
+        print(f"[ログ初期化] 深度の可逆記録: {base_path}.depth")
+    except Exception as e:
+        print(f"[ログ初期化エラー] 深度の可逆記録を開始できません: {e}")
+        return
+    color_recorder = ColorRecorder(os.path.join(video_log_dir, f"log{log_index}_colorRaw"), frame_width, frame_height, frame_rate)
+    print(f"[ログ初期化] 再生用のカラー映像: {color_recorder.path}")
+
+def close_depth_recording():                            # 残りの深度フレームを書き出して閉じる
+    global color_recorder
+    if color_recorder:
+        color_recorder.close()                          # 残りのカラーフレームを書き出して閉じる
+        print(f"[保存] 再生用のカラー映像を保存しました: {color_recorder.summary()}")
+        color_recorder = None
+    if depth_recorder:
+        depth_recorder.close()
+        print(f"[保存] 深度の可逆記録を保存しました: {depth_recorder.summary()}")
+        if depth_recorder.dropped:
+            print(f"[保存警告] 深度の可逆記録で {depth_recorder.dropped} フレームを記録できませんでした（.depth.json の dropped）。")
+
+# --- 手ランドマークログ記録用関数 ---
+landmark_log_writer = None  # 手ランドマークログのバックグラウンドライター
+def initialize_landmark_logging():
     """
-    frame_logsに蓄積した全データをJSONファイルとして保存する。
-    ログ形式は最上位に解像度情報、次にフレームごとのデータを格納する。
+    BlackBoardログ番号に合わせた手ランドマークログのライターを作成する。
+    記録はバックグラウンドで逐次ファイルに書き出され、一定サイズごとに新しいファイルへ切り替わる。
     """
-    if not SAVE_HANDLANDMARK_LOGS or not frame_logs:  # ログ設定が無効またはデータ無しなら終了
+    global landmark_log_writer
+    if not SAVE_HANDLANDMARK_LOGS:                    # ログ設定が無効なら何もしない
         return
 
     landmark_log_dir = "Log/HandLandmarkLog"          # 手ランドマークログ保存用ディレクトリ
     os.makedirs(landmark_log_dir, exist_ok=True)      # フォルダがなければ作成
 
-    blackboard_log_dir = "Log/BlackBoardLog"          # BlackBoardログディレクトリ
-    existing_logs = glob.glob(os.path.join(blackboard_log_dir, "log*_blackBoard.log"))  # ログファイル検索
-    max_index = 0
-    for log_file in existing_logs:
-        match = re.match(r".*log(\d+)_blackBoard\.log$", log_file)  # ログ番号を抽出
-        if match:
-            idx = int(match.group(1))
-            if idx > max_index:
-                max_index = idx
-
-    log_index = max_index                             # BlackBoardログ番号に合わせる
-    landmark_log_filename = os.path.join(landmark_log_dir, f"log{log_index}_handLandmarks.json")  # 出力ファイル名生成
+    log_index = current_log_index()                   # BlackBoardログ番号に合わせる
+    base_path = os.path.join(landmark_log_dir, f"log{log_index}_handLandmarks")  # 出力ファイル名（拡張子・パート番号は自動付与）
+    try:
+        landmark_log_writer = HandLandmarkLogWriter(
+            base_path, {"width": frame_width, "height": frame_height}, HANDLANDMARK_LOG_FORMAT)
+        print(f"[ログ初期化] 手ランドマークログ: {base_path}_part*（形式: {HANDLANDMARK_LOG_FORMAT}）")
+    except Exception as e:
+        print(f"[ログ初期化エラー] 手ランドマークログを開始できません: {e}")
 
-    logs_to_save = {                                  # ログデータ構造を作成
-        "image_resolution": {"width": frame_width, "height": frame_height},  # 解像度情報
-        "frames": frame_logs                         # フレームごとのデータ
-    }
+def record_frame_data(frame_idx, timestamp, hand_arrays):
+    """
+    フレームごとの手ランドマーク情報をライターのキューに積む（ファイル書き込みはバックグラウンドで行う）。
+    """
+    if landmark_log_writer:
+        landmark_log_writer.write(frame_idx, timestamp, hand_arrays)
 
+def close_landmark_logging():                          # 残りの手ランドマークログを書き出して閉じる
+    if not landmark_log_writer:
+        return
     try:
-        with open(landmark_log_filename, "w", encoding="utf-8") as f:  # JSONファイルを開く
-            json.dump(logs_to_save, f, indent=2, ensure_ascii=False)   # データをJSON形式で保存
-        print(f"[保存] 手ランドマークログを保存しました: {landmark_log_filename}")
+        landmark_log_writer.close()
+        print(f"[保存] 手ランドマークログを保存しました: {', '.join(landmark_log_writer.paths)}"
+              f"（{landmark_log_writer.written} フレーム, 破棄 {landmark_log_writer.dropped}）")
     except Exception as e:
         print(f"[保存エラー] 手ランドマークログ保存中に例外発生: {e}")  # 保存エラー時にメッセージを表示
 
-# --- フレーム取得関数 ---
-def safe_wait_for_frames(pipeline, max_retries=5):  # フレーム取得をリトライ付きで行う関数
-    for i in range(max_retries):                    # 最大max_retries回までリトライ
-        try:
-            return pipeline.wait_for_frames()       # フレームを取得
-        except RuntimeError as e:                   # 取得に失敗した場合
-            print(f"[警告] フレームの取得に失敗（{i+1}/{max_retries}）: {e}")  # 警告を表示
-            time.sleep(0.5)                         # 0.5秒待って再試行
-    raise RuntimeError("フレーム取得に連続で失敗しました。")  # 最大リトライを超えた場合は例外を送出
-
 # --- BlackBoardからのコマンド受信用スレッド ---
 def receive_from_blackboard():                     # BlackBoardからのコマンドを受信するスレッド
     global s, running
-    while True:                                    # 無限ループで受信を監視
-        try:
-            msg = s.recv(1024).decode()            # BlackBoardからデータを受信
-            if msg:
-                print(f"[BlackBoard→VM] {msg}")   # 受信したメッセージを表示
-
-                if msg.strip() == "EXIT":          # EXITコマンドが届いた場合
-                    print("[終了指示] EXITコマンドを受信しました。VisionManagerを終了します。")
-                    try:
-                        s.sendall(b"ACK;EXIT_RECEIVED")      # EXIT受領確認のACKを送信
-                        print("[ACK送信] EXIT受領確認を送信しました。")
-                    except Exception as e:
-                        print(f"[ACK送信失敗] {e}")          # ACK送信失敗時のエラーメッセージ
-                    running = False                          # メインループ終了フラグをFalseに設定
-                    break                                    # スレッドループを終了
-
-        except Exception:                                   # ソケットエラー時
-            break                                           # スレッドループを終了
+    try:
+        for msg_type, sender, content in iter_frames(s):  # フレーム単位で受信を監視
+            print(f"[BlackBoard→VM] {sender}: {content}")  # 受信したメッセージを表示
+
+            if msg_type == MSG_EXIT:               # EXITコマンドが届いた場合
+                print("[終了指示] EXITコマンドを受信しました。VisionManagerを終了します。")
+                try:
+                    send_frame(s, MSG_ACK, "", "EXIT_RECEIVED")  # EXIT受領確認のACKを送信
+                    print("[ACK送信] EXIT受領確認を送信しました。")
+                except Exception as e:
+                    print(f"[ACK送信失敗] {e}")              # ACK送信失敗時のエラーメッセージ
+                running = False                              # メインループ終了フラグをFalseに設定
+                break                                        # スレッドループを終了
+
+            elif msg_type == MSG_SHM_ACCEPT:                 # 共有メモリスロットの利用状態通知
+                topic, _, in_use = content.partition(";")
+                if in_use == "1":
+                    shm_consumers.add(sender)                # 以降このクライアントへはDepthをTCPで送らない
+                else:
+                    shm_consumers.discard(sender)            # 受け手が切断したのでTCP送信に戻す
+
+    except Exception:                                       # ソケットエラー時
+        pass                                                # スレッドループを終了
 
 # --- ソケット接続処理 ---
 def connect_to_blackboard():                      # BlackBoardサーバへ接続する関数
     global s
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCPソケットを作成
-    s.connect((HOST, PORT))                                # BlackBoardに接続
+    s = connect_blackboard(HOST, PORT)                     # BlackBoardに接続（起動中なら待って再試行）
 
-    local_ip, local_port = s.getsockname()                # 自分のIPとポート番号を取得
-    init_msg = f"{CLIENT_NAME};{local_ip}:{local_port}"   # 初期メッセージを作成
-    s.sendall(init_msg.encode())                          # 初期メッセージを送信
+    local_ip, local_port = send_hello(s, CLIENT_NAME)     # 初期メッセージ（HELLO）を送信
 
     print(f"[接続] BlackBoardに '{CLIENT_NAME}'（{local_ip}:{local_port}）として接続済み")
 
+    offer_shared_memory()                              # 共有メモリ最新値スロットをBMに提供する
+
     recv_thread = threading.Thread(target=receive_from_blackboard, daemon=True)  # BlackBoard受信用スレッドを作成
     recv_thread.start()                                # スレッドを開始
 
+def disconnect_from_blackboard():                 # 共有メモリスロットを解放し、BlackBoardとの接続を閉じる
+    global s, shm_writer
+    if shm_writer:
+        shm_writer.close()                             # 共有メモリスロットを解放する（BlackBoardは切断時に受け手へ取り下げを通知する）
+        shm_writer = None
+    if s:
+        s.close()                                      # BlackBoardへのソケット接続を閉じる
+        s = None
+        print("[切断] BlackBoardとの接続を閉じました。")
+
+# --- 共有メモリ最新値スロットの提供 ---
+def offer_shared_memory():
+    global shm_writer
+    if not USE_SHARED_MEMORY:
+        return
+    try:
+        shm_writer = LatestValueWriter(max_hands=MAX_NUM_HANDS)  # 共有メモリスロットを作成
+    except Exception as e:
+        print(f"[共有メモリ] スロットの作成に失敗しました。TCPのみで送信します: {e}")
+        return
+    send_frame(s, MSG_SHM_OFFER, SHM_CONSUMER, f"{SHM_TOPIC};{shm_writer.name}")  # BlackBoard経由で受け手に通知
+    print(f"[共有メモリ] {SHM_CONSUMER} に {SHM_TOPIC} スロット {shm_writer.name} を提供しました")
+
+def publish_shared_memory(frame_idx, hand_arrays, min_depth, trace=None):  # 最新の手情報を共有メモリスロットに書き込む
+    if shm_writer is None:
+        return
+    landmarks = np.concatenate(                                # (手の数, 21, 6): pixel_x, pixel_y, depth, x, y, z
+        [hand_arrays["pixels"].astype(np.float32), hand_arrays["depths"][..., None], hand_arrays["points"]],
+        axis=2)[:MAX_NUM_HANDS]
+    if trace is not None:
+        trace["vm"] = LatencyTrace.now()                       # 送信時刻
+    shm_writer.publish(frame_idx, time.time(), min_depth, np.ascontiguousarray(landmarks), len(landmarks), trace)
+
 # --- フレーム内のすべての手のランドマーク情報を整理する ---
+# ランドマークの深度は、その画素を中心とした小さなパッチ内の有効画素（深度>0）の中央値とする。
+# 1画素だけを読むと深度の穴（0）や物体の縁で値が跳ぶため、パッチの中央値で安定させる。
+# 全ランドマークの座標変換とパッチ読み出しはNumPyでまとめて行い、辞書への変換はログ記録など必要な場合のみ行う。
+# カラーと深度の画像は位置合わせされていないため、カメラのパラメータが分かる場合（camera_geometry）は
+# ランドマークの点だけを深度画像上の対応点に移してから深度を読み、深度カメラ座標系の3次元座標[mm]も求める。
+DEPTH_PATCH_RADIUS = 2                          # 深度パッチの半径（2なら5x5画素）
+_PATCH_DY, _PATCH_DX = (offsets.ravel() for offsets in np.mgrid[-DEPTH_PATCH_RADIUS:DEPTH_PATCH_RADIUS + 1,
+                                                                 -DEPTH_PATCH_RADIUS:DEPTH_PATCH_RADIUS + 1])  # パッチ内の相対座標
+camera_geometry = None                          # フレームソースから取得したカメラのパラメータ（CameraGeometry）
+
+def sample_landmark_depths(depth_image, pixels, in_frame):
+    """
+    pixels（N×2, x,y）の各点について、周囲パッチ内の有効深度の中央値を返す（N, float32）。
+    画像外の点や有効画素が無い点はNaNとする。
+    """
+    dh, dw = depth_image.shape[:2]
+    xs = np.clip(pixels[:, 0:1] + _PATCH_DX, 0, dw - 1)       # 画像端ではパッチを内側に寄せる
+    ys = np.clip(pixels[:, 1:2] + _PATCH_DY, 0, dh - 1)
+    patches = depth_image[ys, xs].astype(np.float32)        # 全点のパッチを一括で読み出す（N×パッチ画素数）
+    patches[patches == 0] = np.nan                          # 深度0は無効
+    patches[~in_frame] = np.nan                             # 画像外の点は無効
+    patches.sort(axis=1)                                    # NaNは末尾に並ぶ
+    valid_count = np.count_nonzero(~np.isnan(patches), axis=1)
+    rows = np.arange(len(patches))
+    lo = np.maximum((valid_count - 1) // 2, 0)              # 有効画素の中央位置
+    hi = valid_count // 2
+    depths = (patches[rows, lo] + patches[rows, hi]) * 0.5  # 偶数個なら中央2値の平均
+    depths[valid_count == 0] = np.nan
+    return depths
+
+def empty_hand_arrays():                          # 手が1つも無い場合の配列形式の手情報
+    return {
+        "color_pixels": np.zeros((0, 21, 2), np.float32),
+        "pixels": np.zeros((0, 21, 2), np.int32),
+        "depths": np.zeros((0, 21), np.float32),
+        "points": np.zeros((0, 21, 3), np.float32),
+        "in_frame": np.zeros((0, 21), bool),
+        "min_depths": np.zeros(0, np.float32),
+        "handedness": [], "scores": [], "multi_hand_landmarks": [],
+    }
+
+def detected_hands(results, image_shape):
+    """
+    検出結果から全手のランドマークの座標と左右判定を配列にまとめて返す（深度は読まない）。
+    """
+    h, w = image_shape[:2]                          # 入力画像の高さ・幅を取得
+    multi_hand_landmarks = results.multi_hand_landmarks or []
+    multi_handedness = results.multi_handedness or []
+    num_hands = min(len(multi_hand_landmarks), len(multi_handedness))
+    if num_hands == 0:
+        return empty_hand_arrays()
+    normalized = np.array([[(lm.x, lm.y) for lm in hand_landmarks.landmark]
+                           for hand_landmarks in multi_hand_landmarks[:num_hands]], dtype=np.float32)
+    color_pixels = normalized * np.array([w, h], np.float32)
+    return {
+        "color_pixels": color_pixels,
+        "pixels": color_pixels.astype(np.int32),    # 正規化座標をピクセル座標に一括変換
+        "handedness": [hd.classification[0].label for hd in multi_handedness[:num_hands]],
+        "scores": [hd.classification[0].score for hd in multi_handedness[:num_hands]],
+        "multi_hand_landmarks": list(multi_hand_landmarks[:num_hands]),
+    }
+
+def measure_landmarks(color_pixels, depth_image, image_shape):
+    """
+    カラー画像上のランドマーク座標（手の数×21×2, float32）について、深度と3次元座標を読む。
+    pixels / depths / points / in_frame の辞書を返す（意味は extract_hand_arrays() と同じ）。
+    """
+    h, w = image_shape[:2]
+    num_hands = len(color_pixels)
+    pixels = color_pixels.astype(np.int32)
+    in_frame = ((pixels[..., 0] >= 0) & (pixels[..., 0] < w) &
+                (pixels[..., 1] >= 0) & (pixels[..., 1] < h))              # 画像範囲内かどうか
+    geometry = camera_geometry if DEPTH_ALIGNMENT else None
+    if geometry is not None:                        # ランドマークの点だけを深度画像に対応付ける
+        depth_pixels, _ = geometry.color_to_depth_pixels(color_pixels.reshape(-1, 2), depth_image,
+                                                         ALIGNMENT_NEAR_MM, ALIGNMENT_FAR_MM)
+        depths = sample_landmark_depths(depth_image, depth_pixels, in_frame.reshape(-1)) * np.float32(geometry.depth_unit_mm)
+        points = geometry.deproject_depth(depth_pixels, depths).astype(np.float32).reshape(num_hands, -1, 3)
+        depths = depths.reshape(num_hands, -1)
+    else:                                           # パラメータが無い場合はカラー画像の座標でそのまま読む
+        depths = sample_landmark_depths(depth_image, pixels.reshape(-1, 2), in_frame.reshape(-1)).reshape(num_hands, -1)
+        points = np.full((num_hands, 21, 3), np.nan, np.float32)
+    return {"pixels": pixels, "depths": depths, "points": points, "in_frame": in_frame}
+
+def hand_min_depths(depths):                        # 手ごとの最小深度（有効な深度が無い手はNaN）
+    valid = ~np.isnan(depths)
+    min_depths = np.where(valid, depths, np.inf).min(axis=1)
+    min_depths[~valid.any(axis=1)] = np.nan
+    return min_depths.astype(np.float32)
+
+def extract_hand_arrays(results, depth_image, image_shape):
+    """
+    検出結果から全手のランドマーク座標と深度を配列にまとめて返す。
+      color_pixels: (手の数, 21, 2) float32 のカラー画像上の座標（小数）
+      pixels: (手の数, 21, 2) int32 のピクセル座標
+      depths: (手の数, 21) float32 の深度[mm]（無効はNaN）
+      points: (手の数, 21, 3) float32 の深度カメラ座標系の3次元座標[mm]（位置合わせしない場合・無効はNaN）
+      in_frame: (手の数, 21) bool 画像内かどうか
+      min_depths: (手の数,) float32 手ごとの最小深度（無効はNaN）
+      handedness / scores: 左右判定とその信頼度のリスト
+      multi_hand_landmarks: 描画用のMediaPipeランドマーク
+    """
+    hand_arrays = detected_hands(results, image_shape)
+    if len(hand_arrays["color_pixels"]) == 0:
+        return hand_arrays
+    hand_arrays.update(measure_landmarks(hand_arrays["color_pixels"], depth_image, image_shape))
+    hand_arrays["min_depths"] = hand_min_depths(hand_arrays["depths"])
+    return hand_arrays
+
+def overall_min_depth(hand_arrays):                 # 検出したすべての手のうち、最も近い手の深度を返す（無ければNone）
+    min_depths = hand_arrays["min_depths"]
+    min_depths = min_depths[~np.isnan(min_depths)]
+    return float(min_depths.min()) if len(min_depths) else None
+
 def extract_all_hands_landmarks(results, depth_image, image_shape):
     """
     検出結果から全手の21ランドマーク座標と深度を整理し、
     各手のhand_id, handedness, confidence, landmarks情報を含む辞書リストを返す。
     """
-    h, w, _ = image_shape                           # 入力画像の高さ・幅を取得
-    all_hands_data = []                            # 全ての手データを格納するリスト
-
-    if results.multi_hand_landmarks and results.multi_handedness:  # ランドマークと左右判定情報がある場合
-        for i, (hand_landmarks, handedness) in enumerate(zip(results.multi_hand_landmarks, results.multi_handedness)):  # 各手ごとに処理
-            landmarks_list = []                    # この手のランドマーク情報リスト
-            depth_values = []                      # 有効な深度値を格納するリスト
-
-            for idx, lm in enumerate(hand_landmarks.landmark):  # 各ランドマークを処理
-                cx, cy = int(lm.x * w), int(lm.y * h)           # 正規化座標をピクセル座標に変換
-                if 0 <= cx < w and 0 <= cy < h:                 # 画像範囲内の場合
-                    d = depth_image[cy, cx]                     # 深度値を取得
-                    if d > 0:                                   # 有効な深度なら
-                        depth_values.append(d)                  # 有効深度をリストに追加
-                    depth_val = float(d)                        # 深度値をfloat型に変換
-                else:
-                    depth_val = None                           # 範囲外の場合はNone
-
-                landmarks_list.append({                         # ランドマーク情報を辞書にして追加
-                    "landmark_id": idx,
-                    "pixel_x": cx,
-                    "pixel_y": cy,
-                    "depth": depth_val
-                })
-
-            min_depth = np.min(depth_values) if depth_values else None  # 有効深度があれば最小値を計算
-
-            single_hand_data = {                               # 手情報を辞書にまとめる
-                "hand_id": i,
-                "handedness": handedness.classification[0].label,
-                "hand_confidence": handedness.classification[0].score,
-                "min_depth": float(min_depth) if min_depth is not None else None,
-                "landmarks": landmarks_list
+    hand_arrays = extract_hand_arrays(results, depth_image, image_shape)
+    return hand_arrays_to_dicts(hand_arrays), hand_arrays["multi_hand_landmarks"]  # 全手情報とランドマークそのものを返す
+
+# --- 推論範囲（ROI）の追跡と縮小推論 ---
+# 前フレームで手を検出した場合、そのランドマークの外接矩形を広げた正方形の範囲だけを切り出してMediaPipeに渡す。
+# 範囲は手がその内側に収まっている間は動かさない（MediaPipe内部のトラッキングが同じ座標系で続けられるようにする）。
+# 手を見失った場合と、一定フレームごと（画面外から入ってくる手の検出用）には画像全体で推論する。
+# 検出結果の正規化座標は切り出し範囲から画像全体の座標に戻すため、深度の読み出しや描画は従来どおり行える。
+ROI_MIN_SIZE = 192                              # 推論範囲の最小の一辺（ピクセル）
+ROI_MAX_AREA_RATIO = 0.6                        # 推論範囲が画像のこの割合より大きくなる場合は全体で推論する
+inference_counts = {"full_frame": 0, "roi": 0, "skipped": 0, "predicted": 0}  # 全体・推論範囲で推論したフレーム数、深度判定で推論を省略したフレーム数、推論を間引いて予測したフレーム数
+
+def landmarks_roi(pixels, image_shape, margin=ROI_MARGIN):
+    """
+    ランドマーク（手の数×21×2 のピクセル座標）を囲む推論範囲 (x0, y0, x1, y1) を返す。
+    範囲が大きすぎて切り出す意味が無い場合はNoneを返す。
+    """
+    h, w = image_shape[:2]
+    points = pixels.reshape(-1, 2)
+    (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+    size = max(x1 - x0, y1 - y0) * (1 + 2 * margin)
+    size = int(min(max(size, ROI_MIN_SIZE), w, h))  # 正方形の一辺
+    if size * size > ROI_MAX_AREA_RATIO * w * h:
+        return None
+    left = int(np.clip((x0 + x1 - size) // 2, 0, w - size))  # 画像端では範囲を内側に寄せる
+    top = int(np.clip((y0 + y1 - size) // 2, 0, h - size))
+    return (left, top, left + size, top + size)
+
+def roi_contains(roi, pixels, margin=ROI_MARGIN):  # ランドマークが推論範囲の内側（端から余白の半分以上内側）に収まっているか
+    x0, y0, x1, y1 = roi
+    inset = int((x1 - x0) * margin / (1 + 2 * margin) / 2)
+    points = pixels.reshape(-1, 2)
+    return bool(((points[:, 0] >= x0 + inset) & (points[:, 0] < x1 - inset) &
+                 (points[:, 1] >= y0 + inset) & (points[:, 1] < y1 - inset)).all())
+
+def prepare_inference_image(image, roi=None, scale=INFERENCE_SCALE):
+    """
+    image（BGR）の roi の範囲を scale 倍に縮小したRGB画像を返す。roi がNoneなら画像全体。
+    """
+    h, w = image.shape[:2]
+    x0, y0, x1, y1 = roi or (0, 0, w, h)
+    crop = image[y0:y1, x0:x1]                                  # 切り出し（コピーはしない）
+    if scale != 1.0:
+        crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    image_rgb = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)           # RGB形式に変換（切り出し・縮小後なので小さい）
+    image_rgb.flags.writeable = False                           # 画像を読み取り専用にして処理を高速化
+    return image_rgb
+
+def remap_landmarks(results, roi, image_shape):  # 切り出し範囲の正規化座標を画像全体に対する値に変換する
+    if not roi or not results.multi_hand_landmarks:
+        return
+    h, w = image_shape[:2]
+    x0, y0, x1, y1 = roi
+    sx, sy = (x1 - x0) / w, (y1 - y0) / h
+    for hand_landmarks in results.multi_hand_landmarks:
+        for lm in hand_landmarks.landmark:
+            lm.x = x0 / w + lm.x * sx
+            lm.y = y0 / h + lm.y * sy
+            lm.z *= sx                                          # zは画像の幅を基準にした値
+
+def process_hands(hands, image, roi=None, scale=INFERENCE_SCALE):
+    """
+    image（BGR）の roi の範囲を scale 倍に縮小してMediaPipeで手検出を行う。roi がNoneなら画像全体。
+    検出されたランドマークの正規化座標は画像全体に対する値に変換して返す。
+    """
+    results = hands.process(prepare_inference_image(image, roi, scale))  # MediaPipeで手検出を実行
+    remap_landmarks(results, roi, image.shape)
+    return results
+
+def next_roi(roi, hand_arrays, image_shape):    # 検出結果から次のフレームの推論範囲を決める
+    if not ROI_TRACKING or len(hand_arrays["pixels"]) == 0:
+        return None                             # 見失った場合は画像全体に戻す
+    if roi is None or not roi_contains(roi, hand_arrays["pixels"]):
+        return landmarks_roi(hand_arrays["pixels"], image_shape)
+    return roi
+
+# --- 深度による推論の省略 ---
+# ロボットが反応するのは近くの手だけなので、間引いた深度画像で対象の深度範囲に物があるかを先に調べ、
+# 何も無いフレームではMediaPipeを実行しない（展示で人がいない間はほとんどCPUを使わない）。
+# 前フレームで手を検出している間は判定せずに推論を続ける。
+class DepthGate:
+    """
+    間引いた深度画像で、深度範囲内の画素数（と、必要なら前フレームからの動き）を調べて推論の要否を判定する。
+    """
+    def __init__(self, near_mm=DEPTH_GATE_NEAR_MM, far_mm=DEPTH_GATE_FAR_MM, min_pixels=DEPTH_GATE_MIN_PIXELS,
+                 decimation=DEPTH_GATE_DECIMATION, motion=DEPTH_GATE_MOTION, motion_mm=DEPTH_GATE_MOTION_MM):
+        self.near_mm, self.far_mm = near_mm, far_mm
+        self.min_pixels = min_pixels
+        self.decimation = decimation
+        self.motion, self.motion_mm = motion, motion_mm
+        self.previous = None                    # 前フレームの間引き深度画像（動き判定用）
+
+    def should_infer(self, depth_image):        # 推論が必要ならTrue
+        small = depth_image[::self.decimation, ::self.decimation]  # 間引き（コピーしない）
+        in_band = (small >= self.near_mm) & (small <= self.far_mm)  # 深度0（無効）は範囲外
+        if self.motion:
+            previous, self.previous = self.previous, small.astype(np.int16)  # 次のフレームとの比較用
+            if previous is None:
+                return bool(np.count_nonzero(in_band) >= self.min_pixels)
+            moved = np.abs(self.previous - previous) >= self.motion_mm
+            return bool(np.count_nonzero(in_band & moved) >= self.min_pixels)
+        return bool(np.count_nonzero(in_band) >= self.min_pixels)
+
+# --- ランドマークの平滑化と、推論しないフレームの予測 ---
+# 推論したフレームでは検出結果を手ごとの追跡（HandTracker）に渡して座標を平滑化し、
+# 推論を間引いたフレーム（INFERENCE_STRIDE）では追跡中の手の座標を等速運動で予測する。
+# どちらも、その座標で現在のフレームの深度画像から深度を読み直してから深度も平滑化するため、
+# 推論を間引いても深度はカメラのフレームごとに測った値になる。
+# 平滑化しない設定（landmark_filter: false）で間引く場合は、検出結果と深度をそのまま使い、間引いたフレームの予測だけを行う。
+def create_hand_tracker():                      # 平滑化も推論の間引きも行わない設定ならNone
+    if not LANDMARK_FILTER and INFERENCE_STRIDE == 1:
+        return None
+    return HandTracker(FILTER_MIN_CUTOFF, FILTER_BETA, FILTER_D_CUTOFF, max_prediction=FILTER_MAX_PREDICTION,
+                       smoothing=LANDMARK_FILTER)  # 平滑化しない設定では、推論しなかったフレームの予測だけを行う
+
+def landmark_lists(color_pixels, image_shape):  # 座標（手の数×21×2）から描画用のMediaPipeランドマークを作る
+    h, w = image_shape[:2]
+    return [landmark_pb2.NormalizedLandmarkList(landmark=[
+                landmark_pb2.NormalizedLandmark(x=x / w, y=y / h) for x, y in hand.tolist()])
+            for hand in color_pixels]
+
+def filter_hand_arrays(tracker, frame, detected=None):
+    """
+    detected（推論したフレームの detected_hands() の結果）があれば追跡を更新し、無ければ追跡中の手の座標を予測する。
+    平滑化・予測した座標で frame の深度画像から深度を読み、深度も平滑化した手情報（extract_hand_arrays() と同じ形）を返す。
+    """
+    t = frame["timestamp_ms"] / 1000.0          # カメラのタイムスタンプ（秒）
+    if detected is not None:
+        color_pixels = tracker.update(detected["color_pixels"], detected["handedness"], detected["scores"], t)
+    else:
+        color_pixels = tracker.predict(t)
+    if len(color_pixels) == 0:
+        return empty_hand_arrays()
+    image_shape = frame["image"].shape
+    hand_arrays = measure_landmarks(color_pixels, frame["depth_image"], image_shape)
+    hand_arrays["depths"], hand_arrays["points"] = tracker.smooth_measurements(hand_arrays["depths"], hand_arrays["points"], t)
+    hand_arrays.update(
+        color_pixels=color_pixels,
+        min_depths=hand_min_depths(hand_arrays["depths"]),
+        handedness=tracker.handedness,
+        scores=tracker.scores,
+        multi_hand_landmarks=landmark_lists(color_pixels, image_shape),
+    )
+    return hand_arrays
+
+# --- 処理時間に応じた品質の自動調整 ---
+# 推論したフレームの処理時間を QualityController に渡し、予算を超え続けたら下の段に、余裕が続けば上の段に移る。
+# 段ごとに変えるのは、MediaPipeのモデルの複雑さ・推論前の縮小倍率（inference_scale に掛ける）・検出する手の最大数・
+# 画面表示の頻度の上限・映像ログへのオーバーレイ描画で、精度への影響が小さいものから順に軽くする。
+# 各フレームには推論段で処理したときのレベル（frame["quality"]）を付け、描画・記録段もそのレベルに従う。
+# tasks バックエンドではモデルの複雑さと手の最大数は変えない（推論器を作り直すと推論中の結果が失われるため）。
+QUALITY_LEVELS = [                              # 0が最高品質（従来の設定）。preview_fps は画面表示の頻度の上限（Noneなら display_mode のまま）
+    {"model_complexity": 1, "scale": 1.0, "max_num_hands": 2, "preview_fps": None, "render_overlays": True},
+    {"model_complexity": 1, "scale": 1.0, "max_num_hands": 2, "preview_fps": 5, "render_overlays": True},
+    {"model_complexity": 0, "scale": 1.0, "max_num_hands": 2, "preview_fps": 5, "render_overlays": True},
+    {"model_complexity": 0, "scale": 0.75, "max_num_hands": 2, "preview_fps": 2, "render_overlays": True},
+    {"model_complexity": 0, "scale": 0.5, "max_num_hands": 1, "preview_fps": 2, "render_overlays": False},
+]
+quality_counts = {}                             # 品質レベルごとの推論段の処理フレーム数
+quality_changes = []                            # 品質レベルの変更履歴
+quality_log = None                              # 品質レベルの変更ログ（1行1件のJSON）
+
+def create_hands(level=0):                      # 品質レベルに応じたMediaPipe Handsを作る
+    settings = QUALITY_LEVELS[level]
+    return mp_hands.Hands(
+        model_complexity=settings["model_complexity"],  # モデルの複雑さ（1:標準, 0:軽量）
+        min_detection_confidence=0.5,           # 検出の最低信頼度
+        min_tracking_confidence=0.5,            # トラッキングの最低信頼度
+        max_num_hands=min(settings["max_num_hands"], MAX_NUM_HANDS))  # 最大検出する手の数
+
+def hands_changed(old, new):                    # レベルの変更でHandsを作り直す必要があるか
+    return any(QUALITY_LEVELS[old][key] != QUALITY_LEVELS[new][key] for key in ("model_complexity", "max_num_hands"))
+
+def quality_budget_ms():                        # 1フレームの処理時間の予算[ms]
+    return FRAME_BUDGET_MS or 1000.0 / frame_rate
+
+def create_quality_controller():                # 自動調整しない設定ならNone
+    if not ADAPTIVE_QUALITY:
+        return None
+    return QualityController(len(QUALITY_LEVELS), quality_budget_ms(), QUALITY_WINDOW,
+                             QUALITY_UPGRADE_RATIO, QUALITY_UPGRADE_WINDOWS)
+
+def initialize_quality_logging():
+    """
+    BlackBoardログ番号に合わせて品質レベルの変更ログを開き、開始時のレベルを1行目に書く。
+    各行の frame_idx 以降のフレームが、その行の to のレベルで処理されている。
+    """
+    global quality_log
+    if not ADAPTIVE_QUALITY or not SAVE_QUALITY_LOGS:
+        return
+    quality_log_dir = "Log/QualityLog"                 # 品質レベルの変更ログ保存ディレクトリ
+    os.makedirs(quality_log_dir, exist_ok=True)
+    path = os.path.join(quality_log_dir, f"log{current_log_index()}_quality.jsonl")
+    try:
+        quality_log = open(path, "w", encoding="utf-8")
+        print(f"[ログ初期化] 品質レベルの変更ログ: {path}")
+    except OSError as e:
+        print(f"[ログ初期化エラー] 品質レベルの変更ログを開始できません: {e}")
+        return
+    write_quality_entry({"frame_idx": 0, "time": time.time(), "from": None, "to": 0,
+                         "budget_ms": round(quality_budget_ms(), 2), "settings": QUALITY_LEVELS[0]})
+
+def write_quality_entry(entry):                 # 変更ログに1行書く（変更は数秒に1回以下なのでその場で書き出す）
+    if quality_log:
+        quality_log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        quality_log.flush()
+
+def log_quality_change(frame_idx, old, new, p90_ms, budget_ms):  # 品質レベルの変更を表示・記録する（frame_idx 以降が新しいレベル）
+    entry = {"frame_idx": frame_idx, "time": time.time(), "from": old, "to": new,
+             "p90_ms": round(p90_ms, 2), "budget_ms": round(budget_ms, 2), "settings": QUALITY_LEVELS[new]}
+    quality_changes.append(entry)
+    print(f"[品質] フレーム {frame_idx} からレベル {old} → {new}（処理時間p90 {p90_ms:.1f} ms, 予算 {budget_ms:.1f} ms）: "
+          f"{QUALITY_LEVELS[new]}")
+    write_quality_entry(entry)
+
+def close_quality_logging():                    # 品質レベルの変更ログを閉じる
+    global quality_log
+    if quality_log:
+        quality_log.close()
+        quality_log = None
+
+# --- パイプライン処理（キャプチャ → 推論 → 送信 / 描画・記録） ---
+# 各段は別スレッドで動き、段の間は長さ制限付きキューでつなぐ。
+# 後段が追いつかない場合はキュー内の最も古いフレームを捨て（drop-oldest）、常に新しいフレームを処理する。
+# ただし記録ファイルの再生（ライブでないソース）では捨てずに後段を待ち、全フレームを処理する。
+# 送信段は描画・記録段と独立しているため、深度の送信が動画エンコードやGUI更新を待つことはない。
+CAPTURE_QUEUE_SIZE = 2                          # キャプチャ → 推論キューの長さ
+PUBLISH_QUEUE_SIZE = 8                          # 推論 → 送信キューの長さ
+RENDER_QUEUE_SIZE = 2                           # 推論 → 描画・記録キューの長さ
+STATS_INTERVAL = 5.0                            # 段ごとのスループットを表示する間隔（秒）
+
+class StageStats:
+    """
+    パイプライン段ごとの処理フレーム数・処理時間・破棄フレーム数を集計する。
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.processed = 0                      # 処理したフレーム数
+        self.dropped = 0                        # 後段が詰まって捨てたフレーム数
+        self.busy_time = 0.0                    # 処理に費やした合計時間（秒）
+
+    def add(self, elapsed):                     # 1フレーム分の処理時間を加算する
+        with self.lock:
+            self.processed += 1
+            self.busy_time += elapsed
+
+    def add_drop(self):                         # 捨てたフレームを数える
+        with self.lock:
+            self.dropped += 1
+
+    def summary(self, wall_time):               # 表示用の集計文字列を返す
+        with self.lock:
+            fps = self.processed / wall_time if wall_time > 0 else 0.0
+            avg_ms = self.busy_time / self.processed * 1000 if self.processed else 0.0
+            return f"{self.name}: {fps:.1f} fps, 平均 {avg_ms:.1f} ms/frame, 破棄 {self.dropped}"
+
+    def as_dict(self, wall_time):               # ベンチマーク出力用の集計値を返す
+        with self.lock:
+            return {
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "fps": self.processed / wall_time if wall_time > 0 else 0.0,
+                "avg_ms": self.busy_time / self.processed * 1000 if self.processed else 0.0,
             }
-            all_hands_data.append(single_hand_data)            # 手情報を全体リストに追加
 
-    return all_hands_data, results.multi_hand_landmarks if results.multi_hand_landmarks else []  # 全手情報とランドマークそのものを返す
+class DepthSeriesStats:
+    """
+    送信した最小深度の揺れを集計する。深度が続けて得られた3フレームの2階差分の絶対値の平均（mm）を揺れとし、
+    同じ記録で平滑化・推論の間引きの設定を比べるために使う。
+    """
+    def __init__(self):
+        self.frames = 0                         # 深度を送ったフレーム数
+        self.recent = []                        # 直近の連続した深度（最大3つ）
+        self.total = 0.0                        # 2階差分の絶対値の合計
+        self.count = 0
+
+    def add(self, min_depth):
+        if min_depth is None:                   # 手が無いフレームで連続が途切れる
+            self.recent = []
+            return
+        self.frames += 1
+        self.recent = (self.recent + [min_depth])[-3:]
+        if len(self.recent) == 3:
+            a, b, c = self.recent
+            self.total += abs(c - 2 * b + a)
+            self.count += 1
+
+    def as_dict(self):
+        return {"frames": self.frames, "jitter_mm": self.total / self.count if self.count else None}
+
+def put_latest(q, item, stats):                 # キューが満杯なら最も古い要素を捨ててから追加する
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()                  # 最も古いフレームを捨てる
+                stats.add_drop()
+            except queue.Empty:
+                pass
+
+def put_all(q, item):                           # キューに空きができるまで待って追加する（再生用、フレームを捨てない）
+    while running:
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False                                # 終了指示が出たので追加しなかった
+
+def put_frame(q, item, stats, drop):            # ライブならdrop-oldest、再生なら待って追加する
+    if drop:
+        put_latest(q, item, stats)
+    else:
+        put_all(q, item)
+
+def close_queue(q, drop=True):                  # 終了の合図（None）を後段に渡す
+    if drop or not put_all(q, None):            # 再生中は残りのフレームを捨てずに終端を渡す
+        put_latest(q, None, StageStats("close"))
+
+def capture_stage(source, capture_queue, stats):  # フレームソースからフレームを取得して推論段に渡す
+    global running
+    frame_idx = 0                               # フレーム番号の初期化
+    try:
+        while running:                          # runningフラグがTrueの間ループを継続
+            t0 = time.perf_counter()
+            try:
+                frame = source.read()           # カメラまたは記録ファイルからフレームを取得
+            except RuntimeError as e:
+                print("[エラー]", e)            # フレーム取得失敗時のエラーメッセージ
+                running = False
+                break
+            if frame is None:                   # 記録ファイルの終端
+                print("[入力] フレームソースの終端に達しました。")
+                break
+            frame["frame_idx"] = frame_idx
+            if TRACE_LATENCY:                   # フレーム番号をトレースIDとし、受け取った時刻を記録する
+                frame["trace"] = {"id": frame_idx, "hw": frame["timestamp_ms"], "cap": LatencyTrace.now()}
+                if source.live:                 # RealSenseのタイムスタンプ（既定はホスト時刻に同期）から受け取るまでの遅延
+                    frame["trace"]["cam"] = time.time() * 1000 - frame["timestamp_ms"]
+            if color_recorder:                           # 描画前のカラー映像を記録（描画段が同じ配列に描き込むため複製して渡す）
+                color_recorder.write(frame_idx, frame["timestamp_ms"], frame["image"].copy())
+            if depth_recorder:                           # 深度の生データを可逆記録（圧縮はレコーダのスレッドで行う）
+                depth_recorder.write(frame_idx, frame["timestamp_ms"], frame["depth_image"])
+            frame_idx += 1
+            stats.add(time.perf_counter() - t0)          # ライブでは待ち時間を含むため、ほぼカメラのフレーム間隔になる
+            put_frame(capture_queue, frame, stats, source.live)  # ライブで推論が追いつかなければ古いフレームを捨てる
+    finally:
+        close_queue(capture_queue, source.live)
+
+def inference_stage(hands, capture_queue, publish_queue, render_queue, stats, drop=True):  # 手検出とランドマーク抽出を行う
+    roi = None                                  # 推論範囲（Noneなら画像全体）
+    frames_since_full = 0                       # 最後に画像全体で推論してからのフレーム数
+    depth_gate = DepthGate() if DEPTH_GATING else None
+    tracker = create_hand_tracker()             # 平滑化・推論の間引きを行わない設定ならNone
+    stride_count = 0                            # 推論の間引き用のフレーム数（深度判定で省略したフレームは数えない）
+    controller = create_quality_controller()    # 品質を自動調整しない設定ならNone
+    level = 0                                   # 現在の品質レベル
+    current_hands = hands                       # 品質レベルに応じて作り直したHands（最初は main() で作ったもの）
+    hand_arrays = empty_hand_arrays()           # 前フレームの検出結果
+    try:
+        while True:
+            frame = capture_queue.get()
+            if frame is None:                   # 前段の終了
+                break
+            t0 = time.perf_counter()
+            frame["quality"] = level
+            quality_counts[level] = quality_counts.get(level, 0) + 1
+            tracking = len(hand_arrays["pixels"]) > 0  # 前フレームで手を検出していれば深度判定せずに推論を続ける
+            if depth_gate and not tracking and not depth_gate.should_infer(frame["depth_image"]):
+                inference_counts["skipped"] += 1   # 深度範囲内に何も無いので推論しない
+                frame["roi"] = roi = None
+                hand_arrays = empty_hand_arrays()
+                if tracker:
+                    tracker.reset()
+                stride_count = 0                # 次に深度範囲内に物が入ったフレームはすぐ推論する
+            elif tracker and stride_count % INFERENCE_STRIDE != 0:
+                stride_count += 1
+                inference_counts["predicted"] += 1  # 推論せず、追跡中の手の位置を予測して深度を読む
+                frame["roi"] = roi
+                hand_arrays = filter_hand_arrays(tracker, frame)
+            else:
+                stride_count += 1
+                if frames_since_full >= ROI_FULL_FRAME_INTERVAL:
+                    roi = None                  # 定期的に画像全体を見て、新しく入ってきた手を検出する
+                results = process_hands(current_hands, frame["image"], roi,  # 推論範囲（無ければ全体）でMediaPipeの手検出を実行
+                                        INFERENCE_SCALE * QUALITY_LEVELS[level]["scale"])
+                frame["roi"] = roi
+                if roi is None:
+                    inference_counts["full_frame"] += 1
+                    frames_since_full = 0
+                else:
+                    inference_counts["roi"] += 1
+                    frames_since_full += 1
 
-# --- メイン処理 ---
-def main():                                           # メイン関数（プログラムのエントリポイント）
-    connect_to_blackboard()                          # BlackBoardに接続し、受信用スレッドを開始する
+                # --- ランドマーク抽出と結果取得（配列形式） ---
+                if tracker:                     # 平滑化した座標で深度を読む
+                    detected = detected_hands(results, frame["image"].shape)
+                    hand_arrays = filter_hand_arrays(tracker, frame, detected)
+                else:
+                    detected = hand_arrays = extract_hand_arrays(results, frame["depth_image"], frame["image"].shape)
+
+                # --- 次のフレームの推論範囲を決める（平滑化前の検出結果から） ---
+                roi = next_roi(roi, detected, frame["image"].shape)
+
+                # --- 処理時間に応じて次のフレームからの品質レベルを決める ---
+                change = controller.add((time.perf_counter() - t0) * 1000) if controller else None
+                if change:
+                    old, level, p90_ms = change
+                    log_quality_change(frame["frame_idx"] + 1, old, level, p90_ms, controller.budget_ms)
+                    if hands_changed(old, level):
+                        if current_hands is not hands:
+                            current_hands.close()
+                        current_hands = create_hands(level)
+
+            # --- 検出したすべての手のうち、最も近い手の深度を取得 ---
+            frame["hands"] = hand_arrays
+            frame["min_depth"] = overall_min_depth(hand_arrays)
+            if "trace" in frame:
+                frame["trace"]["inf"] = LatencyTrace.now()
+            stats.add(time.perf_counter() - t0)
+
+            put_frame(publish_queue, frame, stats, drop)   # 送信段（通常は詰まらない）
+            put_frame(render_queue, frame, stats, drop)    # 描画・記録段（ライブで遅ければ古いフレームを捨てる）
+    finally:
+        if current_hands is not hands:          # 作り直したHandsを閉じる（main() で作ったものは main() が閉じる）
+            current_hands.close()
+        close_queue(publish_queue, drop)
+        close_queue(render_queue, drop)
 
-    start_time = time.time()                         # メイン処理開始時刻を記録する
+ASYNC_RESULT_TIMEOUT = 0.5                      # 非同期推論でこの秒数以上結果が届かないフレームは、MediaPipeが捨てたとみなす
 
-    log_color_writer, log_depth_writer = initialize_video_logging()  # ログ用のVideoWriterを初期化する
+def async_inference_stage(landmarker, capture_queue, publish_queue, render_queue, stats, drop=True):
+    """
+    HandLandmarker（ライブストリームモード）で手検出を行う推論段。推論の完了を待たずに次のフレームを受け取り、
+    結果はコールバック（MediaPipeのスレッド）で受け取ってランドマーク抽出を行う。後段へはフレームの取得順に渡す。
+    ライブ（drop=True）では推論中でも次のフレームを渡し、MediaPipeが捨てたフレームは破棄として数える。
+    再生（drop=False）では前のフレームの結果が届いてから次を渡し、全フレームを処理する。
+    推論範囲の追跡と深度による省略は、その時点で最後に届いた結果をもとに判断する。
+    推論を間引いたフレームは、その時点で最後に届いた結果までの追跡から手の位置を予測する。
+    """
+    cond = threading.Condition()
+    pending = deque()                           # 取得順のフレーム（結果待ちのものと、結果が揃ったもの）
+    state = {"roi": None, "hand_arrays": empty_hand_arrays(),  # 最後に届いた結果と、それから決めた推論範囲
+             "level": 0, "last_submitted": -1}  # 現在の品質レベルと、最後に推論を依頼したフレーム番号
+
+    def waiting():                              # 結果待ちのフレーム数
+        return sum(1 for frame in pending if "hands" not in frame)
+
+    def emit_ready():                           # 先頭から結果の揃ったフレームを後段に渡す（cond を保持して呼ぶ）
+        while pending and "hands" in pending[0]:
+            frame = pending.popleft()
+            put_frame(publish_queue, frame, stats, drop)
+            put_frame(render_queue, frame, stats, drop)
+
+    def discard(frame):                         # 結果が届かなかったフレームを捨てる（cond を保持して呼ぶ）
+        pending.remove(frame)
+        stats.add_drop()
+
+    def on_result(results, timestamp_ms):       # MediaPipeのスレッドから呼ばれる
+        with cond:
+            for frame in list(pending):
+                if "hands" in frame or frame["inference_ts"] > timestamp_ms:
+                    continue
+                if frame["inference_ts"] < timestamp_ms:  # 結果は時刻順に届くので、これより前の結果待ちはMediaPipeが捨てた
+                    discard(frame)
+                    continue
+                remap_landmarks(results, frame["roi"], frame["image"].shape)
+                if tracker:                     # 平滑化した座標で深度を読む
+                    detected = detected_hands(results, frame["image"].shape)
+                    hand_arrays = filter_hand_arrays(tracker, frame, detected)
+                else:
+                    detected = hand_arrays = extract_hand_arrays(results, frame["depth_image"], frame["image"].shape)
+                state["hand_arrays"] = hand_arrays
+                state["roi"] = next_roi(frame["roi"], detected, frame["image"].shape)
+                frame["hands"] = hand_arrays
+                frame["min_depth"] = overall_min_depth(hand_arrays)
+                if "trace" in frame:
+                    frame["trace"]["inf"] = LatencyTrace.now()
+                elapsed = time.perf_counter() - frame["submitted"]
+                stats.add(elapsed)                # 依頼から結果までの時間
+                change = controller.add(elapsed * 1000) if controller else None
+                if change:                        # 次に依頼するフレームから品質レベルを変える
+                    old, state["level"], p90_ms = change
+                    log_quality_change(state["last_submitted"] + 1, old, state["level"], p90_ms, controller.budget_ms)
+            emit_ready()
+            cond.notify_all()
+
+    def expire():                               # 長く結果の届かないフレームを捨てる（cond を保持して呼ぶ）
+        deadline = time.perf_counter() - ASYNC_RESULT_TIMEOUT
+        for frame in list(pending):
+            if "hands" not in frame and frame["submitted"] < deadline:
+                discard(frame)
+        emit_ready()
+
+    tracker = create_hand_tracker()             # 平滑化・推論の間引きを行わない設定ならNone（cond を保持して使う）
+    controller = create_quality_controller()    # 品質を自動調整しない設定ならNone（cond を保持して使う）
+    landmarker.on_result = on_result
+    frames_since_full = 0                       # 最後に画像全体で推論してからのフレーム数
+    stride_count = 0                            # 推論の間引き用のフレーム数（深度判定で省略したフレームは数えない）
+    last_ts = -1                                # MediaPipeに渡した最後のタイムスタンプ（増加させる必要がある）
+    depth_gate = DepthGate() if DEPTH_GATING else None
+    try:
+        while True:
+            try:
+                frame = capture_queue.get(timeout=0.1)
+            except queue.Empty:
+                with cond:
+                    expire()
+                continue
+            if frame is None:                   # 前段の終了
+                break
+            t0 = time.perf_counter()
+            with cond:
+                if not drop:                    # 再生: 前のフレームの結果を待つ
+                    cond.wait_for(lambda: waiting() == 0, timeout=ASYNC_RESULT_TIMEOUT)
+                expire()
+                tracking = len(state["hand_arrays"]["pixels"]) > 0 or waiting() > 0
+                roi = state["roi"]
+                level = frame["quality"] = state["level"]
+                quality_counts[level] = quality_counts.get(level, 0) + 1
+                skip = depth_gate and not tracking and not depth_gate.should_infer(frame["depth_image"])
+                predict = not skip and tracker and stride_count % INFERENCE_STRIDE != 0
+                if skip:
+                    inference_counts["skipped"] += 1   # 深度範囲内に何も無いので推論しない
+                    frame["roi"] = state["roi"] = None
+                    frame["hands"] = state["hand_arrays"] = empty_hand_arrays()
+                    if tracker:
+                        tracker.reset()
+                    stride_count = 0                # 次に深度範囲内に物が入ったフレームはすぐ推論する
+                elif predict:
+                    stride_count += 1
+                    inference_counts["predicted"] += 1  # 推論せず、追跡中の手の位置を予測して深度を読む
+                    frame["roi"] = roi
+                    frame["hands"] = state["hand_arrays"] = filter_hand_arrays(tracker, frame)
+                if skip or predict:
+                    frame["min_depth"] = overall_min_depth(frame["hands"])
+                    if "trace" in frame:
+                        frame["trace"]["inf"] = LatencyTrace.now()
+                    pending.append(frame)
+                    stats.add(time.perf_counter() - t0)
+                    emit_ready()
+                    continue
+                stride_count += 1
+            if frames_since_full >= ROI_FULL_FRAME_INTERVAL:
+                roi = None                      # 定期的に画像全体を見て、新しく入ってきた手を検出する
+            frame["roi"] = roi
+            if roi is None:
+                inference_counts["full_frame"] += 1
+                frames_since_full = 0
+            else:
+                inference_counts["roi"] += 1
+                frames_since_full += 1
+            image_rgb = prepare_inference_image(frame["image"], roi, INFERENCE_SCALE * QUALITY_LEVELS[level]["scale"])
+            last_ts = max(int(frame["timestamp_ms"]), last_ts + 1)
+            frame["inference_ts"] = last_ts
+            frame["submitted"] = t0
+            with cond:
+                pending.append(frame)
+                state["last_submitted"] = frame["frame_idx"]
+            landmarker.submit(image_rgb, last_ts)   # 推論の完了を待たずに次のフレームへ進む
+    finally:
+        with cond:                              # 推論中のフレームの結果を待ってから後段を閉じる
+            cond.wait_for(lambda: waiting() == 0, timeout=ASYNC_RESULT_TIMEOUT * 4)
+            for frame in [frame for frame in pending if "hands" not in frame]:
+                discard(frame)
+            emit_ready()
+            landmarker.on_result = None
+        close_queue(publish_queue, drop)
+        close_queue(render_queue, drop)
+
+def send_depth_to_blackboard(min_depth, trace=None):  # 最小深度をBM宛てにTCPで送る（BMが共有メモリで受け取っている場合は送らない）
+    if s and min_depth is not None and SHM_CONSUMER not in shm_consumers:
+        try:
+            message = f"Depth:{min_depth:.1f}"              # メッセージを作成
+            if trace is not None:                         # 遅延トレースを付ける（BlackBoard・BMが時刻を書き足す）
+                message = LatencyTrace.attach_trace(message, {**trace, "vm": LatencyTrace.now()})
+            send_frame(s, MSG_ROUTE, "BM", message)       # BM宛てフレームとして送信
+            print(f"[送信] {message}")
+        except Exception as e:
+            print(f"[送信エラー] {e}")                    # 送信失敗時に表示
+
+def publish_stage(publish_queue, stats, depth_stats):  # 深度の送信とランドマークログの記録を行う
+    while True:
+        frame = publish_queue.get()
+        if frame is None:                       # 前段の終了
+            break
+        t0 = time.perf_counter()
+        frame_idx = frame["frame_idx"]
+        min_depth_overall = frame["min_depth"]
+        trace = frame.get("trace")
+
+        # --- 最新の手情報を共有メモリスロットに書き込む ---
+        publish_shared_memory(frame_idx, frame["hands"], min_depth_overall, trace)
+
+        # --- 最小深度をBlackBoardに送信（共有メモリで受け取っている場合は送らない） ---
+        send_depth_to_blackboard(min_depth_overall, trace)
+        depth_stats.add(min_depth_overall)
+
+        # --- 手ランドマークのログ保存（書き込みはバックグラウンド） ---
+        record_frame_data(frame_idx, time.time(), frame["hands"])
+        stats.add(time.perf_counter() - t0)
+
+def render_and_record(frame, log_color_writer, log_depth_writer, show=True, overlays=True):
+    """
+    オーバーレイ描画・映像ログ保存・画面表示を行う。show=False では画面に表示しない。
+    カラー映像への描画は表示か映像ログに使う場合のみ、深度のカラーマップは表示か深度の映像ログに使う場合のみ行う。
+    overlays=False（品質レベルを下げた場合）では、表示しないフレームの映像ログにはオーバーレイを描かない。
+    何もしなかった場合はFalseを返す。
+    """
+    draw_color = show or (log_color_writer is not None and overlays)
+    draw_depth = show or log_depth_writer is not None
+    if not draw_color and not draw_depth and log_color_writer is None:  # 表示も映像ログも無い（ヘッドレス）
+        return False
+
+    # --- 現在日時を文字列化 ---
+    now = time.localtime()
+    datetime_text = time.strftime("%Y-%m-%d %H:%M:%S", now)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale, color, thickness = 0.5, (255, 255, 255), 1
+    (text_width, _), _ = cv2.getTextSize(datetime_text, font, font_scale, thickness)
+
+    image = frame["image"]
+    if draw_color:
+        draw_color_overlay(frame, datetime_text, text_width)
+
+    depth_colormap = None
+    if draw_depth:
+        depth_colormap = cv2.applyColorMap(             # 深度をカラーマップ化
+            cv2.convertScaleAbs(frame["depth_image"], alpha=0.03), cv2.COLORMAP_JET)
+        # --- 深度映像にも日時を右上に描画 ---
+        cv2.putText(depth_colormap, datetime_text, (depth_colormap.shape[1]-text_width-10, 20), font, font_scale, color, thickness, cv2.LINE_AA)
+
+    # --- 映像ログ保存 ---
+    if log_color_writer:
+        log_color_writer.write(image)                      # カラー映像を保存
+        if log_depth_writer:
+            log_depth_writer.write(depth_colormap)         # 深度映像を保存（可逆記録時は作成しない）
+
+    # --- 映像を画面に表示 ---
+    if show:
+        cv2.imshow('RealSense D415 with MediaPipe Hands (Color)', image)         # カラー映像を表示
+        cv2.imshow('RealSense D415 Depth', depth_colormap)                      # 深度映像を表示
+    return True
+
+def draw_color_overlay(frame, datetime_text, text_width):  # カラー映像にランドマーク・深度・日時・フレーム番号を描画する
+    image = frame["image"]
+
+    # --- 検出した各手のランドマークを描画 ---
+    hand_arrays = frame["hands"]
+    for i, hand_landmarks in enumerate(hand_arrays["multi_hand_landmarks"]):
+        mp_drawing.draw_landmarks(                        # MediaPipeのランドマークを描画
+            image,
+            hand_landmarks,
+            mp_hands.HAND_CONNECTIONS,
+            mp_drawing_styles.get_default_hand_landmarks_style(),
+            mp_drawing_styles.get_default_hand_connections_style()
+        )
+        # 手の中心に最小深度をテキストで描画
+        center_x, center_y = hand_arrays["pixels"][i].mean(axis=0).astype(int)
+        min_depth = hand_arrays["min_depths"][i]
+        if not np.isnan(min_depth):
+            text = f"Min Depth: {min_depth:.1f}mm"
+            cv2.putText(image, text, (center_x - 70, center_y - 50),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, cv2.LINE_AA)
+        else:
+            cv2.putText(image, "Min Depth: N/A", (50, 50),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2, cv2.LINE_AA)
+
+    # --- カラー映像に日時を右上に描画 ---
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale, color, thickness = 0.5, (255, 255, 255), 1
+    cv2.putText(image, datetime_text, (image.shape[1]-text_width-10, 20), font, font_scale, color, thickness, cv2.LINE_AA)
+
+    # --- frame番号を描画 ---
+    if frame.get("roi"):                                 # 推論範囲を枠で描画
+        x0, y0, x1, y1 = frame["roi"]
+        cv2.rectangle(image, (x0, y0), (x1, y1), (255, 255, 0), 1)
+
+    frame_text = f"Frame: {frame['frame_idx']}"                         # 表示用文字列を作成
+    (frame_text_width, _), _ = cv2.getTextSize(frame_text, font, font_scale, thickness)  # テキストサイズ取得
+    cv2.putText(image, frame_text, (image.shape[1]-frame_text_width-10, 45),  # 右上に表示（日時の少し下）
+                font, font_scale, color, thickness, cv2.LINE_AA)
 
-    print("RealSense カメラを起動中...")
+# --- メイン処理 ---
+def main(source=None, use_blackboard=True, display=True):  # メイン関数（プログラムのエントリポイント）
+    """
+    source を省略すると vision_config.json のフレームソースを使う。
+    use_blackboard=False ではBlackBoardに接続せず、display=False では画面表示を行わない（ベンチマーク用）。
+    display=True の場合も vision_config.json の display_mode が headless なら表示せず、preview なら preview_fps に間引いて表示する。
+    終了時に段ごとの集計値を辞書で返す。
+    """
+    global running, frame_width, frame_height, frame_rate, camera_geometry
+    running = True
+    for key in inference_counts:
+        inference_counts[key] = 0
+    quality_counts.clear()
+    quality_changes.clear()
+    if use_blackboard:
+        connect_to_blackboard()                      # BlackBoardに接続し、受信用スレッドを開始する
+
+    if source is None:
+        source = create_frame_source(FRAME_SOURCE, FRAME_SOURCE_PATH, frame_width, frame_height, frame_rate, REALTIME_PLAYBACK)
+
+    print("フレームソースを起動中...")
     try:
-        pipeline.start(config)                       # RealSenseパイプラインを開始する
-        print("RealSense カメラが起動しました。")
+        source.start()                               # カメラ、または記録ファイルの再生を開始する
+        frame_width, frame_height = source.width, source.height  # 記録の再生では記録時の解像度に合わせる
+        frame_rate = int(round(source.fps))
+        camera_geometry = getattr(source, "geometry", None)  # 起動時に取得したカメラのパラメータ（無ければ位置合わせしない）
+        print(f"フレームソースが起動しました。（{type(source).__name__}, {frame_width}x{frame_height}）")
     except Exception as e:
-        print("RealSense カメラの起動に失敗しました:", e)  # カメラ起動失敗時にエラーメッセージを表示
-        return
+        print("フレームソースの起動に失敗しました:", e)  # カメラ起動失敗時にエラーメッセージを表示
+        disconnect_from_blackboard()
+        return None
+
+    log_color_writer, log_depth_writer = initialize_video_logging() if SAVE_VIDEO_LOGS else (None, None)  # ログ用のVideoWriterを初期化する
+    initialize_landmark_logging()                    # 手ランドマークログのライターを開始する
+    initialize_depth_recording(camera_geometry)      # 深度の可逆記録を開始する
+    initialize_quality_logging()                     # 品質レベルの変更ログを開始する
+
+    stage_stats = {name: StageStats(name) for name in ("capture", "inference", "publish", "render")}
+    depth_stats = DepthSeriesStats()
+    capture_queue = queue.Queue(maxsize=CAPTURE_QUEUE_SIZE)
+    publish_queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+    render_queue = queue.Queue(maxsize=RENDER_QUEUE_SIZE)
+    workers = []
 
     try:
-        with mp_hands.Hands(                        # MediaPipe Handsを初期化
-            model_complexity=1,                      # モデルの複雑さ（1:標準）
-            min_detection_confidence=0.5,            # 検出の最低信頼度
-            min_tracking_confidence=0.5,             # トラッキングの最低信頼度
-            max_num_hands=2) as hands:               # 最大検出する手は2つ
-
-            frame_idx = 0                           # フレーム番号の初期化
-
-            while running:                          # runningフラグがTrueの間ループを継続
+        if HAND_BACKEND == "tasks":                 # MediaPipe Tasks の HandLandmarker（非同期）
+            hands = AsyncHandLandmarker(HAND_LANDMARKER_MODEL, max_num_hands=MAX_NUM_HANDS)
+            inference_target = async_inference_stage
+        else:
+            hands = create_hands()                   # MediaPipe Handsを初期化（最高品質のレベル）
+            inference_target = inference_stage
+        print(f"[手検出] バックエンド: {HAND_BACKEND}")
+        if LANDMARK_FILTER or INFERENCE_STRIDE > 1:
+            smoothing = f"min_cutoff={FILTER_MIN_CUTOFF}, beta={FILTER_BETA}" if LANDMARK_FILTER else "無効"
+            print(f"[手検出] 平滑化: {smoothing}, 推論の間隔: {INFERENCE_STRIDE} フレームごと")
+        if ADAPTIVE_QUALITY:
+            print(f"[品質] 自動調整: 予算 {quality_budget_ms():.1f} ms/フレーム, {len(QUALITY_LEVELS)} 段階")
+        with hands:
+
+            workers = [
+                threading.Thread(target=capture_stage, args=(source, capture_queue, stage_stats["capture"]), daemon=True),
+                threading.Thread(target=inference_target, args=(hands, capture_queue, publish_queue, render_queue, stage_stats["inference"], source.live), daemon=True),
+                threading.Thread(target=publish_stage, args=(publish_queue, stage_stats["publish"], depth_stats), daemon=True),
+            ]
+            for worker in workers:
+                worker.start()
+
+            # --- 描画・記録段（GUI操作はメインスレッドで行う） ---
+            show_window = display and DISPLAY_MODE != "headless"
+            preview_interval = 1.0 / PREVIEW_FPS if DISPLAY_MODE == "preview" and PREVIEW_FPS > 0 else 0.0
+            next_preview = 0.0                      # 次に画面を更新する時刻（preview）
+            print(f"[表示] {DISPLAY_MODE if show_window else 'headless'}"
+                  + (f"（{PREVIEW_FPS}fps）" if show_window and preview_interval else ""))
+            pipeline_start = time.perf_counter()
+            last_report = pipeline_start
+            while True:
                 try:
-                    frames = safe_wait_for_frames(pipeline)  # RealSenseからフレームを取得
-                except RuntimeError as e:
-                    print("[エラー]", e)            # フレーム取得失敗時のエラーメッセージ
-                    break                           # メインループを終了
-
-                color_frame = frames.get_color_frame()       # カラーフレームを取得
-                depth_frame = frames.get_depth_frame()       # 深度フレームを取得
-                if not color_frame or not depth_frame:       # いずれかのフレームが無効な場合はスキップ
-                    continue
-
-                image = np.asanyarray(color_frame.get_data())       # カラーフレームをNumPy配列に変換
-                image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # RGB形式に変換
-                depth_image = np.asanyarray(depth_frame.get_data()) # 深度フレームをNumPy配列に変換
-                depth_colormap = cv2.applyColorMap(                 # 深度をカラーマップ化
-                    cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
-
-                image_rgb.flags.writeable = False                   # 画像を読み取り専用にして処理を高速化
-                results = hands.process(image_rgb)                  # MediaPipeで手検出を実行
-                image.flags.writeable = True                        # 処理後に書き込み可能に戻す
-
-                # --- ランドマーク抽出と結果取得 ---
-                hands_data, multi_hand_landmarks = extract_all_hands_landmarks(results, depth_image, image.shape)
-
-                # --- 検出したすべての手のうち、最も近い手の深度を取得 ---
-                min_depths = [hand["min_depth"] for hand in hands_data if hand["min_depth"] is not None]
-                min_depth_overall = min(min_depths) if min_depths else None
-
-                # --- 最小深度をBlackBoardに送信 ---
-                if min_depth_overall is not None:
-                    try:
-                        message = f"BM;Depth:{min_depth_overall:.1f}"  # メッセージを作成
-                        s.sendall(message.encode())                   # メッセージを送信
-                        print(f"[送信] {message}")
-                    except Exception as e:
-                        print(f"[送信エラー] {e}")                    # 送信失敗時に表示
-
-                # --- 検出した各手のランドマークを描画 ---
-                for hand, hand_landmarks in zip(hands_data, multi_hand_landmarks):
-                    mp_drawing.draw_landmarks(                        # MediaPipeのランドマークを描画
-                        image,
-                        hand_landmarks,
-                        mp_hands.HAND_CONNECTIONS,
-                        mp_drawing_styles.get_default_hand_landmarks_style(),
-                        mp_drawing_styles.get_default_hand_connections_style()
-                    )
-                    # 手の中心に最小深度をテキストで描画
-                    if hand["landmarks"]:
-                        lm_points = hand["landmarks"]
-                        center_x = int(np.mean([lm["pixel_x"] for lm in lm_points]))
-                        center_y = int(np.mean([lm["pixel_y"] for lm in lm_points]))
-                        if hand["min_depth"] is not None:
-                            text = f"Min Depth: {hand['min_depth']:.1f}mm"
-                            cv2.putText(image, text, (center_x - 70, center_y - 50),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, cv2.LINE_AA)
-                        else:
-                            cv2.putText(image, "Min Depth: N/A", (50, 50),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2, cv2.LINE_AA)
-
-                # --- 現在日時を文字列化 ---
-                now = time.localtime()
-                datetime_text = time.strftime("%Y-%m-%d %H:%M:%S", now)
-
-                # --- カラー映像に日時を右上に描画 ---
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                font_scale, color, thickness = 0.5, (255, 255, 255), 1
-                (text_width, _), _ = cv2.getTextSize(datetime_text, font, font_scale, thickness)
-                cv2.putText(image, datetime_text, (image.shape[1]-text_width-10, 20), font, font_scale, color, thickness, cv2.LINE_AA)
-
-                # --- 深度映像にも日時を右上に描画 ---
-                (depth_text_width, _), _ = cv2.getTextSize(datetime_text, font, font_scale, thickness)
-                cv2.putText(depth_colormap, datetime_text, (depth_colormap.shape[1]-depth_text_width-10, 20), font, font_scale, color, thickness, cv2.LINE_AA)
-
-                # --- frame番号を描画 ---
-                frame_text = f"Frame: {frame_idx}"                                  # 表示用文字列を作成
-                (frame_text_width, _), _ = cv2.getTextSize(frame_text, font, font_scale, thickness)  # テキストサイズ取得
-                cv2.putText(image, frame_text, (image.shape[1]-frame_text_width-10, 45),  # 右上に表示（日時の少し下）
-                            font, font_scale, color, thickness, cv2.LINE_AA)
-
-                # --- 映像ログ保存 ---
-                if SAVE_VIDEO_LOGS:
-                    log_color_writer.write(image)                      # カラー映像を保存
-                    log_depth_writer.write(depth_colormap)             # 深度映像を保存
-
-                # --- 手ランドマークのログ保存 ---
-                if SAVE_HANDLANDMARK_LOGS:
-                    frame_timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())  # ISO形式の時刻文字列
-                    elapsed_ms = (time.time() - start_time) * 1000      # 処理開始からの経過時間を計算
-                    record_frame_data(frame_idx, frame_timestamp, hands_data, elapsed_ms)  # フレーム情報を記録
-
-                frame_idx += 1  # フレーム番号を更新
-
-                # --- 映像を画面に表示 ---
-                cv2.imshow('RealSense D415 with MediaPipe Hands (Color)', image)         # カラー映像を表示
-                cv2.imshow('RealSense D415 Depth', depth_colormap)                      # 深度映像を表示
-
-                if cv2.waitKey(5) & 0xFF == 27:  # ESCキーが押されたらループを抜ける
+                    frame = render_queue.get(timeout=0.1)
+                except queue.Empty:
+                    frame = False                   # フレーム無しでもwaitKeyは回してウィンドウを応答させる
+                if frame is None:                   # 推論段の終了
+                    break
+                show = False
+                if frame:
+                    t0 = time.perf_counter()
+                    settings = QUALITY_LEVELS[frame.get("quality", 0)]  # 推論段で処理したときの品質レベル
+                    show = show_window and t0 >= next_preview
+                    if show:
+                        interval = preview_interval
+                        if settings["preview_fps"]:  # 品質を下げている間は表示の頻度も抑える
+                            interval = max(interval, 1.0 / settings["preview_fps"])
+                        next_preview = t0 + interval
+                    if render_and_record(frame, log_color_writer, log_depth_writer, show, settings["render_overlays"]):
+                        stage_stats["render"].add(time.perf_counter() - t0)
+
+                if show_window and (show or frame is False) and cv2.waitKey(5) & 0xFF == 27:  # ESCキーが押されたらループを抜ける
                     break
 
-    finally:
-        print("RealSense カメラを停止中...")
-        pipeline.stop()                         # RealSenseパイプラインを停止する
-        print("RealSense カメラが停止しました。")
-
-        save_all_frame_logs()                   # フレームごとのランドマークデータをJSONに保存する
+                now = time.perf_counter()
+                if now - last_report >= STATS_INTERVAL:  # 段ごとのスループットを定期的に表示
+                    for st in stage_stats.values():
+                        print(f"[パイプライン] {st.summary(now - pipeline_start)}")
+                    print(f"[推論] {inference_counts}")
+                    last_report = now
+            running = False                         # 他の段にも終了を知らせる
+            for worker in workers:
+                worker.join(timeout=2.0)            # 推論中のフレームを処理し終えるまで待つ
+
+            wall_time = time.perf_counter() - pipeline_start
+            for st in stage_stats.values():
+                print(f"[パイプライン] {st.summary(wall_time)}")
+            print(f"[推論] 全体 {inference_counts['full_frame']} フレーム, 追跡範囲 {inference_counts['roi']} フレーム, "
+                  f"深度判定で省略 {inference_counts['skipped']} フレーム, 間引いて予測 {inference_counts['predicted']} フレーム")
+            depth = depth_stats.as_dict()
+            if depth["jitter_mm"] is not None:
+                print(f"[深度] 送信 {depth['frames']} フレーム, 揺れ（2階差分の平均） {depth['jitter_mm']:.2f} mm")
+            quality = {"changes": list(quality_changes), "frames_per_level": dict(sorted(quality_counts.items()))}
+            if ADAPTIVE_QUALITY:
+                print(f"[品質] レベルの変更 {len(quality['changes'])} 回, レベルごとのフレーム数: {quality['frames_per_level']}")
+            return {"wall_time": wall_time, "stages": {name: st.as_dict(wall_time) for name, st in stage_stats.items()},
+                    "inference_counts": dict(inference_counts), "depth": depth, "quality": quality}
 
-        cv2.destroyAllWindows()                 # OpenCVのウィンドウを全て閉じる
-        if s:
-            s.close()                           # BlackBoardへのソケット接続を閉じる
-            print("[切断] BlackBoardとの接続を閉じました。")
+    finally:
+        running = False
+        print("フレームソースを停止中...")
+        source.stop()                           # カメラ、または記録ファイルの再生を停止する
+        print("フレームソースが停止しました。")
+
+        close_landmark_logging()                # 手ランドマークログの残りを書き出して閉じる
+        close_depth_recording()                 # 深度の可逆記録の残りを書き出して閉じる
+        close_quality_logging()                 # 品質レベルの変更ログを閉じる
+        if log_color_writer:
+            log_color_writer.release()          # 映像ログファイルを閉じる
+        if log_depth_writer:
+            log_depth_writer.release()
+
+        if display and DISPLAY_MODE != "headless":
+            cv2.destroyAllWindows()             # OpenCVのウィンドウを全て閉じる
+        disconnect_from_blackboard()            # 共有メモリスロットを解放し、BlackBoardとの接続を閉じる
 
 if __name__ == "__main__":                     # スクリプトが直接実行されたときのみ
     main()                                     # メイン処理を実行する